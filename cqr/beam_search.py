@@ -0,0 +1,91 @@
+import torch
+
+
+class BeamHypotheses:
+    """ The num_keep best finished rewrites, scored by their log prob / length ** length_penalty """
+
+    def __init__(self, num_keep, length_penalty=1.0, early_stopping=True):
+        self.num_keep = num_keep
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.hypotheses = []  # (score, token ids, log prob)
+
+    def score(self, log_prob, length):
+        return log_prob / max(length, 1) ** self.length_penalty
+
+    def add(self, token_ids, log_prob, length):
+        """ length counts the scored tokens, i.e. <EOS> too when the rewrite ended with it """
+        score = self.score(log_prob, length)
+        if len(self.hypotheses) < self.num_keep or score > self.hypotheses[-1][0]:
+            self.hypotheses.append((score, token_ids, log_prob))
+            self.hypotheses.sort(key=lambda hypothesis: -hypothesis[0])
+            del self.hypotheses[self.num_keep:]
+
+    def is_done(self, best_log_prob, length):
+        """ Whether no beam still running, the best of which has best_log_prob after length tokens, can make it
+            into the kept rewrites. Without early stopping this assumes that the running beams do not get longer,
+            the usual approximation for length penalties above 0.
+        """
+        if len(self.hypotheses) < self.num_keep:
+            return False
+        if self.early_stopping:
+            return True
+        return self.hypotheses[-1][0] >= self.score(best_log_prob, length)
+
+    def best(self, num_return):
+        return [(token_ids, log_prob) for _, token_ids, log_prob in self.hypotheses[:num_return]]
+
+
+def beam_search(step, log_probs, past, eos_id, max_length, num_beams=4, num_return=1, length_penalty=1.0,
+                early_stopping=True):
+    """ The num_return best continuations of one conversation, as (token ids, log prob) pairs, best first.
+        All beams are decoded together as one batch on top of the conversation's cached history, which is
+        encoded once by the caller.
+        Args:
+            step: step(tokens, past) decodes tokens (beams x 1) given the cached past of every beam and returns
+                the next token log probs (beams x vocabulary size) and the new past
+            log_probs: next token log probs after the history (1 x vocabulary size)
+            past: key/value states of the history (one tensor per layer, batch dimension 1), reordered with
+                index_select along that dimension as beams are selected
+            length_penalty: rewrites are ranked by log prob / length ** length_penalty, above 0 favours longer ones
+            early_stopping: stop as soon as num_beams rewrites are finished instead of when no running beam can
+                beat them any more
+    """
+    device = log_probs.device
+    hypotheses = BeamHypotheses(max(num_beams, num_return), length_penalty, early_stopping)
+    beam_log_probs = torch.zeros(1, device=device)
+    beam_tokens = [[]]
+    for cur_length in range(1, max_length + 1):
+        vocab_size = log_probs.size(-1)
+        candidate_log_probs = (beam_log_probs.unsqueeze(1) + log_probs).view(-1)
+        # twice as many candidates as beams, so that num_beams of them do not end with <EOS>
+        top_log_probs, top_indices = candidate_log_probs.topk(min(2 * num_beams, candidate_log_probs.numel()))
+        top_log_probs, top_indices = top_log_probs.tolist(), top_indices.tolist()
+
+        next_beams = []  # (log prob, beam index, token)
+        for rank, (log_prob, index) in enumerate(zip(top_log_probs, top_indices)):
+            beam, token = divmod(index, vocab_size)
+            if token == eos_id:
+                # only an <EOS> among the num_beams best candidates ends a rewrite
+                if rank < num_beams:
+                    hypotheses.add(beam_tokens[beam], log_prob, cur_length)
+            else:
+                next_beams.append((log_prob, beam, token))
+            if len(next_beams) == num_beams:
+                break
+
+        done = hypotheses.is_done(next_beams[0][0], cur_length)
+        if done or cur_length == max_length:
+            break
+        beam_log_probs = torch.tensor([log_prob for log_prob, _, _ in next_beams], device=device)
+        beam_index = torch.tensor([beam for _, beam, _ in next_beams], dtype=torch.long, device=device)
+        tokens = torch.tensor([[token] for _, _, token in next_beams], dtype=torch.long, device=device)
+        beam_tokens = [beam_tokens[beam] + [token] for _, beam, token in next_beams]
+        past = [layer_past.index_select(1, beam_index) for layer_past in past]
+        log_probs, past = step(tokens, past)
+
+    if not done:
+        # beams that reached max_length without <EOS>
+        for log_prob, beam, token in next_beams:
+            hypotheses.add(beam_tokens[beam] + [token], log_prob, cur_length)
+    return hypotheses.best(num_return)
@@ -0,0 +1,295 @@
+import argparse
+import json
+import time
+import numpy as np
+import torch
+
+from torch.nn import functional as F
+from torch.utils.data import BatchSampler, RandomSampler
+from transformers import GPT2Tokenizer
+
+from cqr.dataset import load_dataset
+from cqr.inference_model import InferenceModel
+from cqr.modeling import GPT2DoubleHeadsTargetModel, GPT2LMHeadTargetModel, target_positions
+from cqr.mtl_run_training import get_lm_loss
+from cqr.quantization import rewrite_records
+from cqr.sampling import sample_next_token, top_p_filtering
+from cqr.torchscript_runtime import TracedRewriter
+from cqr.utils import PRECISIONS, special_tokens_dict, training_autocast
+
+
+def padded_examples(dataset, index):
+    """ (topic number, query number, ids, labels, pred_begin_pos, needs_rewrite) of the examples at index of a
+        TensorizedDataset, with ids and labels as Python lists padded to block_size, as the trainers kept examples
+        before TensorizedDataset
+    """
+    ids, labels = dataset.gather(np.asarray(index, dtype=np.int64), dataset.block_size)
+    return [(dataset.keys[i][0], dataset.keys[i][1], example_ids, example_labels, int(dataset.pred_begin_pos[i]),
+             int(dataset.needs_rewrite[i]))
+            for i, example_ids, example_labels in zip(index, ids.tolist(), labels.tolist())]
+
+
+def list_collate(batch_dataset):
+    # per-example list building, as the trainers batched before TensorizedDataset
+    return_tuple = [[], [], [], [], [], []]
+    for topic_number, query_number, ids, labels, pred_begin_pos, needs_rewrite in batch_dataset:
+        return_tuple[0].append(topic_number)
+        return_tuple[1].append(query_number)
+        return_tuple[2].append(ids)
+        return_tuple[3].append(labels)
+        return_tuple[4].append(pred_begin_pos)
+        return_tuple[5].append(needs_rewrite)
+    return_tuple[2] = torch.tensor(return_tuple[2])
+    return_tuple[3] = torch.tensor(return_tuple[3])
+    return tuple(return_tuple)
+
+
+def time_batches(make_batch, batches):
+    start = time.perf_counter()
+    for batch in batches:
+        make_batch(batch)
+    return (time.perf_counter() - start) / len(batches) * 1000
+
+
+def bench_collate(args):
+    tokenizer = GPT2Tokenizer.from_pretrained(args.model_name_or_path)
+    tokenizer.add_special_tokens(special_tokens_dict)
+    tensors = load_dataset([args.train_file], tokenizer, args)
+    batches = list(BatchSampler(RandomSampler(tensors), args.batch_size, drop_last=True))[:args.num_batches]
+    indices = sorted({i for batch in batches for i in batch})
+    examples = dict(zip(indices, padded_examples(tensors, indices)))
+
+    list_ms = time_batches(lambda batch: list_collate([examples[i] for i in batch]), batches)
+    tensor_ms = time_batches(lambda batch: tensors[batch], batches)
+    print("collate, batch size %d, %d batches" % (args.batch_size, len(batches)))
+    print("  list collate:  %.3f ms/batch" % list_ms)
+    print("  tensor gather: %.3f ms/batch (%.1fx)" % (tensor_ms, list_ms / tensor_ms))
+
+
+def sort_sample(next_token_logits, temperature, top_p):
+    # sampling as InferenceModel did before cqr.sampling: the vocabulary is sorted on every step, even for greedy
+    next_token_logits = next_token_logits / (temperature if temperature > 0 else 1.)
+    filtered_logits = top_p_filtering(next_token_logits, top_p=top_p)
+    if temperature == 0:
+        return torch.argmax(filtered_logits, dim=-1).unsqueeze(-1)
+    return torch.multinomial(F.softmax(filtered_logits, dim=-1), num_samples=1)
+
+
+def bench_sampling(args):
+    print("next token sampling, vocabulary %d, top_p %.2f, logits ~ N(0, %.1f^2)" % (
+        args.vocab_size, args.top_p, args.logit_scale))
+    for batch_size in args.batch_sizes:
+        logits = torch.randn(batch_size, args.vocab_size) * args.logit_scale
+        for temperature in [0.0, 1.0]:
+            sort_ms = time_batches(lambda _: sort_sample(logits.clone(), temperature, args.top_p), range(args.num_steps))
+            new_ms = time_batches(lambda _: sample_next_token(logits, temperature, args.top_p), range(args.num_steps))
+            print("  batch size %2d, %-7s sort: %7.3f ms/step, cqr.sampling: %7.3f ms/step (%.1fx)" % (
+                batch_size, "greedy" if temperature == 0 else "top-p", sort_ms, new_ms, sort_ms / new_ms))
+
+
+def bench_decode(args):
+    with open(args.input_file) as fin:
+        records = [json.loads(line) for line in fin][:args.num_records]
+    generation = {'length': args.length, 'temperature': 0.0, 'top_p': args.top_p, 'rewrite_threshold': 0.0}
+    eager = InferenceModel(argparse.Namespace(model_path=args.model_path, mtl=args.mtl, device=torch.device('cpu'),
+                                              toy_data=False, **generation))
+    traced = TracedRewriter(args.traced_dir, **generation)
+    results = {}
+    for name, model in [('eager', eager), ('traced', traced)]:
+        # the first runs of a traced graph profile and optimize it
+        rewrite_records(model, records[:args.warmup])
+        results[name] = rewrite_records(model, records)
+    (eager_predictions, eager_ms), (traced_predictions, traced_ms) = results['eager'], results['traced']
+    print("greedy decoding on CPU, %d records, %d threads" % (len(records), torch.get_num_threads()))
+    print("  eager:  %.3f ms/token" % eager_ms)
+    print("  traced: %.3f ms/token (%.2fx)" % (traced_ms, eager_ms / traced_ms))
+    print("  same rewrites: %d/%d" % (sum(a == b for a, b in zip(eager_predictions, traced_predictions)), len(records)))
+
+
+def saved_activation_bytes(model, step):
+    """ Run step() and count the bytes of the tensors autograd keeps for its backward pass, each storage once.
+        The model parameters are resident anyway and are left out; the bf16 copies autocast makes of them are not.
+    """
+    parameters = {parameter.untyped_storage().data_ptr() for parameter in model.parameters()}
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in parameters:
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = step()
+    return loss, sum(storages.values())
+
+
+def bench_precision(args):
+    device = torch.device(args.device)
+    model_class = GPT2DoubleHeadsTargetModel if args.mtl else GPT2LMHeadTargetModel
+    model = model_class.from_pretrained(args.model_path).to(device)
+    model.train()
+
+    def loss_step(batch_size):
+        # the losses of run_training.py and mtl_run_training.py on a random batch
+        input_ids = torch.randint(model.config.vocab_size, (batch_size, args.block_size), device=device)
+        if args.mtl:
+            mc_token_ids = torch.full((batch_size,), args.block_size - 1, dtype=torch.long, device=device)
+            mc_labels = torch.arange(batch_size, device=device) % 2  # half of the rows need a rewrite
+            outputs = model(input_ids=input_ids, mc_labels=mc_labels, mc_token_ids=mc_token_ids)
+            return outputs[0] + 50 * get_lm_loss(outputs[1], input_ids, mc_labels)
+        return model(input_ids, labels=input_ids)[0]
+
+    print("training step on %s, batch %d x %d, %d steps" % (device, args.batch_size, args.block_size, args.num_steps))
+    results = {}
+    for precision in PRECISIONS:
+        activation_bytes = []
+        for batch_size in [args.batch_size, 2 * args.batch_size]:
+            with training_autocast(precision, device):
+                loss, saved_bytes = saved_activation_bytes(model, lambda: loss_step(batch_size))
+            loss.backward()
+            model.zero_grad()
+            activation_bytes.append(saved_bytes)
+
+        def train_step(_):
+            with training_autocast(precision, device):
+                loss = loss_step(args.batch_size)
+            loss.backward()
+            model.zero_grad()
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+
+        # per example: what batch_size more examples add, without the bf16 weight copies made once per step
+        results[precision] = (time_batches(train_step, range(args.num_steps)),
+                              (activation_bytes[1] - activation_bytes[0]) / args.batch_size)
+    fp32_ms, fp32_bytes = results['fp32']
+    for precision, (step_ms, example_bytes) in results.items():
+        print("  %-4s %8.1f ms/step (%.2fx), %7.1f MB of activations per example (%.2fx)" % (
+            precision, step_ms, fp32_ms / step_ms, example_bytes / 2 ** 20, example_bytes / fp32_bytes))
+
+
+def bench_target_logits(args):
+    device = torch.device(args.device)
+    model_class = GPT2DoubleHeadsTargetModel if args.mtl else GPT2LMHeadTargetModel
+    model = model_class.from_pretrained(args.model_path).to(device)
+    model.train()
+
+    # a random batch whose rows end with target_length target tokens, as after pred_begin_pos in the datasets
+    def make_batch(batch_size):
+        input_ids = torch.randint(model.config.vocab_size, (batch_size, args.block_size))
+        labels = input_ids.masked_fill(torch.arange(args.block_size) < args.block_size - args.target_length, -1)
+        mc_labels = torch.arange(batch_size) % 2  # half of the rows need a rewrite
+        return input_ids, labels, mc_labels
+
+    def loss_step(batch, mode):
+        # the losses of run_training.py and mtl_run_training.py, with the LM head over the whole block or only at
+        # the targets
+        input_ids, labels, mc_labels = batch
+        inputs = input_ids.to(device)
+        chunk_size = args.chunk_size if mode == 'chunked' else 0
+        if not args.mtl:
+            if mode == 'full':
+                return model(inputs, labels=labels.to(device))[0]
+            target_index, target_labels = [t.to(device) for t in target_positions(labels)]
+            return model(inputs, target_index=target_index, target_labels=target_labels, chunk_size=chunk_size)[0]
+        mc_token_ids = torch.full((len(inputs),), args.block_size - 1, dtype=torch.long, device=device)
+        if mode == 'full':
+            outputs = model(inputs, mc_labels=mc_labels.to(device), mc_token_ids=mc_token_ids)
+            return outputs[0] + 50 * get_lm_loss(outputs[1], labels.to(device), mc_labels.to(device))
+        target_index, target_labels = [t.to(device) for t in target_positions(labels, mc_labels)]
+        mc_loss, lm_loss, _ = model(inputs, mc_labels=mc_labels.to(device), mc_token_ids=mc_token_ids,
+                                    target_index=target_index, target_labels=target_labels, chunk_size=chunk_size)
+        return mc_loss + 50 * lm_loss
+
+    print("training step on %s, batch %d x %d with %d targets per row, %d steps" % (
+        device, args.batch_size, args.block_size, args.target_length, args.num_steps))
+    batches = {batch_size: make_batch(batch_size) for batch_size in [args.batch_size, 2 * args.batch_size]}
+    results = {}
+    for mode in ['full', 'targets', 'chunked']:
+        activation_bytes = []
+        for batch in batches.values():
+            loss, saved_bytes = saved_activation_bytes(model, lambda: loss_step(batch, mode))
+            loss.backward()
+            model.zero_grad()
+            activation_bytes.append(saved_bytes)
+
+        def train_step(_):
+            loss_step(batches[args.batch_size], mode).backward()
+            model.zero_grad()
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+
+        results[mode] = (time_batches(train_step, range(args.num_steps)),
+                         (activation_bytes[1] - activation_bytes[0]) / args.batch_size)
+    full_ms, full_bytes = results['full']
+    for mode, (step_ms, example_bytes) in results.items():
+        print("  %-7s %8.1f ms/step (%.2fx), %7.1f MB of activations per example (%.2fx)" % (
+            mode, step_ms, full_ms / step_ms, example_bytes / 2 ** 20, example_bytes / full_bytes))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    collate_parser = subparsers.add_parser('collate', help="Time producing one training batch")
+    collate_parser.add_argument("--train_file", type=str, required=True)
+    collate_parser.add_argument("--model_name_or_path", default="gpt2-medium", type=str)
+    collate_parser.add_argument("--block_size", default=150, type=int)
+    collate_parser.add_argument("--batch_size", default=8, type=int)
+    collate_parser.add_argument("--num_batches", default=200, type=int)
+    collate_parser.add_argument("--mtl", action='store_true')
+    collate_parser.add_argument("--dynamic_padding", action='store_true')
+    collate_parser.set_defaults(func=bench_collate)
+
+    sampling_parser = subparsers.add_parser('sampling', help="Time choosing the next token of a batch")
+    sampling_parser.add_argument("--batch_sizes", default=[1, 8, 64], type=int, nargs='+')
+    sampling_parser.add_argument("--vocab_size", default=50262, type=int)
+    sampling_parser.add_argument("--top_p", default=0.9, type=float)
+    sampling_parser.add_argument("--logit_scale", default=6.0, type=float,
+                                 help="Standard deviation of the random logits; 6 puts about 10 tokens in the nucleus")
+    sampling_parser.add_argument("--num_steps", default=100, type=int)
+    sampling_parser.set_defaults(func=bench_sampling)
+
+    decode_parser = subparsers.add_parser('decode', help="Time the eager and the traced decode loop per token")
+    decode_parser.add_argument("--model_path", type=str, required=True)
+    decode_parser.add_argument("--traced_dir", type=str, required=True,
+                               help="Export of model_path by cqr/torchscript.py")
+    decode_parser.add_argument("--input_file", type=str, required=True)
+    decode_parser.add_argument("--num_records", default=200, type=int)
+    decode_parser.add_argument("--warmup", default=5, type=int)
+    decode_parser.add_argument("--length", default=20, type=int)
+    decode_parser.add_argument("--top_p", default=0.9, type=float)
+    decode_parser.add_argument("--mtl", action='store_true')
+    decode_parser.set_defaults(func=bench_decode)
+
+    precision_parser = subparsers.add_parser('precision', help="Time a training step and count its activation memory "
+                                                               "in fp32 and under bf16 autocast")
+    precision_parser.add_argument("--model_path", type=str, required=True)
+    precision_parser.add_argument("--mtl", action='store_true')
+    precision_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    precision_parser.add_argument("--batch_size", default=4, type=int)
+    precision_parser.add_argument("--block_size", default=150, type=int)
+    precision_parser.add_argument("--num_steps", default=5, type=int)
+    precision_parser.set_defaults(func=bench_precision)
+
+    target_parser = subparsers.add_parser('target_logits', help="Time a training step and count its activation "
+                                                                "memory with the LM head over the whole block, only "
+                                                                "at the targets, and at the targets in chunks")
+    target_parser.add_argument("--model_path", type=str, required=True)
+    target_parser.add_argument("--mtl", action='store_true')
+    target_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    target_parser.add_argument("--batch_size", default=4, type=int)
+    target_parser.add_argument("--block_size", default=150, type=int)
+    target_parser.add_argument("--target_length", default=15, type=int,
+                               help="Target tokens at the end of every row, i.e. the length of a rewrite")
+    target_parser.add_argument("--chunk_size", default=32, type=int)
+    target_parser.add_argument("--num_steps", default=5, type=int)
+    target_parser.set_defaults(func=bench_target_logits)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
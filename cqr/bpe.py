@@ -0,0 +1,145 @@
+import json
+import os
+
+import regex as re
+
+# A GPT-2 byte-level BPE tokenizer without transformers, for the TorchScript runtime. It reads the files written by
+# GPT2Tokenizer.save_pretrained and encodes and decodes like GPT2Tokenizer in transformers 2.3.0.
+
+
+def bytes_to_unicode():
+    """ Printable unicode character for every byte, as used in the GPT-2 vocabulary """
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2 ** 8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2 ** 8 + n)
+            n += 1
+    return dict(zip(bs, [chr(c) for c in cs]))
+
+
+def clean_up_tokenization(out_string):
+    out_string = out_string.replace(' .', '.').replace(' ?', '?').replace(' !', '!').replace(' ,', ','
+                    ).replace(" ' ", "'").replace(" n't", "n't").replace(" 'm", "'m").replace(" do not", " don't"
+                    ).replace(" 's", "'s").replace(" 've", "'ve").replace(" 're", "'re")
+    return out_string
+
+
+class BPETokenizer:
+
+    def __init__(self, tokenizer_dir):
+        with open(os.path.join(tokenizer_dir, 'vocab.json'), encoding='utf-8') as f:
+            self.encoder = json.load(f)
+        self.decoder = {v: k for k, v in self.encoder.items()}
+        with open(os.path.join(tokenizer_dir, 'merges.txt'), encoding='utf-8') as f:
+            bpe_merges = [tuple(merge.split()) for merge in f.read().split('\n')[1:-1]]
+        self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
+        self.added_tokens_encoder = {}
+        added_tokens_file = os.path.join(tokenizer_dir, 'added_tokens.json')
+        if os.path.exists(added_tokens_file):
+            with open(added_tokens_file, encoding='utf-8') as f:
+                self.added_tokens_encoder = json.load(f)
+        self.added_tokens_decoder = {v: k for k, v in self.added_tokens_encoder.items()}
+        with open(os.path.join(tokenizer_dir, 'special_tokens_map.json'), encoding='utf-8') as f:
+            special_tokens = json.load(f)
+        # same order as PreTrainedTokenizer.all_special_tokens
+        self.all_special_tokens = []
+        for value in special_tokens.values():
+            for token in (value if isinstance(value, (list, tuple)) else [value]):
+                if token not in self.all_special_tokens:
+                    self.all_special_tokens.append(token)
+        self.unk_token = special_tokens.get('unk_token', '<|endoftext|>')
+        self.byte_encoder = bytes_to_unicode()
+        self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
+        self.pat = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
+        self.cache = {}
+
+    def token_to_id(self, token):
+        if token in self.added_tokens_encoder:
+            return self.added_tokens_encoder[token]
+        return self.encoder.get(token, self.encoder.get(self.unk_token))
+
+    def bpe(self, token):
+        if token in self.cache:
+            return self.cache[token]
+        word = tuple(token)
+        while len(word) > 1:
+            pairs = set(zip(word[:-1], word[1:]))
+            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float('inf')))
+            if bigram not in self.bpe_ranks:
+                break
+            first, second = bigram
+            new_word = []
+            i = 0
+            while i < len(word):
+                if i < len(word) - 1 and word[i] == first and word[i + 1] == second:
+                    new_word.append(first + second)
+                    i += 2
+                else:
+                    new_word.append(word[i])
+                    i += 1
+            word = tuple(new_word)
+        self.cache[token] = word
+        return word
+
+    def _tokenize(self, text):
+        bpe_tokens = []
+        for token in re.findall(self.pat, text):
+            bpe_tokens.extend(self.bpe(''.join(self.byte_encoder[b] for b in token.encode('utf-8'))))
+        return bpe_tokens
+
+    def tokenize(self, text):
+        """ Like PreTrainedTokenizer.tokenize: added and special tokens are split off and the text around them
+            is stripped before it is byte-pair encoded
+        """
+        if not text.strip():
+            return []
+        special = set(self.added_tokens_encoder) | set(self.all_special_tokens)
+        text_list = [text]
+        for tok in list(self.added_tokens_encoder) + self.all_special_tokens:
+            tokenized_text = []
+            for sub_text in text_list:
+                if sub_text in special:
+                    tokenized_text.append(sub_text)
+                    continue
+                split_text = sub_text.split(tok)
+                for i, part in enumerate(split_text):
+                    part = part.strip()
+                    if i == 0 and not part:
+                        tokenized_text.append(tok)
+                    elif i == len(split_text) - 1:
+                        if part:
+                            tokenized_text.append(part)
+                    else:
+                        if part:
+                            tokenized_text.append(part)
+                        tokenized_text.append(tok)
+            text_list = tokenized_text
+        tokens = []
+        for sub_text in text_list:
+            tokens.extend([sub_text] if sub_text in special else self._tokenize(sub_text))
+        return tokens
+
+    def encode(self, text):
+        return [self.token_to_id(token) for token in self.tokenize(text)]
+
+    def decode(self, token_ids):
+        """ Like GPT2Tokenizer.decode with clean_up_tokenization_spaces """
+        sub_texts = []
+        current_sub_text = []
+        for index in token_ids:
+            if index in self.added_tokens_decoder:
+                if current_sub_text:
+                    sub_texts.append(self.convert_tokens_to_string(current_sub_text))
+                    current_sub_text = []
+                sub_texts.append(self.added_tokens_decoder[index])
+            else:
+                current_sub_text.append(self.decoder[index])
+        if current_sub_text:
+            sub_texts.append(self.convert_tokens_to_string(current_sub_text))
+        return clean_up_tokenization(' '.join(sub_texts))
+
+    def convert_tokens_to_string(self, tokens):
+        return bytearray([self.byte_decoder[c] for c in ''.join(tokens)]).decode('utf-8', errors='replace')
@@ -0,0 +1,214 @@
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+# torch, transformers and cqr.inference_model are imported where they are used: a process that only
+# loads a bundle should not pay for more than it needs
+
+BUNDLE_FILE = 'bundle.json'
+WEIGHTS_FILE = 'weights.pt'
+
+
+def export_bundle(model_path, output_dir, mtl=False, generation=None, quantize=False):
+    """ Write a self-contained inference bundle for the model in model_path to output_dir:
+        the tokenizer files, the weights as one state dict that can be memory-mapped, and bundle.json with the
+        model config, the special token ids and the generation settings.
+        With quantize the bundle is loaded as an int8 model; the weights are still stored in fp32.
+    """
+    import torch
+    from transformers import GPT2DoubleHeadsModel, GPT2LMHeadModel, GPT2Tokenizer
+    from cqr.utils import special_tokens_dict
+
+    model_class = GPT2DoubleHeadsModel if mtl else GPT2LMHeadModel
+    tokenizer = GPT2Tokenizer.from_pretrained(model_path)
+    tokenizer.add_special_tokens(special_tokens_dict)
+    model = model_class.from_pretrained(model_path)
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer.save_pretrained(output_dir)
+    torch.save(model.state_dict(), os.path.join(output_dir, WEIGHTS_FILE))
+    bundle = {
+        'model_class': model_class.__name__,
+        'config': model.config.to_dict(),
+        'special_token_ids': {name: tokenizer.convert_tokens_to_ids(token) for name, token in special_tokens_dict.items()},
+        'generation': generation or {},
+        'quantize': quantize,
+    }
+    with open(os.path.join(output_dir, BUNDLE_FILE), 'w') as f:
+        json.dump(bundle, f, indent=2)
+
+
+@contextlib.contextmanager
+def skip_weight_init():
+    """ Build models without initialising their weights, for when every weight is loaded right after.
+        (Building on the meta device would also skip it, but its first use imports torch's reference ops,
+        which costs more than initialising the weights.)
+    """
+    import torch
+    from transformers.modeling_utils import PreTrainedModel
+
+    def skip(tensor, *args, **kwargs):
+        return tensor
+
+    patched = [(torch.nn.init, name, skip) for name in ['normal_', 'uniform_', 'kaiming_uniform_']]
+    patched.append((PreTrainedModel, 'init_weights', lambda self: self.tie_weights()))
+    originals = [(owner, name, getattr(owner, name)) for owner, name, _ in patched]
+    try:
+        for owner, name, replacement in patched:
+            setattr(owner, name, replacement)
+        yield
+    finally:
+        for owner, name, original in originals:
+            setattr(owner, name, original)
+
+
+def load_bundle(bundle_dir, device='cpu', quantize=None, **generation):
+    """ InferenceModel for a bundle written by export_bundle; keyword arguments override its generation settings.
+        The model is built without initialising weights and its parameters are the memory-mapped tensors of the
+        bundle, so loading does not read or copy the weights up front. quantize overrides the bundle's choice.
+    """
+    import torch
+    import transformers
+    from cqr.inference_model import InferenceModel
+    from cqr.utils import special_tokens_dict
+
+    with open(os.path.join(bundle_dir, BUNDLE_FILE)) as f:
+        bundle = json.load(f)
+    tokenizer = transformers.GPT2Tokenizer.from_pretrained(bundle_dir)
+    tokenizer.add_special_tokens(special_tokens_dict)
+    for name, token in special_tokens_dict.items():
+        if tokenizer.convert_tokens_to_ids(token) != bundle['special_token_ids'][name]:
+            raise ValueError("Special token {} of {} does not have the id it was exported with".format(token, bundle_dir))
+
+    config = transformers.GPT2Config.from_dict(bundle['config'])
+    with skip_weight_init():
+        model = getattr(transformers, bundle['model_class'])(config)
+    state_dict = torch.load(os.path.join(bundle_dir, WEIGHTS_FILE), map_location='cpu', mmap=True, weights_only=True)
+    model.load_state_dict(state_dict, assign=True)
+    model.tie_weights()
+    if bundle.get('quantize', False) if quantize is None else quantize:
+        if device != 'cpu':
+            raise ValueError("Quantized models run on CPU only")
+        from cqr.quantization import quantize_model
+        model = quantize_model(model, inplace=True)
+
+    settings = {'length': 20, 'temperature': 0.0, 'top_p': 0.9, 'rewrite_threshold': 0.0}
+    settings.update(bundle['generation'])
+    settings.update(generation)
+    args = argparse.Namespace(mtl=bundle['model_class'] == 'GPT2DoubleHeadsModel', device=torch.device(device),
+                              toy_data=False, **settings)
+    return InferenceModel(args, {'model': model, 'tokenizer': tokenizer})
+
+
+def load_from_model_path(model_path, mtl=False, device='cpu'):
+    import torch
+    from cqr.inference_model import InferenceModel
+    args = argparse.Namespace(model_path=model_path, mtl=mtl, device=torch.device(device), toy_data=False,
+                              length=20, temperature=0.0, top_p=0.9)
+    return InferenceModel(args)
+
+
+def rewrite(args):
+    import torch
+    device = 'cuda' if torch.cuda.is_available() and not args.no_cuda else 'cpu'
+    # stdout only carries rewrites
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.bundle_dir:
+            inference_model = load_bundle(args.bundle_dir, device)
+        else:
+            inference_model = load_from_model_path(args.model_path, args.mtl, device)
+    with open(args.input_file) as fin:
+        for line in fin:
+            print(json.dumps({'output': inference_model.predict(json.loads(line)['input'])}), flush=True)
+
+
+def time_first_rewrite(command, input_file):
+    """ Seconds from starting command in a new process until it prints its first rewrite """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'cqr.bundle', 'rewrite', '--input_file', input_file] + command,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    first_line = process.stdout.readline()
+    seconds = time.perf_counter() - start
+    process.kill()
+    process.wait()
+    if not first_line:
+        raise RuntimeError("{} printed no rewrite".format(' '.join(command)))
+    return seconds
+
+
+def coldstart(args):
+    # only the first record is rewritten
+    with open(args.input_file) as fin:
+        first_record = fin.readline()
+    input_file = args.input_file + '.first'
+    with open(input_file, 'w') as fout:
+        fout.write(first_record)
+    device_flags = ['--no_cuda'] if args.no_cuda else []
+    runs = []
+    if args.bundle_dir:
+        runs.append(('bundle', ['--bundle_dir', args.bundle_dir] + device_flags))
+    if args.model_path:
+        runs.append(('from_pretrained', ['--model_path', args.model_path] + (['--mtl'] if args.mtl else []) + device_flags))
+    try:
+        for name, command in runs:
+            seconds = [time_first_rewrite(command, input_file) for _ in range(args.repeat)]
+            print("%-16s cold start to first rewrite: best %.2fs, mean %.2fs over %d runs" % (
+                name, min(seconds), sum(seconds) / len(seconds), len(seconds)))
+    finally:
+        os.remove(input_file)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    export_parser = subparsers.add_parser('export', help="Write an inference bundle")
+    export_parser.add_argument("--model_path", type=str, required=True)
+    export_parser.add_argument("--output_dir", type=str, required=True)
+    export_parser.add_argument('--mtl', action='store_true')
+    export_parser.add_argument("--length", type=int, default=20,
+                               help="Maximum length of output sequence")
+    export_parser.add_argument("--temperature", type=float, default=0.0,
+                               help="temperature of 0 implies greedy sampling")
+    export_parser.add_argument("--top_p", type=float, default=0.9)
+    export_parser.add_argument("--quantize", action='store_true',
+                               help="Load the bundle as an int8 dynamically quantized model (CPU only)")
+    export_parser.add_argument("--rewrite_threshold", type=float, default=0.0,
+                               help="MTL only: return the last utterance unchanged when the classifier's "
+                                    "needs_rewrite probability is below this threshold, 0 always decodes")
+    export_parser.add_argument("--stop_sequences", type=str, nargs='*', default=[],
+                               help="Also stop decoding at any of these strings (they are left out of the rewrite)")
+    export_parser.add_argument("--sync_every", type=int, default=0,
+                               help="Decode steps between checks for finished rewrites, 0 for 1 on CPU and 8 on GPU")
+
+    rewrite_parser = subparsers.add_parser('rewrite', help="Print the rewrite of every record of a json lines file")
+    coldstart_parser = subparsers.add_parser('coldstart', help="Time starting a process up to its first rewrite")
+    for subparser in [rewrite_parser, coldstart_parser]:
+        subparser.add_argument("--bundle_dir", type=str, default=None)
+        subparser.add_argument("--model_path", type=str, default=None,
+                               help="Model loaded with from_pretrained (instead of, or for coldstart also, the bundle)")
+        subparser.add_argument('--mtl', action='store_true',
+                               help="With --model_path: the model is a MTL model")
+        subparser.add_argument("--input_file", type=str, required=True)
+        subparser.add_argument("--no_cuda", action='store_true')
+    coldstart_parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        generation = {'length': args.length, 'temperature': args.temperature, 'top_p': args.top_p,
+                      'rewrite_threshold': args.rewrite_threshold, 'stop_sequences': args.stop_sequences,
+                      'sync_every': args.sync_every}
+        export_bundle(args.model_path, args.output_dir, args.mtl, generation, args.quantize)
+    elif args.command == 'rewrite':
+        rewrite(args)
+    else:
+        coldstart(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,90 +1,324 @@
 
+import hashlib
 import json
+import multiprocessing
+import os
+import shutil
+import random
 import numpy as np
-from torch.utils.data import Dataset
-
-class ConvSearchExample:
-    def __init__(self, topic_number, query_number,\
-         ids, labels, pred_begin_pos,needs_rewrite=None):
-        self.topic_number = topic_number
-        self.query_number = query_number
-        self.ids = ids
-        self.labels = labels
-        self.pred_begin_pos = pred_begin_pos
-        self.needs_rewrite = needs_rewrite
-    
-    def __repr__(self):
-        print('===ConvSearchExample===')
-        print(self.topic_number + '_' + self.query_number)
-        print('-----------------------')
-        print(self.ids)
-        print('-----------------------')
-        print(self.labels)
-        print('-----------------------')
-        print(self.pred_begin_pos)
-        print('=======================')
-
-
-class QueryRewriteDataset(Dataset):
-    def __init__(self, filenames, tokenizer, args, debugging=False):
-        self.examples = []
-        self.debugging = debugging
-        if self.debugging:
-            print(f"in dataset class, cls is {tokenizer.cls_token_id}")
-        for filename in filenames:
-            with open(filename, encoding="utf-8") as f:
-                for line in f:
-                    record = json.loads(line)
-                    input_sents = record['input']
-                    target_sent = record['target']
-                    topic_number = record['topic_number']
-                    query_number = record['query_number']
-                    if args.mtl:
-                        needs_rewrite = record['needs_rewrite']
-                    this_example = []
-                    this_example_labels = []
-
-                    for sent in input_sents:
-                        this_example.extend(tokenizer.convert_tokens_to_ids(\
-                                            tokenizer.tokenize(sent)))
-                        this_example.append(tokenizer.sep_token_id)
-                    this_example.pop()
-                    if args.mtl:
-                        this_example.append(tokenizer.cls_token_id)
-                    this_example.append(tokenizer.bos_token_id) #teacher forcing starts from here
-
-                    begin_pos = len(this_example)
-                    this_example_labels.extend([-1] * begin_pos)
-                    this_example.extend(tokenizer.convert_tokens_to_ids(\
-                                        tokenizer.tokenize(target_sent)))
-                    this_example_labels.extend(tokenizer.convert_tokens_to_ids(\
-                                                tokenizer.tokenize(target_sent)))
-
-                    this_example.append(tokenizer.eos_token_id)
-                    this_example_labels.append(tokenizer.eos_token_id)
-
-                    if len(this_example) > args.block_size:
-                        this_example = this_example[:args.block_size]
-                        if args.mtl and tokenizer.cls_token_id not in this_example:
-                            this_example.pop()
-                            this_example.append(tokenizer.cls_token_id)
-                        this_example_labels = this_example_labels[:args.block_size]
-
-                    else:
-                        pad_num = args.block_size - len(this_example)
-                        this_example.extend([tokenizer.pad_token_id] * pad_num)
-                        this_example_labels.extend([-1] * pad_num)
-                    assert len(this_example) == args.block_size, print(f"{len(this_example)} {args.block_size}")
-                    assert len(this_example_labels) == args.block_size
-                    self.examples.append(ConvSearchExample(topic_number, query_number,\
-                         this_example, this_example_labels, begin_pos, needs_rewrite))
-
-        if self.debugging:
-            self.examples = np.random.choice(self.examples, 100, replace=False)
+import torch
+from torch.utils.data import BatchSampler, DataLoader, Dataset, DistributedSampler, RandomSampler, Sampler
+from cqr.utils import tokenizer_hash
+
+
+_worker_tokenizer = None
+
+
+def _init_tokenize_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_chunk(sentences):
+    return [_worker_tokenizer.convert_tokens_to_ids(_worker_tokenizer.tokenize(sent)) for sent in sentences]
+
+
+def tokenize_sentences(sentences, tokenizer, num_workers=1, chunk_size=1000, token_cache=None):
+    """ Map every distinct sentence to its token ids, tokenizing each one once.
+        With num_workers > 1 the distinct sentences are split into chunks tokenized by a process pool;
+        chunks come back in order, so the result does not depend on the number of workers.
+        Sentences found in token_cache (a SentenceTokenCache) are not tokenized again, and new ones are added to it.
+    """
+    token_ids = {}
+    unique_sents = []
+    for sent in dict.fromkeys(sentences):
+        ids = token_cache.get(sent) if token_cache is not None else None
+        if ids is None:
+            unique_sents.append(sent)
+        else:
+            token_ids[sent] = ids
+    if num_workers > 1 and len(unique_sents) > chunk_size:
+        chunks = [unique_sents[i:i + chunk_size] for i in range(0, len(unique_sents), chunk_size)]
+        with multiprocessing.Pool(num_workers, initializer=_init_tokenize_worker, initargs=(tokenizer,)) as pool:
+            all_ids = [ids for chunk_ids in pool.map(_tokenize_chunk, chunks) for ids in chunk_ids]
+    else:
+        all_ids = [tokenizer.convert_tokens_to_ids(tokenizer.tokenize(sent)) for sent in unique_sents]
+    for sent, ids in zip(unique_sents, all_ids):
+        token_ids[sent] = ids
+        if token_cache is not None:
+            token_cache.put(sent, ids)
+    return token_ids
+
+
+def read_records(filenames, tokenizer, args, token_cache=None):
+    """ Records of all files, and the token ids of all their sentences (see tokenize_sentences) """
+    records = []
+    for filename in filenames:
+        with open(filename, encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f)
+    sentences = (sent for record in records for sent in record['input'] + [record['target']])
+    token_ids = tokenize_sentences(sentences, tokenizer, getattr(args, 'tokenize_workers', 1), token_cache=token_cache)
+    return records, token_ids
+
+
+def encode_record(record, tokenizer, args, token_ids=None):
+    """ Tokenize one record into (ids, labels, pred_begin_pos, needs_rewrite), truncated to args.block_size but not padded.
+        token_ids maps sentences to their ids when they were tokenized beforehand.
+    """
+    mtl = getattr(args, 'mtl', False)
+    input_sents = record['input']
+    target_sent = record['target']
+    needs_rewrite = record['needs_rewrite'] if mtl else None
+    if token_ids is None:
+        token_ids = tokenize_sentences(input_sents + [target_sent], tokenizer)
+    this_example = []
+    this_example_labels = []
+
+    for sent in input_sents:
+        this_example.extend(token_ids[sent])
+        this_example.append(tokenizer.sep_token_id)
+    this_example.pop()
+    if mtl:
+        this_example.append(tokenizer.cls_token_id)
+    this_example.append(tokenizer.bos_token_id) #teacher forcing starts from here
+
+    begin_pos = len(this_example)
+    this_example_labels.extend([-1] * begin_pos)
+    this_example.extend(token_ids[target_sent])
+    this_example_labels.extend(token_ids[target_sent])
+
+    this_example.append(tokenizer.eos_token_id)
+    this_example_labels.append(tokenizer.eos_token_id)
+
+    if len(this_example) > args.block_size:
+        this_example = this_example[:args.block_size]
+        if mtl and tokenizer.cls_token_id not in this_example:
+            this_example.pop()
+            this_example.append(tokenizer.cls_token_id)
+        this_example_labels = this_example_labels[:args.block_size]
+    return this_example, this_example_labels, begin_pos, needs_rewrite
+
+
+PART_ARRAYS = ['ids', 'labels', 'offsets', 'pred_begin_pos', 'needs_rewrite']
+
+
+def pretokenized_path(filename, tokenizer, args):
+    """ Cache directory for filename, keyed by the file content, the tokenizer, the block size and the MTL setting """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    sha.update(tokenizer_hash(tokenizer).encode('utf-8'))
+    sha.update(('%d-%d' % (args.block_size, getattr(args, 'mtl', False))).encode('utf-8'))
+    return os.path.join(args.pretokenized_dir, '%s.%s' % (os.path.basename(filename), sha.hexdigest()[:16]))
+
+
+def encode_records(records, tokenizer, args, token_ids):
+    """ The examples of records as flat int32 ids/labels with an offsets index (example i is
+        ids[offsets[i]:offsets[i + 1]], not padded), plus per-example arrays and (topic, query) keys.
+        This is the layout of the files written by write_pretokenized.
+    """
+    ids, labels, offsets, begin_pos, needs_rewrite, keys = [], [], [0], [], [], []
+    for record in records:
+        example_ids, example_labels, example_begin_pos, example_needs_rewrite = encode_record(record, tokenizer, args,
+                                                                                              token_ids)
+        ids.extend(example_ids)
+        labels.extend(example_labels)
+        offsets.append(len(ids))
+        begin_pos.append(example_begin_pos)
+        needs_rewrite.append(-1 if example_needs_rewrite is None else example_needs_rewrite)
+        keys.append([record['topic_number'], record['query_number']])
+    return {'ids': np.asarray(ids, dtype=np.int32), 'labels': np.asarray(labels, dtype=np.int32),
+            'offsets': np.asarray(offsets, dtype=np.int64), 'pred_begin_pos': np.asarray(begin_pos, dtype=np.int32),
+            'needs_rewrite': np.asarray(needs_rewrite, dtype=np.int32), 'keys': keys}
+
+
+def write_pretokenized(filename, output_path, tokenizer, args, token_cache=None):
+    """ Store the examples of filename as flat int32 ids/labels with an offsets index, plus per-example arrays """
+    records, token_ids = read_records([filename], tokenizer, args, token_cache)
+    part = encode_records(records, tokenizer, args, token_ids)
+
+    tmp_path = output_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name in PART_ARRAYS:
+        np.save(os.path.join(tmp_path, name + '.npy'), part[name])
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'source': os.path.abspath(filename), 'block_size': args.block_size,
+                   'pad_token_id': tokenizer.pad_token_id, 'keys': part['keys']}, f)
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.replace(tmp_path, output_path)
+
+
+def load_pretokenized(path):
+    """ The examples written by write_pretokenized, with the arrays memory-mapped (see encode_records) """
+    part = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in PART_ARRAYS}
+    with open(os.path.join(path, 'meta.json')) as f:
+        part['keys'] = json.load(f)['keys']
+    return part
+
+
+def pretokenize_files(filenames, tokenizer, args, token_cache=None):
+    """ Cache directories of filenames under args.pretokenized_dir, converting files without an up-to-date one """
+    paths = []
+    for filename in filenames:
+        path = pretokenized_path(filename, tokenizer, args)
+        if not os.path.exists(path):
+            write_pretokenized(filename, path, tokenizer, args, token_cache)
+        paths.append(path)
+    return paths
+
+
+def part_starts(parts):
+    """ Index of the first example of every part in the concatenation of parts, and the number of examples """
+    starts = np.cumsum([0] + [len(part['pred_begin_pos']) for part in parts])
+    return starts[:-1], int(starts[-1])
+
+
+class BucketBatchSampler(Sampler):
+    """ Batches of examples of similar length, for use with dynamic padding.
+        Shuffled indices are cut into pools of bucket_size batches, each pool is sorted by length
+        and split into batches, and the batches are shuffled again.
+        With num_replicas > 1, every process shuffles the same way, from seed and the epoch (see set_epoch),
+        and takes every num_replicas-th batch from rank on, repeating batches so that all get as many.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=50, drop_last=False, num_replicas=1, rank=0, seed=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch) if self.num_replicas > 1 else random
+        indices = list(range(len(self.lengths)))
+        rng.shuffle(indices)
+        pool_size = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = sorted(indices[start:start + pool_size], key=lambda i: self.lengths[i])
+            batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        rng.shuffle(batches)
+        if self.num_replicas > 1:
+            while len(batches) < len(self) * self.num_replicas:
+                batches += batches[:len(self) * self.num_replicas - len(batches)]
+            batches = batches[self.rank::self.num_replicas]
+        return iter(batches)
 
     def __len__(self):
-        return len(self.examples)
+        if self.drop_last:
+            num_batches = len(self.lengths) // self.batch_size
+        else:
+            num_batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        return (num_batches + self.num_replicas - 1) // self.num_replicas
+
+
+class TensorizedDataset(Dataset):
+    """ The examples of parts (see encode_records), gathered a whole batch at a time.
+        The token arrays stay flat and unpadded, memory-mapped for pretokenized files; a batch slices its examples
+        out of them by offsets and pads them to block_size, or to its longest example with dynamic_padding.
+        Indexed with a list of example indices (use it with a batch sampler and batch_size=None in the DataLoader),
+        it returns (topic numbers, query numbers, ids, labels, pred_begin_pos, attention_mask)
+        or, for MTL, (topic numbers, query numbers, ids, labels, pred_begin_pos, needs_rewrite, attention_mask, cls positions).
+    """
+
+    def __init__(self, parts, tokenizer, args, debugging=False):
+        self.mtl = getattr(args, 'mtl', False)
+        self.dynamic_padding = getattr(args, 'dynamic_padding', False)
+        self.block_size = args.block_size
+        self.pad_token_id = tokenizer.pad_token_id
+        self.cls_token_id = tokenizer.cls_token_id
+        self.parts = parts
+        self.starts, num_examples = part_starts(parts)
+        # example -> (part, row in the part), and the per-example arrays of all parts
+        rows = np.random.choice(num_examples, 100, replace=False) if debugging else np.arange(num_examples)
+        self.part_index = np.searchsorted(self.starts, rows, side='right') - 1
+        self.part_rows = rows - self.starts[self.part_index]
+        offsets = np.concatenate([part['offsets'][:-1] for part in parts])
+        self.offsets = offsets[rows]
+        self.lengths = torch.from_numpy(np.concatenate([np.diff(part['offsets']) for part in parts])[rows])
+        self.pred_begin_pos = torch.from_numpy(
+            np.concatenate([part['pred_begin_pos'] for part in parts])[rows].astype(np.int64))
+        self.needs_rewrite = torch.from_numpy(
+            np.concatenate([part['needs_rewrite'] for part in parts])[rows].astype(np.int64))
+        keys = [key for part in parts for key in part['keys']]
+        self.keys = [keys[row] for row in rows] if debugging else keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def gather(self, index, max_length):
+        """ Padded [batch, max_length] ids and labels of the examples at index """
+        ids = np.full((len(index), max_length), self.pad_token_id, dtype=np.int64)
+        labels = np.full((len(index), max_length), -1, dtype=np.int64)
+        positions = np.arange(max_length)
+        for p in np.unique(self.part_index[index]):
+            in_part = self.part_index[index] == p
+            # positions past an example's end read its neighbours, and are padded below
+            token_index = np.minimum(self.offsets[index][in_part, None] + positions,
+                                     len(self.parts[p]['ids']) - 1)
+            is_token = positions < self.lengths.numpy()[index][in_part, None]
+            ids[in_part] = np.where(is_token, self.parts[p]['ids'][token_index], self.pad_token_id)
+            labels[in_part] = np.where(is_token, self.parts[p]['labels'][token_index], -1)
+        return torch.from_numpy(ids), torch.from_numpy(labels)
+
+    def __getitem__(self, index):
+        index = np.asarray(index, dtype=np.int64)
+        lengths = self.lengths[index]
+        max_length = int(lengths.max()) if self.dynamic_padding else self.block_size
+        ids, labels = self.gather(index, max_length)
+        attention_mask = (torch.arange(max_length).unsqueeze(0) < lengths.unsqueeze(1)).long()
+        topic_numbers = [self.keys[i][0] for i in index.tolist()]
+        query_numbers = [self.keys[i][1] for i in index.tolist()]
+        if self.mtl:
+            cls_positions = (ids == self.cls_token_id).int().argmax(dim=1)
+            return (topic_numbers, query_numbers, ids, labels, self.pred_begin_pos[index], self.needs_rewrite[index],
+                    attention_mask, cls_positions)
+        return topic_numbers, query_numbers, ids, labels, self.pred_begin_pos[index], attention_mask
+
+
+def load_dataset(filenames, tokenizer, args, debugging=False, token_cache=None):
+    """ TensorizedDataset of filenames, memory-mapping their pretokenized files when args.pretokenized_dir is set """
+    if getattr(args, 'pretokenized_dir', None):
+        parts = [load_pretokenized(path) for path in pretokenize_files(filenames, tokenizer, args, token_cache)]
+    else:
+        records, token_ids = read_records(filenames, tokenizer, args, token_cache)
+        parts = [encode_records(records, tokenizer, args, token_ids)]
+    return TensorizedDataset(parts, tokenizer, args, debugging=debugging)
+
+
+def build_dataloader(dataset, args, batch_size, distributed=False):
+    """ Shuffled batches of dataset. With distributed, every process of the group gets its own share of the
+        batches, reshuffled every epoch by set_sampler_epoch.
+    """
+    num_replicas, rank = 1, 0
+    if distributed and torch.distributed.is_initialized():
+        num_replicas, rank = torch.distributed.get_world_size(), torch.distributed.get_rank()
+    if getattr(args, 'dynamic_padding', False):
+        batch_sampler = BucketBatchSampler(dataset.lengths.tolist(), batch_size, num_replicas=num_replicas,
+                                           rank=rank, seed=args.seed)
+    elif num_replicas > 1:
+        batch_sampler = BatchSampler(DistributedSampler(dataset, num_replicas, rank, seed=args.seed), batch_size,
+                                     drop_last=False)
+    else:
+        batch_sampler = BatchSampler(RandomSampler(dataset), batch_size, drop_last=False)
+    # TensorizedDataset gathers whole batches, so the DataLoader neither batches nor collates
+    return DataLoader(dataset, sampler=batch_sampler, batch_size=None, num_workers=getattr(args, 'num_workers', 0),
+                      pin_memory=args.device.type == 'cuda')
 
-    def __getitem__(self, item):
-        return self.examples[item]
 
+def set_sampler_epoch(dataloader, epoch):
+    """ Reshuffle the batches of a distributed dataloader for epoch """
+    batch_sampler = dataloader.sampler
+    sampler = getattr(batch_sampler, 'sampler', batch_sampler)
+    if hasattr(sampler, 'set_epoch'):
+        sampler.set_epoch(epoch)
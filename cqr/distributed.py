@@ -0,0 +1,79 @@
+import contextlib
+import logging
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+logger = logging.getLogger(__name__)
+
+
+def setup_distributed(args):
+    """ Join the process group when launched by torchrun (or torch.distributed.launch with --local_rank): one
+        process per GPU with NCCL, or per CPU worker with gloo. Sets args.device and args.n_gpu for this process
+        and returns whether training is distributed.
+    """
+    args.local_rank = int(os.environ.get('LOCAL_RANK', args.local_rank))
+    if args.local_rank == -1:
+        return False
+    if torch.cuda.is_available() and not args.no_cuda:
+        torch.cuda.set_device(args.local_rank)
+        args.device = torch.device('cuda', args.local_rank)
+        args.n_gpu = 1
+    else:
+        args.device = torch.device('cpu')
+        args.n_gpu = 0
+    dist.init_process_group(backend=args.ddp_backend or ('nccl' if args.device.type == 'cuda' else 'gloo'))
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """ Whether this process logs and saves checkpoints: global rank 0, or the only process """
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+@contextlib.contextmanager
+def local_main_first(args):
+    """ Run the block in the first process of every node before the others, e.g. so that it downloads the model
+        or writes the pretokenized files that the others then only read.
+    """
+    local_rank = args.local_rank if is_distributed() else -1
+    if local_rank > 0:
+        dist.barrier()
+    yield
+    if local_rank == 0:
+        dist.barrier()
+
+
+def wrap_model(model, args):
+    if not is_distributed():
+        return model
+    device_ids = [args.device.index] if args.device.type == 'cuda' else None
+    return DistributedDataParallel(model, device_ids=device_ids, output_device=device_ids and device_ids[0])
+
+
+def unwrap_model(model):
+    return model.module if hasattr(model, 'module') else model
+
+
+def gradient_sync(model, sync):
+    """ Context for the forward and backward pass of a batch: without sync, DDP keeps the gradients local, so
+        gradient accumulation only all-reduces on the last batch of every update.
+    """
+    if sync or not isinstance(model, DistributedDataParallel):
+        return contextlib.nullcontext()
+    return model.no_sync()
@@ -0,0 +1,102 @@
+import contextlib
+import copy
+import logging
+import multiprocessing
+import shutil
+import tempfile
+
+import torch
+from transformers import GPT2Tokenizer
+
+from cqr.dataset import pretokenize_files
+from cqr.distributed import is_main_process
+from cqr.token_cache import build_token_cache, save_token_cache, save_token_cache_states, shared_token_cache_state
+from cqr.utils import NUM_FOLD, set_seed, special_tokens_dict
+
+logger = logging.getLogger(__name__)
+
+
+def _init_fold_worker(devices, num_threads, log_file):
+    global _worker_device
+    _worker_device = devices.get()
+    torch.set_num_threads(num_threads)
+    logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt = '%m/%d/%Y %H:%M:%S',
+                        level = logging.INFO,
+                        filename=log_file)
+
+
+def _run_fold(task):
+    fold_fn, args, i = task
+    args = copy.copy(args)
+    args.device = _worker_device
+    # a worker owns a single device, so the fold runs without DataParallel
+    args.n_gpu = 1 if _worker_device.type == 'cuda' else 0
+    set_seed(args)
+    logger.info("Fold #%d on %s", i, args.device)
+    # the parent saves the token caches of all workers together
+    return fold_fn(args, i), shared_token_cache_state()
+
+
+def run_folds(fold_fn, args, num_folds=NUM_FOLD):
+    """ Run fold_fn(args, i) for every fold and return the results in fold order.
+        With args.fold_workers > 1 the folds run in a pool of spawned processes: one per GPU on CUDA
+        (at most as many as there are devices), otherwise args.fold_workers CPU workers sharing the
+        intra-op threads. fold_fn must be importable, and the folds must not write to the same files.
+        The folds share the token cache of their process (see shared_token_cache), which is saved to
+        args.token_cache_file once all folds are done, merged over the workers.
+    """
+    num_workers = min(getattr(args, 'fold_workers', 1), num_folds)
+    if num_workers <= 1:
+        results = [fold_fn(args, i) for i in range(num_folds)]
+        if is_main_process():
+            save_token_cache_states([shared_token_cache_state()], args)
+        return results
+
+    if args.device.type == 'cuda':
+        devices = [torch.device('cuda', k) for k in range(torch.cuda.device_count())]
+        num_workers = min(num_workers, len(devices))
+    else:
+        devices = [args.device] * num_workers
+    context = multiprocessing.get_context('spawn')  # CUDA cannot be used in forked processes
+    device_queue = context.Queue()
+    for device in devices[:num_workers]:
+        device_queue.put(device)
+    num_threads = max(1, torch.get_num_threads() // num_workers)
+    log_file = next((handler.baseFilename for handler in logging.getLogger().handlers
+                     if isinstance(handler, logging.FileHandler)), None)
+    logger.info("Running %d folds on %d workers", num_folds, num_workers)
+    with context.Pool(num_workers, initializer=_init_fold_worker,
+                      initargs=(device_queue, num_threads, log_file)) as pool:
+        outputs = pool.map(_run_fold, [(fold_fn, args, i) for i in range(num_folds)], chunksize=1)
+    save_token_cache_states([state for _, state in outputs], args)
+    return [result for result, _ in outputs]
+
+
+@contextlib.contextmanager
+def shared_fold_data(filenames, tokenizer_path, args):
+    """ With parallel folds, tokenize filenames once before the folds start so that every fold worker
+        memory-maps the same files (see load_dataset) instead of tokenizing them again.
+        Without args.pretokenized_dir the files go to a temporary directory, removed afterwards.
+    """
+    if getattr(args, 'fold_workers', 1) <= 1:
+        yield
+        return
+    tokenizer = GPT2Tokenizer.from_pretrained(tokenizer_path)
+    tokenizer.add_special_tokens(special_tokens_dict)
+    if args.block_size <= 0:
+        args.block_size = tokenizer.max_len_single_sentence
+    args.block_size = min(args.block_size, tokenizer.max_len_single_sentence)
+    temp_dir = None
+    if not args.pretokenized_dir:
+        temp_dir = args.pretokenized_dir = tempfile.mkdtemp(prefix='pretokenized-')
+    try:
+        # the workers start from the token cache file, so it gets the sentences tokenized here
+        token_cache = build_token_cache(tokenizer, args)
+        pretokenize_files(filenames, tokenizer, args, token_cache)
+        save_token_cache(token_cache, args)
+        yield
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+            args.pretokenized_dir = None
@@ -1,48 +1,36 @@
 
 # from types import NoneType
+import logging
+
 import torch
 from torch.nn import functional as F
 from transformers import GPT2LMHeadModel, GPT2Tokenizer, GPT2DoubleHeadsModel
+from cqr.beam_search import beam_search
+from cqr.model_registry import model_registry
+from cqr.modeling import transformer_forward
+from cqr.prefix_cache import PrefixCache
+from cqr.quantization import quantize_model
+from cqr.sampling import sample_next_token, top_p_filtering
+from cqr.stopping import StopCriteria, default_sync_every
+from cqr.token_cache import shared_token_cache
 from cqr.utils import NUM_FOLD, set_seed, special_tokens_dict
 
+logger = logging.getLogger(__name__)
+
 
 def to_list(tensor):
     return tensor.detach().cpu().tolist()
 
 
-def top_p_filtering(logits, top_p=0.0, filter_value=-float('Inf')):
-    """ Filter a distribution of logits using nucleus (top-p) filtering
-        Args:
-            logits: logits distribution shape (batch size x vocabulary size)
-            top_p > 0.0: keep the top tokens with cumulative probability >= top_p (nucleus filtering).
-                Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
-        From: https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317
-    """
-    if top_p > 0.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-
-        # Remove tokens with cumulative probability above the threshold
-        sorted_indices_to_remove = cumulative_probs > top_p
-        # Shift the indices to the right to keep also the first token above the threshold
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-
-        # scatter sorted tensors to original indexing
-        indices_to_remove = sorted_indices_to_remove.scatter(dim=1, index=sorted_indices, src=sorted_indices_to_remove)
-        logits[indices_to_remove] = filter_value
-    return logits
-
-
 class InferenceModel:
 
-    def __init__(self, args, model_config=None):
+    def __init__(self, args, model_config=None, token_cache=None):
 
         self.special_tokens = ['<SEP>', '<PAD>', '<BOS>', '<EOS>']
         if args.mtl:
             self.special_tokens.append('<CLS>')
         if isinstance(model_config, type(dict())):
-            print("Using training model for inference")
+            logger.info("Using training model for inference")
             self.model = model_config['model']
             self.tokenizer = model_config['tokenizer']
         else:
@@ -53,16 +41,27 @@ class InferenceModel:
             else:
                 model_class = GPT2LMHeadModel
             
+            # folds share the tokenizer and, with the same config, the model (see ModelRegistry)
             try:
-                print(f"using model path {args.model_path}")
-                self.tokenizer = tokenizer_class.from_pretrained(args.model_path)
-                self.model = model_class.from_pretrained(args.model_path)
-            except:
-                self.tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
-                self.model = model_class.from_pretrained(args.model_name_or_path)
+                logger.info("Using model path %s", args.model_path)
+                self.tokenizer = model_registry.tokenizer(tokenizer_class, args.model_path)
+                self.model = model_registry.model(model_class, args.model_path)
+            except OSError:
+                if not getattr(args, 'model_name_or_path', None):
+                    raise
+                logger.info("Cannot load %s, using %s", args.model_path, args.model_name_or_path)
+                self.tokenizer = model_registry.tokenizer(tokenizer_class, args.model_name_or_path)
+                self.model = model_registry.model(model_class, args.model_name_or_path)
             
             
         self.tokenizer.add_special_tokens(special_tokens_dict)
+        if getattr(args, 'quantize', False):
+            if args.device.type != 'cpu':
+                raise ValueError("Quantized models run on CPU only, use --no_cuda")
+            # drop the fp32 model from the registry and quantize it in place, so that only the int8 model stays in
+            # memory; a training model passed in model_config is still used by the caller and is copied instead
+            model_registry.discard(self.model)
+            self.model = quantize_model(self.model, inplace=not isinstance(model_config, dict))
         self.model.to(args.device)
         self.model.eval()
 
@@ -74,12 +73,35 @@ class InferenceModel:
         self.top_p = args.top_p
         self.mtl = args.mtl
         self.debugging = args.toy_data
+        # Feed only the newest token per step and reuse the cached key/value states
+        self.use_cache = not getattr(args, 'no_kv_cache', False)
+        # Stop at <EOS> or at any of these (encoded) sequences, checking for finished rows every sync_every steps
+        self.stop_sequences = [self.tokenizer.encode(text) for text in getattr(args, 'stop_sequences', None) or []]
+        self.sync_every = getattr(args, 'sync_every', 0) or default_sync_every(self.device)
+        # With beam search (num_beams > 1) the num_return_sequences best rewrites of every conversation are kept
+        self.num_beams = getattr(args, 'num_beams', 1)
+        self.num_return_sequences = getattr(args, 'num_return_sequences', 1)
+        self.length_penalty = getattr(args, 'length_penalty', 1.0)
+        self.early_stopping = not getattr(args, 'no_early_stopping', False)
+        # Dropped from the predicted ids before decoding
+        self.special_ids = set(self.tokenizer.convert_tokens_to_ids(self.special_tokens))
+        # With the MTL model, return the last utterance as is when P(needs_rewrite) is below this threshold
+        self.rewrite_threshold = getattr(args, 'rewrite_threshold', 0.0) if self.mtl else 0.0
+        # Encoded history of each session, so that the next turn only prefills its new utterance
+        prefix_cache_mb = getattr(args, 'prefix_cache_mb', 0)
+        self.prefix_cache = PrefixCache(prefix_cache_mb * 2 ** 20) if prefix_cache_mb > 0 and self.use_cache else None
+        # Sentence -> token ids; earlier turns of a session are tokenized again for every later turn
+        if token_cache is None:
+            token_cache = shared_token_cache(self.tokenizer, args)
+        else:
+            token_cache.bind(self.tokenizer)
+        self.token_cache = token_cache
 
     def get_input_seq(self, input_sents):
 
         inputs = []        
         for sent in input_sents:
-            inputs.extend(self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(sent)))
+            inputs.extend(self.token_cache.encode(sent))
             inputs.append(self.tokenizer.sep_token_id)
         inputs.pop()
         if self.mtl:
@@ -87,49 +109,200 @@ class InferenceModel:
         inputs.append(self.tokenizer.bos_token_id)
         return inputs
 
-    def remove_special_tokens(self, text):
-        # Remove special tokens from the output text in rare cases
-        for token in self.special_tokens:
-            text = text.replace(token, "")
-        return text
+    def get_past(self, outputs):
+        # presents come after the lm logits (and the mc logits for the double heads model)
+        return outputs[2] if self.mtl else outputs[1]
+
+    def needs_rewrite_probs(self, mc_logits):
+        # the trainer reads two logits per row (class 1 = needs rewrite); a single score per row is a logit
+        if mc_logits.dim() > 1 and mc_logits.size(-1) > 1:
+            return F.softmax(mc_logits, dim=-1)[:, 1]
+        return torch.sigmoid(mc_logits.view(-1))
+
+    def prefill_session(self, session_id, input_ids):
+        """ Encode the conversation up to the new turn's <CLS>/<BOS>, reusing and updating the session's cached prefix.
+            Returns the past for the first past_length input ids and past_length.
+        """
+        past_length = len(input_ids) - (2 if self.mtl else 1)
+        # the next turn of this session continues with <SEP> where this one has <CLS>/<BOS>
+        next_prefix = input_ids[:past_length] + [self.tokenizer.sep_token_id]
+        prefix_ids, past = self.prefix_cache.get(session_id, next_prefix)
+        new_ids = next_prefix[len(prefix_ids):] if prefix_ids is not None else next_prefix
+        if new_ids:
+            new_ids = torch.tensor(new_ids, dtype=torch.long, device=self.device).unsqueeze(0)
+            _, past = transformer_forward(self.model.transformer, new_ids, past=past)
+        self.prefix_cache.put(session_id, next_prefix, past)
+        # drop the trailing <SEP>
+        return [layer_past[..., :-1, :] for layer_past in past], past_length
+
+    def predict(self, input_sents, session_id=None):
+        return self.finish_prediction(input_sents, self.generate(self.get_input_seq(input_sents), session_id))
+
+    def finish_prediction(self, input_sents, pred_ids):
+        # None means the MTL classifier found nothing to rewrite
+        if pred_ids is None:
+            return input_sents[-1]
+        if self.num_beams > 1:
+            # the best of the n-best rewrites
+            pred_ids = pred_ids[0][0]
+        return self.decode_prediction(pred_ids)
+
+    def predict_nbest(self, input_sents, session_id=None):
+        return self.finish_nbest(input_sents, self.generate_beams(self.get_input_seq(input_sents), session_id))
+
+    def finish_nbest(self, input_sents, nbest):
+        """ (rewrite, log prob) pairs of the n-best rewrites returned by generate_beams """
+        if nbest is None:
+            return [(input_sents[-1], 0.0)]
+        return [(self.decode_prediction(pred_ids), log_prob) for pred_ids, log_prob in nbest]
+
+    def generate_beams(self, input_ids, session_id=None):
+        """ The num_return_sequences best rewrites after input_ids by beam search, as (token ids, log prob) pairs,
+            best first, or None when the rewrite is skipped. The history is encoded once and shared by the beams.
+        """
+        with torch.no_grad():
+            past, past_length = None, 0
+            if session_id is not None and self.prefix_cache is not None:
+                past, past_length = self.prefill_session(session_id, input_ids)
+            new_ids = torch.tensor(input_ids[past_length:], dtype=torch.long, device=self.device).unsqueeze(0)
+            hidden_states, past = transformer_forward(self.model.transformer, new_ids, past=past)
+            if self.rewrite_threshold > 0:
+                # <CLS> is followed by <BOS>
+                mc_token_ids = torch.tensor([new_ids.size(1) - 2], dtype=torch.long, device=self.device)
+                mc_logits = self.model.multiple_choice_head(hidden_states, mc_token_ids)
+                if self.needs_rewrite_probs(mc_logits).item() < self.rewrite_threshold:
+                    return None
 
-    def predict(self, input_sents):
-        input_ids = self.get_input_seq(input_sents)
-        # print(input_sents, input_ids)
+            def step(tokens, past):
+                hidden_states, past = transformer_forward(self.model.transformer, tokens, past=past)
+                return F.log_softmax(self.model.lm_head(hidden_states[:, -1, :]), dim=-1), past
+
+            log_probs = F.log_softmax(self.model.lm_head(hidden_states[:, -1, :]), dim=-1)
+            return beam_search(step, log_probs, past, self.tokenizer.eos_token_id, self.length, self.num_beams,
+                               self.num_return_sequences, self.length_penalty, self.early_stopping)
+
+    def generate(self, input_ids, session_id=None):
+        """ Token ids predicted after input_ids (see get_input_seq), or None when the rewrite is skipped.
+            With beam search, the n-best rewrites of generate_beams.
+        """
+        if self.num_beams > 1:
+            return self.generate_beams(input_ids, session_id)
         input_length = len(input_ids)
-        input_ids = torch.tensor(input_ids, dtype=torch.long, device=self.device).unsqueeze(0)
-        if self.debugging:
-            print(input_ids)
         with torch.no_grad():
+            past, past_length = None, 0
+            if session_id is not None and self.prefix_cache is not None:
+                past, past_length = self.prefill_session(session_id, input_ids)
+            input_ids = torch.tensor(input_ids, dtype=torch.long, device=self.device).unsqueeze(0)
+            if self.debugging:
+                logger.info("Input ids: %s", input_ids)
+            stop = StopCriteria(1, self.tokenizer.eos_token_id, self.length, self.stop_sequences, self.device)
+            rows = torch.zeros(1, dtype=torch.long, device=self.device)
+            next_token = None
             for step in range(self.length):
-                inputs = {'input_ids': input_ids}
+                if self.use_cache:
+                    # prefill the (uncached part of the) history once, then only the token sampled last step
+                    inputs = {'input_ids': input_ids[:, past_length:] if step == 0 else next_token, 'past': past}
+                else:
+                    inputs = {'input_ids': input_ids}
+                if step == 0 and self.rewrite_threshold > 0:
+                    # <CLS> is followed by <BOS>
+                    inputs['mc_token_ids'] = torch.tensor([input_length - 2 - past_length], dtype=torch.long,
+                                                          device=self.device)
     
                 outputs = self.model(**inputs)
+                if step == 0 and self.rewrite_threshold > 0:
+                    if self.needs_rewrite_probs(outputs[1]).item() < self.rewrite_threshold:
+                        return None
+                if self.use_cache:
+                    past = self.get_past(outputs)
                 # print(outputs[0].shape)
                 # exit(0)
-                next_token_logits = outputs[0][:, -1, :] / (self.temperature if self.temperature > 0 else 1.)
-
-                filtered_logits = top_p_filtering(next_token_logits, top_p=self.top_p)
-                if self.temperature == 0: # greedy sampling:
-                    next_token = torch.argmax(filtered_logits, dim=-1).unsqueeze(-1)
-                else:
-                    next_token = torch.multinomial(F.softmax(filtered_logits, dim=-1), num_samples=1)
-                new_token = to_list(next_token)
-                if self.tokenizer.decode(new_token[0]).strip() == "<EOS>":
-                    # _, mc_pred = outputs[1].topk(1,dim=1)
-                    # print(mc_pred)
-                    # print(f"step:{step} break called")
+                next_token = self.sample_next_token(outputs[0][:, -1, :])
+                stop.update(next_token, rows)
+                if (step + 1) % self.sync_every == 0 and stop.finished_rows(rows)[0]:
                     break
                 input_ids = torch.cat((input_ids, next_token), dim=1)
 
-        pred_ids = to_list(input_ids[0, input_length:])
+        return stop.finished_ids()[0]
+
+    def sample_next_token(self, next_token_logits):
+        return sample_next_token(next_token_logits, self.temperature, self.top_p)
+
+    def decode_prediction(self, pred_ids):
         if self.debugging:
-            print(f"PRED_IDS: {pred_ids}")
+            logger.info("PRED_IDS: %s", pred_ids)
+        # special tokens are rare in predictions, but should not end up in the text
+        pred_ids = [token_id for token_id in pred_ids if token_id not in self.special_ids]
         pred_text = self.tokenizer.decode(pred_ids, clean_up_tokenization_spaces=True)
         if self.debugging:
-            print(f"decode op: {pred_text}")
-        # print(f"PRED_TEXT:{pred_text}")
-        pred_text = self.remove_special_tokens(pred_text)
-        
-        return pred_text 
+            logger.info("decode op: %s", pred_text)
+        return pred_text
+
+    def predict_batch(self, list_of_input_sents):
+        batch_pred_ids = self.generate_batch([self.get_input_seq(input_sents) for input_sents in list_of_input_sents])
+        return [self.finish_prediction(input_sents, pred_ids)
+                for input_sents, pred_ids in zip(list_of_input_sents, batch_pred_ids)]
+
+    def generate_batch(self, batch_ids):
+        """ Decode several conversations together, returning what generate would for each of them.
+            Histories are left-padded so that every row's next token is predicted from the last column;
+            padded positions are masked out and position ids restart at each row's first real token.
+            Rows are dropped from the batch (and from the cached key/values) once they stop (see StopCriteria),
+            which is checked every sync_every steps, or right after the prefill when the MTL classifier says
+            they need no rewrite.
+        """
+        if self.num_beams > 1:
+            # the beams of a conversation are its batch
+            return [self.generate_beams(input_ids) for input_ids in batch_ids]
+        max_length = max(len(ids) for ids in batch_ids)
+        pad_id, eos_id = self.tokenizer.pad_token_id, self.tokenizer.eos_token_id
+        input_ids = torch.tensor([[pad_id] * (max_length - len(ids)) + ids for ids in batch_ids],
+                                 dtype=torch.long, device=self.device)
+        attention_mask = torch.tensor([[0] * (max_length - len(ids)) + [1] * len(ids) for ids in batch_ids],
+                                      dtype=torch.long, device=self.device)
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+
+        stop = StopCriteria(len(batch_ids), eos_id, self.length, self.stop_sequences, self.device)
+        skipped = set()
+        rows = torch.arange(len(batch_ids), device=self.device)  # original row index of every row still being decoded
+        with torch.no_grad():
+            hidden_states, past = transformer_forward(self.model.transformer, input_ids, attention_mask=attention_mask,
+                                                      position_ids=position_ids)
+            if self.rewrite_threshold > 0:
+                # every row ends with <CLS> <BOS> after left padding
+                mc_token_ids = torch.full((len(batch_ids),), max_length - 2, dtype=torch.long, device=self.device)
+                probs = to_list(self.needs_rewrite_probs(self.model.multiple_choice_head(hidden_states, mc_token_ids)))
+                keep = [row for row, prob in enumerate(probs) if prob >= self.rewrite_threshold]
+                skipped.update(row for row, prob in enumerate(probs) if prob < self.rewrite_threshold)
+                if len(keep) < len(batch_ids):
+                    index = torch.tensor(keep, dtype=torch.long, device=self.device)
+                    hidden_states = hidden_states[:, -1:, :].index_select(0, index)
+                    past = [layer_past.index_select(1, index) for layer_past in past]
+                    attention_mask = attention_mask.index_select(0, index)
+                    position_ids = position_ids.index_select(0, index)
+                    rows = index
+
+            for step in range(self.length if len(rows) > 0 else 0):
+                next_token = self.sample_next_token(self.model.lm_head(hidden_states[:, -1, :]))
+                stop.update(next_token, rows)
+                if step == self.length - 1:
+                    break
+                if (step + 1) % self.sync_every == 0:
+                    finished = stop.finished_rows(rows)
+                    if all(finished):
+                        break
+                    if any(finished):
+                        # retire finished rows
+                        index = torch.tensor([row for row, done in enumerate(finished) if not done],
+                                             dtype=torch.long, device=self.device)
+                        past = [layer_past.index_select(1, index) for layer_past in past]
+                        next_token = next_token.index_select(0, index)
+                        attention_mask = attention_mask.index_select(0, index)
+                        position_ids = position_ids.index_select(0, index)
+                        rows = rows.index_select(0, index)
+                attention_mask = torch.cat((attention_mask, attention_mask.new_ones((len(rows), 1))), dim=1)
+                position_ids = position_ids[:, -1:] + 1
+                hidden_states, past = transformer_forward(self.model.transformer, next_token, past=past,
+                                                          attention_mask=attention_mask, position_ids=position_ids)
 
+        return [None if row in skipped else ids for row, ids in enumerate(stop.finished_ids())]
@@ -0,0 +1,85 @@
+import hashlib
+import logging
+import os
+import time
+
+import torch
+from transformers import WEIGHTS_NAME, GPT2Config
+
+logger = logging.getLogger(__name__)
+
+TOKENIZER_FILES = ['vocab.json', 'merges.txt', 'added_tokens.json', 'special_tokens_map.json']
+
+
+def tokenizer_files_hash(path):
+    sha = hashlib.sha1()
+    for name in TOKENIZER_FILES:
+        filename = os.path.join(path, name)
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                sha.update(name.encode('utf-8') + f.read())
+    return sha.hexdigest()
+
+
+def load_state_dict_mmap(weights_file):
+    """ State dict whose tensors are memory-mapped from weights_file instead of read into memory """
+    try:
+        return torch.load(weights_file, map_location='cpu', mmap=True, weights_only=True)
+    except RuntimeError:
+        # files written with the legacy (non-zip) serialization cannot be memory-mapped
+        return torch.load(weights_file, map_location='cpu')
+
+
+class ModelRegistry:
+    """ Process-level cache of tokenizers and models, for loading several checkpoints of the same architecture
+        (e.g. the folds of a cross validation run) one after another.
+        A tokenizer is loaded once per distinct set of tokenizer files. A model is built once per model class
+        and config; loading another checkpoint with the same config copies its memory-mapped weights into that
+        model, so models returned earlier for the same class and config see the new weights.
+    """
+
+    def __init__(self):
+        self.tokenizers = {}  # (tokenizer class, tokenizer files hash) -> tokenizer
+        self.models = {}  # (model class, config) -> model
+        self.load_seconds = 0.0
+
+    def tokenizer(self, tokenizer_class, path):
+        start = time.perf_counter()
+        key = (tokenizer_class, tokenizer_files_hash(path) if os.path.isdir(path) else path)
+        cached = key in self.tokenizers
+        if not cached:
+            self.tokenizers[key] = tokenizer_class.from_pretrained(path)
+        self._log("tokenizer", path, start, " (cached)" if cached else "")
+        return self.tokenizers[key]
+
+    def model(self, model_class, path):
+        start = time.perf_counter()
+        weights_file = os.path.join(path, WEIGHTS_NAME)
+        config = GPT2Config.from_pretrained(path)
+        key = (model_class, config.to_json_string())
+        model = self.models.get(key)
+        if model is not None and os.path.exists(weights_file):
+            state_dict = load_state_dict_mmap(weights_file)
+            incompatible = model.load_state_dict(state_dict, strict=False)
+            if not incompatible.missing_keys:
+                self._log("weights", path, start, " into the cached model")
+                return model
+            # missing weights would silently keep the values of the previous checkpoint
+            logger.warning("%s lacks %d weights of the cached model, loading it from scratch",
+                           weights_file, len(incompatible.missing_keys))
+        model = model_class.from_pretrained(path)
+        self.models[key] = model
+        self._log("model", path, start, "")
+        return model
+
+    def discard(self, model):
+        """ Stop caching model, e.g. once it has been replaced by a quantized copy """
+        self.models = {key: cached for key, cached in self.models.items() if cached is not model}
+
+    def _log(self, what, path, start, note):
+        seconds = time.perf_counter() - start
+        self.load_seconds += seconds
+        logger.info("Loaded %s %s in %.2fs%s", what, path, seconds, note)
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,123 @@
+import torch
+from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
+from transformers import GPT2DoubleHeadsModel, GPT2LMHeadModel
+
+
+def transformer_forward(transformer, input_ids, past=None, attention_mask=None, position_ids=None):
+    """ Run the GPT-2 body (``model.transformer``) and return the final hidden states and the presents.
+        Args:
+            transformer: the ``GPT2Model`` of a ``GPT2LMHeadModel`` / ``GPT2DoubleHeadsModel``
+            past: key/value states returned by a previous call (one tensor per layer)
+            attention_mask: 1 for real tokens and 0 for padding, shape (batch size x (past length + input length)).
+                ``GPT2Model.forward`` in transformers 2.3.0 reshapes the mask to the input length only,
+                so it cannot mask left-padded histories once they are cached.
+            position_ids: defaults to consecutive positions following the cached ones
+    """
+    past_length = 0 if past is None else past[0].size(-2)
+    if past is None:
+        past = [None] * len(transformer.h)
+    if position_ids is None:
+        position_ids = torch.arange(past_length, past_length + input_ids.size(-1),
+                                    dtype=torch.long, device=input_ids.device).unsqueeze(0)
+
+    hidden_states = transformer.wte(input_ids) + transformer.wpe(position_ids)
+    hidden_states = transformer.drop(hidden_states)
+    if attention_mask is not None:
+        # batch size x 1 x 1 x key length, added to the raw attention scores before the softmax
+        attention_mask = attention_mask[:, None, None, :].to(dtype=hidden_states.dtype)
+        attention_mask = (1.0 - attention_mask) * -10000.0
+
+    presents = ()
+    for block, layer_past in zip(transformer.h, past):
+        outputs = block(hidden_states, layer_past=layer_past, attention_mask=attention_mask)
+        hidden_states, present = outputs[:2]
+        presents = presents + (present,)
+    hidden_states = transformer.ln_f(hidden_states)
+    return hidden_states, presents
+
+
+def target_positions(labels, needs_rewrite=None):
+    """ The positions scored by the LM loss, as indices into the flattened batch x positions, and their labels.
+        The logits at position t predict labels[:, t + 1], and only targets count: labels other than -1 (which
+        start after pred_begin_pos), in rows that need a rewrite when needs_rewrite is given. Meant for the batch
+        labels still on the host, so that the device never has to report how many targets there are.
+    """
+    shift_labels = F.pad(labels[:, 1:], (0, 1), value=-1)
+    if needs_rewrite is not None:
+        shift_labels = shift_labels.masked_fill((needs_rewrite != 1).view(-1, 1), -1)
+    shift_labels = shift_labels.reshape(-1)
+    index = (shift_labels != -1).nonzero(as_tuple=True)[0]
+    return index, shift_labels[index]
+
+
+def _lm_head_loss(lm_head, hidden_states, labels):
+    return F.cross_entropy(lm_head(hidden_states), labels, reduction='sum')
+
+
+def target_lm_loss(lm_head, hidden_states, target_index, target_labels, chunk_size=0):
+    """ Mean cross entropy of lm_head over the target positions of target_positions only, 0 without targets.
+        With chunk_size > 0 the logits are computed chunk_size positions at a time and recomputed in the backward
+        pass, so that only one chunk of vocabulary-sized logits is alive at a time.
+    """
+    hidden_states = hidden_states.reshape(-1, hidden_states.size(-1)).index_select(0, target_index)
+    num_targets = target_index.size(0)
+    if chunk_size <= 0 or num_targets <= chunk_size:
+        loss = _lm_head_loss(lm_head, hidden_states, target_labels)
+    else:
+        loss = sum(checkpoint(_lm_head_loss, lm_head, hidden_states[start:start + chunk_size],
+                              target_labels[start:start + chunk_size], use_reentrant=False)
+                   for start in range(0, num_targets, chunk_size))
+    return loss / max(num_targets, 1)
+
+
+class GPT2LMHeadTargetModel(GPT2LMHeadModel):
+    """ GPT2LMHeadModel that, given target_index and target_labels (see target_positions), only runs the LM head
+        at those positions and returns (LM loss,). Without them it is a GPT2LMHeadModel, and it saves like one.
+    """
+
+    def forward(self, input_ids, attention_mask=None, target_index=None, target_labels=None, chunk_size=0,
+                **kwargs):
+        if target_index is None:
+            return super().forward(input_ids, attention_mask=attention_mask, **kwargs)
+        hidden_states, _ = transformer_forward(self.transformer, input_ids, attention_mask=attention_mask)
+        return (target_lm_loss(self.lm_head, hidden_states, target_index, target_labels, chunk_size),)
+
+
+def needs_rewrite_loss(mc_logits, needs_rewrite):
+    """ Loss of the needs_rewrite classifier of the MTL model. Stock GPT2DoubleHeadsModel heads have one logit per
+        row (config.num_labels is forced to 1), which is trained as a binary classifier; heads with two logits per
+        row are trained with cross entropy.
+    """
+    if mc_logits.dim() > 1 and mc_logits.size(-1) > 1:
+        return F.cross_entropy(mc_logits, needs_rewrite.view(-1))
+    return F.binary_cross_entropy_with_logits(mc_logits.view(-1), needs_rewrite.view(-1).to(mc_logits.dtype))
+
+
+def needs_rewrite_predictions(mc_logits):
+    """ Predicted needs_rewrite (0 or 1) of every row, for either kind of head (see needs_rewrite_loss) """
+    if mc_logits.dim() > 1 and mc_logits.size(-1) > 1:
+        return mc_logits.argmax(dim=-1)
+    return (mc_logits.view(-1) > 0).long()
+
+
+class GPT2DoubleHeadsTargetModel(GPT2DoubleHeadsModel):
+    """ GPT2DoubleHeadsModel whose MC loss (see needs_rewrite_loss) works with one logit per row. Given mc_labels it
+        returns (MC loss, LM loss, MC logits) where the LM loss is that of target_index and target_labels (see
+        target_positions), only running the LM head at those positions, or (MC loss, LM logits, MC logits,
+        presents) without them. Otherwise it is a GPT2DoubleHeadsModel, and it saves like one.
+    """
+
+    def forward(self, input_ids, attention_mask=None, mc_token_ids=None, mc_labels=None, target_index=None,
+                target_labels=None, chunk_size=0, **kwargs):
+        if target_index is None:
+            outputs = super().forward(input_ids, attention_mask=attention_mask, mc_token_ids=mc_token_ids, **kwargs)
+            if mc_labels is None:
+                return outputs
+            # outputs are (LM logits, MC logits, presents)
+            return (needs_rewrite_loss(outputs[1], mc_labels),) + outputs
+        hidden_states, _ = transformer_forward(self.transformer, input_ids, attention_mask=attention_mask)
+        mc_logits = self.multiple_choice_head(hidden_states, mc_token_ids).squeeze(-1)
+        mc_loss = needs_rewrite_loss(mc_logits, mc_labels)
+        lm_loss = target_lm_loss(self.lm_head, hidden_states, target_index, target_labels, chunk_size)
+        return mc_loss, lm_loss, mc_logits
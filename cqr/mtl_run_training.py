@@ -11,52 +11,64 @@ import os
 from cqr.inference_model import InferenceModel
 import torch
 import torch.nn.functional as F
-from torch.nn import  CrossEntropyLoss
 
 
 from datetime import datetime
 
-from torch.utils.data import DataLoader, Dataset, RandomSampler
 from tqdm import tqdm, trange
-from transformers import  GPT2Config,GPT2DoubleHeadsModel,\
-     GPT2Tokenizer, AdamW, get_linear_schedule_with_warmup, GPT2LMHeadModel
-
-from cqr.dataset import QueryRewriteDataset
-from cqr.utils import NUM_FOLD, set_seed, special_tokens_dict
+from transformers import  GPT2Config,\
+     GPT2Tokenizer, AdamW, get_linear_schedule_with_warmup
+
+from cqr.dataset import build_dataloader, load_dataset, set_sampler_epoch
+from cqr.distributed import (barrier, gradient_sync, is_main_process, local_main_first, setup_distributed,
+                             unwrap_model, world_size, wrap_model)
+from cqr.fold_runner import run_folds, shared_fold_data
+from cqr.modeling import (GPT2DoubleHeadsTargetModel, GPT2LMHeadTargetModel, needs_rewrite_predictions,
+                          target_positions)
+from cqr.token_cache import build_token_cache, save_token_cache, shared_token_cache
+from cqr.train_stats import DeviceSums, StepTimer
+from cqr.utils import NUM_FOLD, PRECISIONS, check_precision, set_seed, special_tokens_dict, training_autocast
 
 logger = logging.getLogger(__name__)
 
 
-def collate_fn(batch_dataset: list):
-    return_tuple = [[], [], [], [], [], []]
-    for example in batch_dataset:
-        return_tuple[0].append(example.topic_number)
-        return_tuple[1].append(example.query_number)
-        return_tuple[2].append(example.ids)
-        return_tuple[3].append(example.labels)
-        return_tuple[4].append(example.pred_begin_pos)
-        return_tuple[5].append(example.needs_rewrite)
-    return_tuple[2] = torch.tensor(return_tuple[2])
-    return_tuple[3] = torch.tensor(return_tuple[3])
-    return_tuple = tuple(return_tuple)
-    return return_tuple
-
-def get_lm_loss(preds, target, needs_rewrite):
-    # print(preds.shape, target.shape)
-    idx_need = (needs_rewrite == 1).nonzero(as_tuple=False)
-    target, preds = target[idx_need].squeeze(), preds[idx_need].squeeze()
-
-    shift_logits = preds[..., :-1, :].contiguous()
-    shift_labels = target[..., 1:].contiguous()
-    loss_fct = CrossEntropyLoss(ignore_index=-1)
-    lm_loss = loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
-    return lm_loss
+def get_lm_loss(lm_logits, labels, needs_rewrite):
+    """ Mean LM loss over the target tokens (labels are -1 up to pred_begin_pos) of the rows that need a rewrite,
+        0 when no row does. The labels are shifted and masked instead of the logits, so the [B, T, V] logits are
+        used in place rather than gathered and copied.
+    """
+    # the logits at position t predict the label at t + 1
+    shift_labels = F.pad(labels[:, 1:], (0, 1), value=-1).masked_fill((needs_rewrite != 1).view(-1, 1), -1)
+    lm_loss = F.cross_entropy(lm_logits.view(-1, lm_logits.size(-1)), shift_labels.view(-1), ignore_index=-1,
+                              reduction='sum')
+    return lm_loss / (shift_labels != -1).sum().clamp(min=1)
+
+
+def get_losses(args, model, batch, mc_labels):
+    """ (mc_loss, lm_loss, mc_logits) of a batch. With --target_logits_only the LM head only runs at the target
+        positions of the rows that need a rewrite, found on the host labels before they are copied to the device.
+    """
+    inputs = batch[2].to(args.device, non_blocking=True)  # batch_size * block_size
+    attention_mask = batch[6].to(args.device, non_blocking=True)
+    mc_token_ids = batch[7].to(args.device, non_blocking=True)  # position of <CLS>
+    if args.target_logits_only:
+        target_index, target_labels = [t.to(args.device, non_blocking=True)
+                                       for t in target_positions(batch[3], batch[5])]
+        return model(input_ids=inputs, attention_mask=attention_mask, mc_labels=mc_labels,
+                     mc_token_ids=mc_token_ids, target_index=target_index, target_labels=target_labels,
+                     chunk_size=args.lm_chunk_size)
+    labels = batch[3].to(args.device, non_blocking=True)
+    # without lm_labels, so that the model does not compute an LM loss over all rows
+    outputs = model(input_ids=inputs, attention_mask=attention_mask, mc_labels=mc_labels,
+                    mc_token_ids=mc_token_ids)
+    # model outputs are always tuple in transformers (see doc)
+    return outputs[0], get_lm_loss(outputs[1], labels, mc_labels), outputs[2]
 
 
 def eval(args, val_dataset, model, inf_model, tokenizer , logger):
     args.val_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    val_sampler = RandomSampler(val_dataset)
-    val_dataloader = DataLoader(val_dataset, sampler=val_sampler, batch_size=args.train_batch_size, collate_fn=collate_fn)
+    val_dataloader = build_dataloader(val_dataset, args, args.train_batch_size)
+    model = unwrap_model(model)
     model.eval()
     inf_model.model = model  # updating model before decoding
 
@@ -71,33 +83,22 @@ def eval(args, val_dataset, model, inf_model, tokenizer , logger):
     # val_iterator = trange(int(num_val_epochs), desc="Epoch", disable=args.local_rank not in [-1, 0])
     set_seed(args)  # Added here for reproducibility (even between python 2 and 3)
     epoch_iterator = tqdm(val_dataloader, desc="Iteration", \
-        disable=args.local_rank not in [-1, 0])
+        disable=not is_main_process())
     epoch_pos, epoch_tot = 0., 0.
     for step, batch in enumerate(epoch_iterator):
-        inputs, labels = (batch[2], batch[3])  # get ids and labels
-        inputs = inputs.to(args.device)  # batch_size * block_size
-        labels = labels.to(args.device)
-        mc_labels = torch.tensor(batch[5]).to(args.device)
-        mc_token_ids = (inputs == tokenizer.cls_token_id).nonzero(as_tuple=False)
-        mc_token_ids = mc_token_ids[:,1]
-        mc_token_ids = mc_token_ids.to(args.device)
+        mc_labels = batch[5].to(args.device, non_blocking=True)
         model.eval()
-        outputs = model(input_ids=inputs, lm_labels=labels, mc_labels=mc_labels, mc_token_ids=mc_token_ids)
-        mc_loss = outputs[1]  # model outputs are always tuple in transformers (see doc)
-        lm_loss = get_lm_loss(outputs[2],labels,mc_labels)
-        loss = mc_loss + lm_loss
-        epoch_tot += len(labels)
-        _,pred = outputs[3].data.topk(1,dim=1)
-        pred = pred.flatten()
+        with training_autocast(args.precision, args.device):
+            mc_loss, lm_loss, mc_logits = get_losses(args, model, batch, mc_labels)
+            loss = mc_loss + lm_loss
+        epoch_tot += len(mc_labels)
+        pred = needs_rewrite_predictions(mc_logits.detach())
         # print(pred.shape,mc_labels.shape)
         epoch_pos += (pred == mc_labels).sum().item()
         
-        del inputs
-        del outputs
+        del mc_logits
         torch.cuda.empty_cache()
 
-        if args.n_gpu > 1:
-            loss = loss.sum()  # mean() to average on multi-gpu parallel training
         # if args.gradient_accumulation_steps > 1:
         #     loss = loss / args.gradient_accumulation_steps
 
@@ -128,8 +129,7 @@ def eval(args, val_dataset, model, inf_model, tokenizer , logger):
 
 def train(args, train_dataset, val_dataset, model, inf_model, tokenizer, logger, cross_validate_id=-1):
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size, collate_fn=collate_fn)
+    train_dataloader = build_dataloader(train_dataset, args, args.train_batch_size, distributed=True)
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -146,89 +146,61 @@ def train(args, train_dataset, val_dataset, model, inf_model, tokenizer, logger,
     optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
     scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=t_total)
 
-    # multi-gpu training (should be after apex fp16 initialization)
-    if args.n_gpu > 1:
-        model = torch.nn.DataParallel(model)
+    # multi-process training: one process per GPU (or CPU worker), launched by torchrun
+    model = wrap_model(model, args)
 
     # Train!
     logger.info("***** Running training *****")
     logger.info("  Num examples = %d", len(train_dataset))
     logger.info("  Num Epochs = %d", args.num_train_epochs)
-    logger.info(f" Num GPU = {args.n_gpu}")
+    logger.info(f" Num processes = {world_size()}")
     logger.info("  Instantaneous batch size per GPU = %d", args.per_gpu_train_batch_size)
-    logger.info("  Total train batch size (w. parallel & accumulation) = %d",
-                   args.train_batch_size * args.gradient_accumulation_steps)
+    logger.info("  Total train batch size (w. distributed & accumulation) = %d",
+                   args.train_batch_size * args.gradient_accumulation_steps * world_size())
     logger.info("  Gradient Accumulation steps = %d", args.gradient_accumulation_steps)
     logger.info("  Total optimization steps = %d", t_total)
 
-    global_step = 0
+    global_step, num_batches = 0, 0
     tr_loss, logging_loss = 0.0, 0.0
+    # per-epoch sums stay on the device and are only copied to the host every logging_steps updates
+    epoch_sums = DeviceSums(['loss', 'pos'], args.device)
+    timer = StepTimer()
     model.zero_grad()
     # eval(args, val_dataset, model, inf_model, tokenizer, logger)
     train_iterator = trange(int(args.num_train_epochs), desc="Epoch",\
-        disable=args.local_rank not in [-1, 0])
+        disable=not is_main_process())
     set_seed(args)  # Added here for reproducibility (even between python 2 and 3)
     for ep in train_iterator:
+        set_sampler_epoch(train_dataloader, ep)
         epoch_iterator = tqdm(train_dataloader, desc="Iteration", \
-            disable=args.local_rank not in [-1, 0])
-        epoch_loss = 0.
-        epoch_pos, epoch_tot = 0., 0.
+            disable=not is_main_process())
+        epoch_sums.reset()
+        epoch_tot = 0.
         for step, batch in enumerate(epoch_iterator):
-            inputs, labels = (batch[2], batch[3])  # get ids and labels
-            # print(inputs, tokenizer.cls_token_id)
-            inputs = inputs.to(args.device)  # batch_size * block_size
-            labels = labels.to(args.device)
-            mc_labels = torch.tensor(batch[5]).to(args.device)
-            # mc_token_ids = torch.tensor([inputs.index(tokenizer.cls_token_id)\
-            #      for _ in inputs]).to(args.device)
-            mc_token_ids = (inputs == tokenizer.cls_token_id).nonzero(as_tuple=False)
-            # print(mc_token_ids, mc_token_ids.shape)
-            mc_token_ids = mc_token_ids[:,1]
-            # print(mc_token_ids)
-            # print(mc_token_ids.shape, inputs.shape)
-            # exit(0)
-            mc_token_ids = mc_token_ids.to(args.device)
-            # print(inputs.shape, labels.shape, mc_labels.shape, mc_token_ids.shape)
-            # print(inputs[12])
+            mc_labels = batch[5].to(args.device, non_blocking=True)
+            timer.mark('data')
             model.train()
-            outputs = model(input_ids=inputs, lm_labels=labels, mc_labels=mc_labels, mc_token_ids=mc_token_ids)
-            mc_loss = outputs[1]  # model outputs are always tuple in transformers (see doc)
-            lm_loss = get_lm_loss(outputs[2],labels,mc_labels)
-            if torch.isnan(lm_loss):
-                print(f"called during train, cls is {tokenizer.cls_token_id}")
-                print(f"Input: {inputs}\n \
-                        label: {labels}\n \
-                        mc_loss: {mc_loss}\n \
-                        lm_loss: {lm_loss}")
-                # exit(0)
-                lm_loss = outputs[0]
-            # lm_loss = outputs[0]
-            loss = mc_loss + 50*lm_loss
-            epoch_tot += len(labels)
-            _,pred = outputs[3].data.topk(1,dim=1)
-            pred = pred.flatten()
-            # print(pred,mc_labels)
-            # exit(0)
-            epoch_pos += (pred == mc_labels).sum().item()
-            
-            del inputs
-            del outputs
-            torch.cuda.empty_cache()
-
-            if args.n_gpu > 1:
-                loss = loss.sum()  # mean() to average on multi-gpu parallel training
-            # if args.gradient_accumulation_steps > 1:
-            #     loss = loss / args.gradient_accumulation_steps
-
-            loss.backward()
-            tr_loss += loss.item()
-            epoch_loss += loss.item()
-            # print(epoch_loss/(step+1))
-            # exit(0)
+            # gradients are only all-reduced across processes on the last batch of an update
+            with gradient_sync(model, (step + 1) % args.gradient_accumulation_steps == 0):
+                with training_autocast(args.precision, args.device):
+                    # lm_loss is 0 for batches without rows to rewrite, which then only train the classifier
+                    mc_loss, lm_loss, mc_logits = get_losses(args, model, batch, mc_labels)
+                    loss = mc_loss + 50*lm_loss
+                epoch_tot += len(mc_labels)
+                pred = needs_rewrite_predictions(mc_logits.detach())
+                epoch_sums.add('pos', (pred == mc_labels).sum())
+
+                del mc_logits
+
+                # if args.gradient_accumulation_steps > 1:
+                #     loss = loss / args.gradient_accumulation_steps
+                timer.mark('forward')
+
+                loss.backward()
+            epoch_sums.add_loss(loss)
             del loss
-            torch.cuda.empty_cache()
-            frac = ((step+1)/len(epoch_iterator))
-            epoch_iterator.set_postfix(Loss=epoch_loss/(step+1),Pos=epoch_pos ,Acc=epoch_pos/epoch_tot*100)
+            num_batches += 1
+            timer.mark('backward')
 
             if (step + 1) % args.gradient_accumulation_steps == 0:
                 torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
@@ -236,37 +208,106 @@ def train(args, train_dataset, val_dataset, model, inf_model, tokenizer, logger,
                 scheduler.step()  # Update learning rate schedule
                 model.zero_grad()
                 global_step += 1
-
-                if args.save_steps > 0 and global_step % args.save_steps == 0:
+                timer.mark('optimizer')
+
+                if args.logging_steps > 0 and global_step % args.logging_steps == 0 and is_main_process():
+                    sums = epoch_sums.values()
+                    epoch_iterator.set_postfix(Loss=sums['loss']/(step+1), Pos=sums['pos'],
+                                               Acc=sums['pos']/epoch_tot*100)
+                    logger.info("Step %d: loss %.4f, learning rate %.3g", global_step,
+                                (tr_loss + sums['loss'] - logging_loss) / args.logging_steps,
+                                scheduler.get_last_lr()[0])
+                    logging_loss = tr_loss + sums['loss']
+                    timer.mark('sync')
+
+                if args.save_steps > 0 and global_step % args.save_steps == 0 and is_main_process():
                     checkpoint_prefix = 'checkpoint'
                     output_dir = args.output_dir + (('-' + str(cross_validate_id)) if cross_validate_id != -1 else "")
                     # Save model checkpoint
                     output_dir = os.path.join(output_dir, '{}-{}'.format(checkpoint_prefix, global_step))
                     if not os.path.exists(output_dir):
                         os.makedirs(output_dir)
-                    model_to_save = model.module if hasattr(model, 'module') else model
+                    model_to_save = unwrap_model(model)
                     model_to_save.save_pretrained(output_dir)
                     tokenizer.save_pretrained(output_dir)
                     torch.save(args, os.path.join(output_dir, 'training_args.bin'))
                     logger.info("Saving model checkpoint to %s", output_dir)
+                    timer.mark('checkpoint')
 
             if args.max_steps > 0 and global_step > args.max_steps:
                 epoch_iterator.close()
                 break
-        
-        epoch_loss /= len(epoch_iterator)
-        epoch_acc = epoch_pos/epoch_tot*100
+
+        sums = epoch_sums.values()
+        timer.mark('sync')
+        tr_loss += sums['loss']
+        epoch_loss = sums['loss'] / len(epoch_iterator)
+        epoch_acc = sums['pos']/epoch_tot*100
         logger.info(f"==========Epoch {ep}/{int(args.num_train_epochs)}==========")
         logger.info(f"Train Loss: {epoch_loss} | Train Acc: {epoch_acc}")
-        val_loss, val_acc = eval(args, val_dataset, model, inf_model, tokenizer, logger)
-        logger.info(f"Val Loss: {val_loss} | Val Acc: {val_acc}")
+        if is_main_process():
+            # the other processes wait for it in the first all-reduce of the next epoch
+            val_loss, val_acc = eval(args, val_dataset, model, inf_model, tokenizer, logger)
+            logger.info(f"Val Loss: {val_loss} | Val Acc: {val_acc}")
+            timer.mark('eval')
         if args.max_steps > 0 and global_step > args.max_steps:
             train_iterator.close()
             break
 
+    timer.log_summary(num_batches)
     return global_step, tr_loss / global_step
 
 
+def train_fold(args, i):
+    if args.mtl:
+        config_class, model_class, tokenizer_class = GPT2Config, GPT2DoubleHeadsTargetModel, GPT2Tokenizer
+    else:
+        config_class, model_class, tokenizer_class = GPT2Config, GPT2LMHeadTargetModel, GPT2Tokenizer
+    logger.info("Training Fold #{}".format(i))
+    suffix = ('-' + str(i)) if args.init_from_multiple_models else ''
+    with local_main_first(args):
+        config = config_class.from_pretrained(args.model_name_or_path + suffix)
+        tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path + suffix)
+        tokenizer.add_special_tokens(special_tokens_dict)
+        model = model_class.from_pretrained(args.model_name_or_path + suffix)
+    model.resize_token_embeddings(len(tokenizer))  # resize
+    model.to(args.device)
+
+    if args.block_size <= 0:
+        args.block_size = tokenizer.max_len_single_sentence
+    args.block_size = min(args.block_size, tokenizer.max_len_single_sentence)
+
+    logger.info("Training/evaluation parameters %s", args)
+    train_files = ["%s.%d" % (args.train_file, j) for j in range(NUM_FOLD) if j != i]
+    logger.info("train_files: {}".format(train_files))
+    token_cache = shared_token_cache(tokenizer, args)
+    inf_model = InferenceModel(args, {'model': model, 'tokenizer': tokenizer}, token_cache=token_cache)
+    with local_main_first(args):
+        train_dataset = load_dataset(train_files, tokenizer, args, token_cache=token_cache)
+        # the held-out fold
+        val_dataset = load_dataset(["%s.%d" % (args.train_file, i)], tokenizer, args, token_cache=token_cache)
+    logger.info("Token cache: %s", token_cache)
+    global_step, tr_loss = train(args, train_dataset, val_dataset, model, inf_model, tokenizer, logger,
+                                 cross_validate_id=i)
+    logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
+
+    if is_main_process():
+        # Create output directory if needed
+        output_dir = args.output_dir + '-' + str(i)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        logger.info("Saving model checkpoint to %s", output_dir)
+        model_to_save = unwrap_model(model)
+        model_to_save.save_pretrained(output_dir)
+        tokenizer.save_pretrained(output_dir)
+        torch.save(args, os.path.join(output_dir, 'training_args.bin'))
+
+    del model
+    torch.cuda.empty_cache()
+    return global_step, tr_loss
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -282,13 +323,36 @@ def main():
                         help="Path of training file. Do not add fold suffix when cross validate, i.e. use 'data/eval_topics.jsonl' instead of 'data/eval_topics.jsonl.0'")
     parser.add_argument("--valid_file", default=None, type=str, required=True,
                         help="Path to validation file.")
+    parser.add_argument("--pretokenized_dir", default=None, type=str,
+                        help="Keep tokenized training files here and memory-map them (see cqr/pretokenize.py)")
+    parser.add_argument("--dynamic_padding", action='store_true',
+                        help="Pad each batch only to its longest example and batch examples of similar length together")
+    parser.add_argument("--num_workers", default=0, type=int,
+                        help="Number of DataLoader worker processes")
+    parser.add_argument("--tokenize_workers", default=1, type=int,
+                        help="Number of processes tokenizing the training files")
+    parser.add_argument("--token_cache_size", default=100000, type=int,
+                        help="Number of tokenized sentences kept in memory and shared between folds (0 disables)")
+    parser.add_argument("--token_cache_file", default=None, type=str,
+                        help="Load tokenized sentences from this file if it exists and save them back to it")
     parser.add_argument("--cross_validate", action='store_true',
                         help="Set when doing cross validation")
     parser.add_argument("--init_from_multiple_models", action='store_true',
                         help="Set when initialize from different models during cross validation (Model-based+CV)")
+    parser.add_argument("--fold_workers", default=1, type=int,
+                        help="Number of folds trained in parallel processes, at most one per GPU")
 
     parser.add_argument("--per_gpu_train_batch_size", default=4, type=int,
                         help="Batch size per GPU/CPU for training.")
+    parser.add_argument("--precision", default='fp32', choices=PRECISIONS,
+                        help="bf16 runs the forward pass and losses under autocast: less activation memory per "
+                             "example and faster matmuls on hardware with bf16 support")
+    parser.add_argument("--target_logits_only", action='store_true',
+                        help="Run the LM head only at the target positions of the rows that need a rewrite "
+                             "instead of over the whole block")
+    parser.add_argument("--lm_chunk_size", default=0, type=int,
+                        help="With --target_logits_only: run the LM head and loss on this many target positions at "
+                             "a time and recompute them in the backward pass (0 runs them all at once)")
     parser.add_argument('--gradient_accumulation_steps', type=int, default=1,
                         help="Number of updates steps to accumulate before performing a backward/update pass.")
     parser.add_argument("--learning_rate", default=5e-5, type=float,
@@ -307,16 +371,21 @@ def main():
                         help="Linear warmup over warmup_steps.")
     parser.add_argument('--save_steps', type=int, default=50,
                         help="Save checkpoint every X updates steps.")
+    parser.add_argument('--logging_steps', type=int, default=50,
+                        help="Log the loss and accuracy every X updates steps, the only time the training loop waits "
+                             "for the device (0 logs them at the end of every epoch only)")
     parser.add_argument("--local_rank", type=int, default=-1,
-                        help="For distributed training: local_rank")
+                        help="For distributed training: local_rank (torchrun sets LOCAL_RANK instead)")
+    parser.add_argument("--ddp_backend", default=None, choices=['nccl', 'gloo'],
+                        help="Process group backend for distributed training (default: nccl on GPUs, gloo on CPU)")
     parser.add_argument("--no_cuda", action='store_true',
                         help="Avoid using CUDA when available")
     parser.add_argument('--overwrite_output_dir', action='store_true',
                         help="Overwrite the content of the output directory")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
-    parser.add_argument('--n_gpu', type=int, default=2,
-                        help="number of GPUs to use")
+    parser.add_argument('--n_gpu', type=int, default=1,
+                        help="Deprecated: every process trains on one GPU, launch one process per GPU with torchrun")
     parser.add_argument('--mtl', action='store_true',\
                         help="Use this flag for Multi-task learning")
     parser.add_argument('--debug', action="store_true",
@@ -329,44 +398,58 @@ def main():
     parser.add_argument("--toy_data", action="store_true",
                         help="use only 100 datapoints for debugging")
     args = parser.parse_args()
-    args.n_gpu = torch.cuda.device_count() if args.n_gpu < 1 else args.n_gpu
-
-    if args.overwrite_output_dir:
-        if os.path.exists(args.output_dir):
-            shutil.rmtree(args.output_dir)
-    if os.path.exists(args.output_dir) and os.listdir(args.output_dir) and not args.overwrite_output_dir:
-        raise ValueError("Output directory ({}) already exists and is not empty. Use --overwrite_output_dir to overcome.".format(args.output_dir))
-
+    requested_gpus = args.n_gpu
     device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    args.n_gpu = 1 if device.type == 'cuda' else 0
     args.device = device
-
-    # Setup logging
-    os.makedirs(args.output_dir,exist_ok=True)
-    log_file_path = os.path.join(args.output_dir,datetime.now().strftime('MTL_%H_%M_%d_%m_%Y.log'))
+    distributed = setup_distributed(args)
+    check_precision(args.precision, args.device)
+    if distributed and args.cross_validate and args.fold_workers > 1:
+        raise ValueError("--fold_workers cannot be combined with distributed training")
+
+    if is_main_process():
+        if args.overwrite_output_dir:
+            if os.path.exists(args.output_dir):
+                shutil.rmtree(args.output_dir)
+        if os.path.exists(args.output_dir) and os.listdir(args.output_dir) and not args.overwrite_output_dir:
+            raise ValueError("Output directory ({}) already exists and is not empty. Use --overwrite_output_dir to overcome.".format(args.output_dir))
+        os.makedirs(args.output_dir,exist_ok=True)
+    barrier()
+
+    # Setup logging: the main process logs to a file in output_dir, the others only their warnings to stderr
+    log_file_path = None
+    if is_main_process():
+        log_file_path = os.path.join(args.output_dir,datetime.now().strftime('MTL_%H_%M_%d_%m_%Y.log'))
     logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                         datefmt = '%m/%d/%Y %H:%M:%S',
-                        level = logging.INFO,
+                        level = logging.INFO if is_main_process() else logging.WARN,
                         filename=log_file_path)
-    logger.warning("device: %s, n_gpu: %s", device, args.n_gpu)
+    logger.warning("device: %s, n_gpu: %s, distributed: %s, world size: %d", args.device, args.n_gpu, distributed,
+                   world_size())
+    if requested_gpus > 1 and not distributed:
+        logger.warning("--n_gpu %d is ignored: launch with torchrun --nproc_per_node %d to train on several GPUs",
+                       requested_gpus, requested_gpus)
 
     # Set seed
     set_seed(args)
     if args.mtl:
-        config_class, model_class, tokenizer_class = GPT2Config, GPT2DoubleHeadsModel, GPT2Tokenizer
+        config_class, model_class, tokenizer_class = GPT2Config, GPT2DoubleHeadsTargetModel, GPT2Tokenizer
     else:
-        config_class, model_class, tokenizer_class = GPT2Config, GPT2LMHeadModel, GPT2Tokenizer
+        config_class, model_class, tokenizer_class = GPT2Config, GPT2LMHeadTargetModel, GPT2Tokenizer
 
     if not args.cross_validate:
-        config = config_class.from_pretrained(args.model_name_or_path)
-        tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
-        tokenizer.add_special_tokens(special_tokens_dict)
-        model = model_class.from_pretrained(args.model_name_or_path)
+        with local_main_first(args):
+            config = config_class.from_pretrained(args.model_name_or_path)
+            tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
+            tokenizer.add_special_tokens(special_tokens_dict)
+            model = model_class.from_pretrained(args.model_name_or_path)
         model.resize_token_embeddings(len(tokenizer))  # resize
         if args.toy_data:
             print(f"tokenizer stuff: <BOS> = {tokenizer.bos_token_id}, <SEP> = {tokenizer.sep_token_id}, <CLS> = {tokenizer.cls_token_id}")
         model.to(args.device)
         model_config = {'model': model, 'tokenizer': tokenizer}
-        inf_model = InferenceModel(args, model_config)
+        token_cache = build_token_cache(tokenizer, args)
+        inf_model = InferenceModel(args, model_config, token_cache=token_cache)
 	
         if args.block_size <= 0:
             args.block_size = tokenizer.max_len_single_sentence
@@ -374,58 +457,33 @@ def main():
 
         # Training
         logger.info("Training/evaluation parameters %s", args)
-        train_dataset = QueryRewriteDataset([args.train_file], tokenizer, args, debugging=args.toy_data)
-        val_dataset = QueryRewriteDataset([args.valid_file], tokenizer, args, debugging=args.toy_data)
+        with local_main_first(args):
+            train_dataset = load_dataset([args.train_file], tokenizer, args, debugging=args.toy_data, token_cache=token_cache)
+            val_dataset = load_dataset([args.valid_file], tokenizer, args, debugging=args.toy_data, token_cache=token_cache)
+        logger.info("Token cache: %s", token_cache)
+        if is_main_process():
+            save_token_cache(token_cache, args)
         global_step, tr_loss = train(args, train_dataset, val_dataset, model, inf_model, tokenizer, logger)
         logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
 
         # Saving
-        # Create output directory if needed
-        if not os.path.exists(args.output_dir) and args.local_rank in [-1, 0]:
-            os.makedirs(args.output_dir)
+        if is_main_process():
+            # Create output directory if needed
+            if not os.path.exists(args.output_dir):
+                os.makedirs(args.output_dir)
 
-        logger.info("Saving model checkpoint to %s", args.output_dir)
-        model_to_save = model.module if hasattr(model, 'module') else model
-        model_to_save.save_pretrained(args.output_dir)
-        tokenizer.save_pretrained(args.output_dir)
-        torch.save(args, os.path.join(args.output_dir, 'training_args.bin'))
+            logger.info("Saving model checkpoint to %s", args.output_dir)
+            model_to_save = unwrap_model(model)
+            model_to_save.save_pretrained(args.output_dir)
+            tokenizer.save_pretrained(args.output_dir)
+            torch.save(args, os.path.join(args.output_dir, 'training_args.bin'))
 
     else:
         # K-Fold Cross Validation
-        for i in range(NUM_FOLD):
-            logger.info("Training Fold #{}".format(i))
-            suffix = ('-' + str(i)) if args.init_from_multiple_models else ''
-            config = config_class.from_pretrained(args.model_name_or_path + suffix)
-            tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path + suffix)
-            tokenizer.add_special_tokens(special_tokens_dict)
-            model = model_class.from_pretrained(args.model_name_or_path + suffix)
-            model.resize_token_embeddings(len(tokenizer))  # resize
-            model.to(args.device)
-
-            if args.block_size <= 0:
-                args.block_size = tokenizer.max_len_single_sentence
-            args.block_size = min(args.block_size, tokenizer.max_len_single_sentence)
-    
-            logger.info("Training/evaluation parameters %s", args)
-            train_files = ["%s.%d" % (args.train_file, j) for j in range(NUM_FOLD) if j != i]
-            logger.info("train_files: {}".format(train_files))
-            train_dataset = QueryRewriteDataset(train_files, tokenizer, args)
-            global_step, tr_loss = train(args, train_dataset, model, inf_model, tokenizer, logger, cross_validate_id=i)
-            logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
-
-            # Create output directory if needed
-            output_dir = args.output_dir + '-' + str(i)
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-
-            logger.info("Saving model checkpoint to %s", output_dir)
-            model_to_save = model.module if hasattr(model, 'module') else model
-            model_to_save.save_pretrained(output_dir)
-            tokenizer.save_pretrained(output_dir)
-            torch.save(args, os.path.join(output_dir, 'training_args.bin'))
-
-            del model
-            torch.cuda.empty_cache() 
+        fold_files = ["%s.%d" % (args.train_file, j) for j in range(NUM_FOLD)]
+        tokenizer_path = args.model_name_or_path + ('-0' if args.init_from_multiple_models else '')
+        with shared_fold_data(fold_files, tokenizer_path, args):
+            run_folds(train_fold, args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+import json
+import os
+
+
+class PredictionJob:
+    """ Output file of a prediction run, with a sidecar manifest recording how much of each input file is done.
+        Output is flushed to disk every checkpoint_every input items, after which the manifest is atomically
+        replaced with the number of items done and the size of the output at that point. When resuming,
+        output written after the last commit is truncated and the committed items are skipped.
+        With checkpoint_every 0 no manifest is written.
+    """
+
+    def __init__(self, output_file, resume=False, checkpoint_every=1000):
+        self.output_file = output_file
+        self.manifest_file = output_file + '.manifest.json'
+        self.checkpoint_every = checkpoint_every
+        self.pending = 0
+        self.manifest = {'output_bytes': 0, 'input_sizes': {}, 'done': {}, 'complete': False}
+        if resume and os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+            if not os.path.exists(output_file):
+                raise ValueError("Cannot resume: {} is missing".format(output_file))
+            self.fout = open(output_file, 'a')
+            self.fout.truncate(self.manifest['output_bytes'])
+        else:
+            if os.path.exists(self.manifest_file):
+                os.remove(self.manifest_file)
+            self.fout = open(output_file, 'w')
+
+    def skip(self, input_file):
+        """ Number of items of input_file committed by an earlier run """
+        input_size = os.path.getsize(input_file)
+        if self.manifest['input_sizes'].setdefault(input_file, input_size) != input_size:
+            raise ValueError("Cannot resume: {} changed since {} was written".format(input_file, self.output_file))
+        return self.manifest['done'].get(input_file, 0)
+
+    def write(self, input_file, output_lines):
+        """ Write the output lines of the next item of input_file """
+        for line in output_lines:
+            self.fout.write(line + '\n')
+        self.manifest['done'][input_file] = self.manifest['done'].get(input_file, 0) + 1
+        self.pending += 1
+        if self.checkpoint_every > 0 and self.pending >= self.checkpoint_every:
+            self.commit()
+
+    def commit(self):
+        self.fout.flush()
+        self.pending = 0
+        if self.checkpoint_every <= 0:
+            return
+        os.fsync(self.fout.fileno())
+        self.manifest['output_bytes'] = self.fout.tell()
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_file, self.manifest_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # items written so far are complete, so they are committed even when the run fails
+        self.manifest['complete'] = exc_type is None
+        self.commit()
+        self.fout.close()
+
+
+def remove_job(output_file):
+    """ Remove the output file of a finished job and its manifest """
+    for path in [output_file, output_file + '.manifest.json']:
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,87 @@
+import collections
+import queue
+import threading
+
+_END = object()
+
+
+class _StageError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def background(iterable, queue_size=16):
+    """ Iterate over iterable in a daemon thread, at most queue_size items ahead of the consumer.
+        Exceptions raised by the iterable are raised again in the consumer.
+    """
+    items = queue.Queue(maxsize=queue_size)
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            items.put(_StageError(e))
+        else:
+            items.put(_END)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is _END:
+            return
+        if isinstance(item, _StageError):
+            raise item.exception
+        yield item
+
+
+def stream_predictions(inference_model, items, get_inputs, batch_size=1, queue_size=16, finish=None):
+    """ Rewrite the conversations of a stream of items, yielding (item, predictions) in input order.
+        get_inputs(item) returns the (input_sents, session_id) pairs to rewrite for one item; an item may have none.
+        Reading and tokenizing, decoding, and detokenizing each run in their own thread, connected by queues of
+        queue_size items, so memory stays bounded by the queues and the batch in flight, not by the input size.
+        Conversations are batched across items; with batch_size 1 the session id enables the prefix cache.
+        finish(input_sents, pred_ids) turns predicted ids into a prediction, inference_model.finish_prediction
+        by default.
+    """
+    finish = finish or inference_model.finish_prediction
+
+    def tokenized():
+        for item in items:
+            inputs = [(input_sents, session_id, inference_model.get_input_seq(input_sents))
+                      for input_sents, session_id in get_inputs(item)]
+            yield item, inputs
+
+    def decoded():
+        # items whose conversations are not all decoded yet, oldest first: [item, inputs, predicted ids]
+        pending = collections.deque()
+        batch = []  # (predicted ids of the owning item, conversation index, input ids, session id)
+
+        def run_batch():
+            if len(batch) == 1:
+                batch_pred_ids = [inference_model.generate(batch[0][2], session_id=batch[0][3])]
+            else:
+                batch_pred_ids = inference_model.generate_batch([input_ids for _, _, input_ids, _ in batch])
+            for (owner_pred_ids, index, _, _), pred_ids in zip(batch, batch_pred_ids):
+                owner_pred_ids[index] = pred_ids
+            batch.clear()
+
+        def finished():
+            while pending and all(pred_ids is not False for pred_ids in pending[0][2]):
+                yield tuple(pending.popleft())
+
+        for item, inputs in background(tokenized(), queue_size):
+            owner_pred_ids = [False] * len(inputs)  # False until decoded, None when the rewrite is skipped
+            pending.append([item, inputs, owner_pred_ids])
+            for index, (_, session_id, input_ids) in enumerate(inputs):
+                batch.append((owner_pred_ids, index, input_ids, session_id))
+                if len(batch) == batch_size:
+                    run_batch()
+            yield from finished()
+        if batch:
+            run_batch()
+        yield from finished()
+
+    for item, inputs, all_pred_ids in background(decoded(), queue_size):
+        yield item, [finish(input_sents, pred_ids)
+                     for (input_sents, _, _), pred_ids in zip(inputs, all_pred_ids)]
@@ -0,0 +1,53 @@
+import collections
+
+
+def past_nbytes(past):
+    return sum(layer_past.element_size() * layer_past.nelement() for layer_past in past)
+
+
+class PrefixCache:
+    """ Per-session cache of the key/value states of an encoded conversation history.
+        Each session keeps one entry: the token ids of the history up to and including its last <SEP>
+        and the presents for those positions. Least recently used sessions are evicted once the
+        cached tensors exceed max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # session id -> (prefix ids, past, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id, input_ids):
+        """ Return (prefix ids, past) when the cached prefix of this session starts input_ids, else (None, None) """
+        entry = self.entries.get(session_id)
+        if entry is None or input_ids[:len(entry[0])] != entry[0]:
+            self.misses += 1
+            return None, None
+        self.entries.move_to_end(session_id)
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def put(self, session_id, prefix_ids, past):
+        self.pop(session_id)
+        nbytes = past_nbytes(past)
+        if nbytes > self.max_bytes:
+            return
+        self.entries[session_id] = (list(prefix_ids), past, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, _, evicted_nbytes) = self.entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+
+    def pop(self, session_id):
+        entry = self.entries.pop(session_id, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "PrefixCache(sessions=%d, mb=%.1f/%.1f, hits=%d, misses=%d)" % (
+            len(self.entries), self.nbytes / 2 ** 20, self.max_bytes / 2 ** 20, self.hits, self.misses)
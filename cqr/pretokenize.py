@@ -0,0 +1,55 @@
+import argparse
+import logging
+import os
+
+from transformers import GPT2Tokenizer
+
+from cqr.dataset import pretokenized_path, write_pretokenized
+from cqr.utils import NUM_FOLD, special_tokens_dict
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--train_files", type=str, nargs='+', required=True,
+                        help="JSON lines files to tokenize. With --cross_validate, give them without fold suffix.")
+    parser.add_argument("--pretokenized_dir", type=str, required=True,
+                        help="Directory holding the tokenized files, pass the same directory to the trainers")
+    parser.add_argument("--model_name_or_path", default="gpt2-medium", type=str,
+                        help="Model whose tokenizer is used for training")
+    parser.add_argument("--block_size", default=150, type=int,
+                        help="Block size used for training (150 for run_training.py, 200 for mtl_run_training.py)")
+    parser.add_argument("--cross_validate", action='store_true',
+                        help="Tokenize every fold file '<train_file>.<i>'")
+    parser.add_argument('--mtl', action='store_true',
+                        help="Tokenize for the Multi-task learning model")
+    parser.add_argument("--tokenize_workers", default=1, type=int,
+                        help="Number of processes tokenizing the training files")
+    parser.add_argument('--overwrite', action='store_true',
+                        help="Tokenize again even if an up-to-date file exists")
+    args = parser.parse_args()
+
+    logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt = '%m/%d/%Y %H:%M:%S',
+                        level = logging.INFO)
+
+    tokenizer = GPT2Tokenizer.from_pretrained(args.model_name_or_path)
+    tokenizer.add_special_tokens(special_tokens_dict)
+    args.block_size = min(args.block_size, tokenizer.max_len_single_sentence)
+    os.makedirs(args.pretokenized_dir, exist_ok=True)
+
+    filenames = args.train_files
+    if args.cross_validate:
+        filenames = ["%s.%d" % (filename, i) for filename in filenames for i in range(NUM_FOLD)]
+    for filename in filenames:
+        path = pretokenized_path(filename, tokenizer, args)
+        if os.path.exists(path) and not args.overwrite:
+            logger.info("%s is up to date in %s", filename, path)
+            continue
+        write_pretokenized(filename, path, tokenizer, args)
+        logger.info("Tokenized %s into %s", filename, path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+from torch import nn
+from transformers.modeling_utils import Conv1D
+
+from cqr.bundle import skip_weight_init
+from cqr.utils import NUM_FOLD
+
+BLEU_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'multi-bleu-detok.perl')
+
+
+def conv1d_to_linear(model):
+    """ Replace the Conv1D layers of GPT-2 (a linear layer storing its weight transposed) by nn.Linear,
+        the layer type torch's dynamic quantization knows about. Works in place and returns model.
+    """
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                with skip_weight_init():
+                    linear = nn.Linear(in_features, out_features)
+                linear.weight = nn.Parameter(child.weight.detach().t().contiguous(), requires_grad=False)
+                linear.bias = child.bias
+                setattr(module, name, linear)
+    return model
+
+
+def quantize_model(model, inplace=False):
+    """ CPU model with int8 weights: the linear layers (attention, MLP, LM head and MC head) are dynamically
+        quantized, i.e. their activations are quantized on the fly, with one weight scale per output feature,
+        and the embeddings are stored with one scale per row. The LM head no longer shares its weights with
+        the token embeddings.
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    conv1d_to_linear(model.cpu())
+    qconfig_spec = {nn.Linear: torch.ao.quantization.per_channel_dynamic_qconfig,
+                    nn.Embedding: torch.ao.quantization.float_qparams_weight_only_qconfig}
+    return torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
+def model_bytes(model):
+    """ Size of the serialized weights of model, without the causal attention masks (the attn.bias buffers) """
+    buffer = io.BytesIO()
+    torch.save({name: value for name, value in model.state_dict().items() if not name.endswith('attn.bias')}, buffer)
+    return buffer.tell()
+
+
+def bleu(hypotheses, references, bleu_script=BLEU_SCRIPT):
+    """ Corpus BLEU of hypotheses against references, as computed by multi-bleu-detok.perl """
+    with tempfile.NamedTemporaryFile('w', suffix='.ref') as ref_file:
+        ref_file.write(''.join(reference.strip() + '\n' for reference in references))
+        ref_file.flush()
+        result = subprocess.run(['perl', bleu_script, ref_file.name], universal_newlines=True,
+                                input=''.join(hypothesis.strip() + '\n' for hypothesis in hypotheses),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    match = re.match(r'BLEU = ([\d.]+)', result.stdout)
+    return float(match.group(1)) if match else 0.0
+
+
+def rewrite_records(inference_model, records):
+    """ Predictions for records and the average time spent per generated token, in milliseconds """
+    predictions, num_tokens = [], 0
+    start = time.perf_counter()
+    for record in records:
+        pred_ids = inference_model.generate(inference_model.get_input_seq(record['input']))
+        num_tokens += len(pred_ids) + 1 if pred_ids is not None else 1  # the <EOS> step counts too
+        predictions.append(inference_model.finish_prediction(record['input'], pred_ids))
+    return predictions, (time.perf_counter() - start) * 1000 / max(1, num_tokens)
+
+
+def check_fold(args, model_path, input_file):
+    from cqr.inference_model import InferenceModel
+
+    with open(input_file) as fin:
+        records = [json.loads(line) for line in fin]
+    references = [record['target'] for record in records]
+    fold_args = copy.copy(args)
+    fold_args.model_path = model_path
+    results = {}
+    for quantize in [False, True]:
+        fold_args.quantize = quantize
+        with contextlib.redirect_stdout(sys.stderr):
+            inference_model = InferenceModel(fold_args)
+        predictions, ms_per_token = rewrite_records(inference_model, records)
+        results['int8' if quantize else 'fp32'] = {
+            'predictions': predictions,
+            'exact_match': sum(p.strip() == r.strip() for p, r in zip(predictions, references)) / len(records),
+            'bleu': bleu(predictions, references, args.bleu_script),
+            'ms_per_token': ms_per_token,
+            'model_mb': model_bytes(inference_model.model) / 2 ** 20,
+        }
+    fp32, int8 = results['fp32']['predictions'], results['int8']['predictions']
+    agreement = sum(a == b for a, b in zip(fp32, int8)) / len(records)
+    return results, agreement, len(records)
+
+
+def check(args):
+    """ Compare the rewrites of the fp32 model and of its int8 quantization on input_file (or its folds) """
+    if args.cross_validate:
+        folds = [(args.model_path + '-' + str(i), args.input_file + '.' + str(i)) for i in range(NUM_FOLD)]
+    else:
+        folds = [(args.model_path, args.input_file)]
+    print("%-40s %6s %6s %8s %10s %9s %8s" % ("model", "", "EM", "BLEU", "ms/token", "model MB", "agree"))
+    for model_path, input_file in folds:
+        results, agreement, num_records = check_fold(args, model_path, input_file)
+        for name in ['fp32', 'int8']:
+            result = results[name]
+            print("%-40s %6s %6.3f %8.2f %10.2f %9.1f %8s" % (
+                model_path if name == 'fp32' else "", name, result['exact_match'], result['bleu'],
+                result['ms_per_token'], result['model_mb'], "%.3f" % agreement if name == 'int8' else ""))
+        print("%-40s %d records, int8/fp32 latency %.2fx, size %.2fx" % (
+            "", num_records, results['int8']['ms_per_token'] / results['fp32']['ms_per_token'],
+            results['int8']['model_mb'] / results['fp32']['model_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the rewrite quality and speed of the int8 quantized model "
+                                                 "against the fp32 model, on CPU")
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--input_file", type=str, required=True,
+                        help="Records with input and target, e.g. data/eval_topics.jsonl")
+    parser.add_argument("--cross_validate", action='store_true',
+                        help="Check model_path-i on input_file.i for every fold")
+    parser.add_argument('--mtl', action='store_true')
+    parser.add_argument("--length", type=int, default=20)
+    parser.add_argument("--rewrite_threshold", type=float, default=0.0)
+    parser.add_argument("--bleu_script", type=str, default=BLEU_SCRIPT)
+    args = parser.parse_args()
+
+    # greedy decoding, so that the two models are compared on their most likely rewrites
+    args.temperature, args.top_p = 0.0, 0.0
+    args.device = torch.device('cpu')
+    args.toy_data = False
+    check(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import sys
+import time
+import torch
+
+from cqr.inference_model import InferenceModel
+from cqr.utils import set_seed
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q / 100. * len(sorted_values)))]
+
+
+class ServingStats:
+    def __init__(self, window=10000):
+        self.batch_sizes = collections.Counter()
+        self.latencies = collections.deque(maxlen=window)  # seconds, most recent requests only
+        self.num_requests = 0
+
+    def record_batch(self, batch_size, latencies):
+        self.batch_sizes[batch_size] += 1
+        self.latencies.extend(latencies)
+        self.num_requests += batch_size
+
+    def summary(self, queue_depth):
+        latencies = sorted(self.latencies)
+        return {'queue_depth': queue_depth,
+                'num_requests': self.num_requests,
+                'batch_size_histogram': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                'latency_ms_p50': percentile(latencies, 50) * 1000,
+                'latency_ms_p99': percentile(latencies, 99) * 1000}
+
+
+class RequestError(ValueError):
+    """ A request that cannot be rewritten; its message is returned to the client """
+
+
+class MicroBatcher:
+    """ Coalesce concurrent rewrite requests into batches for InferenceModel.generate_batch.
+        Every request is validated and encoded before it is queued, so a bad one fails alone;
+        only a failure of the batch decoding fails all the requests of the batch.
+        A batch is closed when it reaches max_batch_size or when its oldest request has waited max_wait seconds.
+        Decoding runs in a worker thread so that the event loop keeps accepting requests meanwhile.
+    """
+
+    def __init__(self, inference_model, max_batch_size=8, max_wait=0.01):
+        self.inference_model = inference_model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.stats = ServingStats()
+
+    async def rewrite(self, input_sents):
+        if (not isinstance(input_sents, list) or not input_sents
+                or not all(isinstance(sent, str) for sent in input_sents)):
+            raise RequestError("input must be a non-empty list of utterances")
+        input_ids = self.inference_model.get_input_seq(input_sents)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(((input_sents, input_ids), future, time.perf_counter()))
+        return await future
+
+    def decode(self, inputs):
+        batch_pred_ids = self.inference_model.generate_batch([input_ids for _, input_ids in inputs])
+        return [self.inference_model.finish_prediction(input_sents, pred_ids)
+                for (input_sents, _), pred_ids in zip(inputs, batch_pred_ids)]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][2] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                predictions = await loop.run_in_executor(None, self.decode, [inputs for inputs, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            for (_, future, _), prediction in zip(batch, predictions):
+                if not future.done():
+                    future.set_result(prediction)
+            self.stats.record_batch(len(batch), [now - enqueued for _, _, enqueued in batch])
+
+    def summary(self):
+        return self.stats.summary(self.queue.qsize())
+
+
+async def handle_request(batcher, line, write_line):
+    """ One JSON object per line: {"id": ..., "input": [utterances]} -> {"id": ..., "output": rewrite}.
+        {"stats": true} returns the serving statistics instead. Failed requests get {"id": ..., "error": message};
+        responses come in completion order, so clients match them to requests by id.
+    """
+    try:
+        request = json.loads(line)
+    except ValueError:
+        await write_line(json.dumps({'id': None, 'error': "request is not valid JSON"}))
+        return
+    request_id = request.get('id') if isinstance(request, dict) else None
+    try:
+        if not isinstance(request, dict):
+            raise RequestError("request must be a JSON object")
+        if request.get('stats'):
+            response = batcher.summary()
+        else:
+            response = {'id': request_id, 'output': await batcher.rewrite(request.get('input'))}
+    except RequestError as e:
+        response = {'id': request_id, 'error': str(e)}
+    except Exception:
+        logger.exception("Rewriting request %r failed", request_id)
+        response = {'id': request_id, 'error': "rewrite failed"}
+    await write_line(json.dumps(response))
+
+
+async def serve_lines(batcher, read_line, write_line):
+    pending = set()
+    while True:
+        line = await read_line()
+        if not line:
+            break
+        if not line.strip():
+            continue
+        task = asyncio.ensure_future(handle_request(batcher, line, write_line))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.wait(pending)
+
+
+async def serve_stdio(batcher):
+    loop = asyncio.get_running_loop()
+
+    async def read_line():
+        return await loop.run_in_executor(None, sys.stdin.readline)
+
+    async def write_line(text):
+        sys.stdout.write(text + '\n')
+        sys.stdout.flush()
+
+    await serve_lines(batcher, read_line, write_line)
+
+
+async def serve_tcp(batcher, host, port):
+    async def handle_connection(reader, writer):
+        async def read_line():
+            return (await reader.readline()).decode('utf-8')
+
+        async def write_line(text):
+            writer.write((text + '\n').encode('utf-8'))
+            await writer.drain()
+
+        await serve_lines(batcher, read_line, write_line)
+        writer.close()
+
+    server = await asyncio.start_server(handle_connection, host, port)
+    logger.info("Serving JSON lines on %s:%d", host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def log_stats(batcher, interval):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("Serving stats: %s", json.dumps(batcher.summary()))
+
+
+async def serve(args, inference_model):
+    batcher = MicroBatcher(inference_model, max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000.)
+    workers = [asyncio.ensure_future(batcher.run())]
+    if args.stats_interval > 0:
+        workers.append(asyncio.ensure_future(log_stats(batcher, args.stats_interval)))
+    try:
+        if args.port > 0:
+            await serve_tcp(batcher, args.host, args.port)
+        else:
+            await serve_stdio(batcher)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        logger.info("Serving stats: %s", json.dumps(batcher.summary()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", default=None, type=str, required=True,
+                        help="Path to pre-trained model or shortcut name")
+    parser.add_argument("--length", type=int, default=20,
+                        help="Maximum length of output sequence")
+    parser.add_argument("--temperature", type=float, default=0.0,
+                        help="temperature of 0 implies greedy sampling")
+    parser.add_argument("--top_p", type=float, default=0.9)
+    parser.add_argument("--stop_sequences", type=str, nargs='*', default=[],
+                        help="Also stop decoding at any of these strings (they are left out of the rewrite)")
+    parser.add_argument("--sync_every", type=int, default=0,
+                        help="Decode steps between checks for finished rewrites, 0 for 1 on CPU and 8 on GPU")
+    parser.add_argument("--no_cuda", action='store_true',
+                        help="Avoid using CUDA when available")
+    parser.add_argument('--seed', type=int, default=42,
+                        help="random seed for initialization")
+    parser.add_argument('--mtl', action='store_true',
+                        help="Activate MTL setting")
+    parser.add_argument("--rewrite_threshold", type=float, default=0.0,
+                        help="MTL only: return the last utterance unchanged when the classifier's needs_rewrite "
+                             "probability is below this threshold, 0 always decodes")
+    parser.add_argument("--quantize", action='store_true',
+                        help="Run an int8 dynamically quantized copy of the model (CPU only, see cqr/quantization.py)")
+    parser.add_argument('--toy_data', action='store_true')
+    parser.add_argument("--max_batch_size", type=int, default=8,
+                        help="Maximum number of requests decoded together")
+    parser.add_argument("--max_wait_ms", type=float, default=10.0,
+                        help="Maximum time the oldest request of a batch waits for more requests")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=-1,
+                        help="Serve JSON lines over TCP on this port; read stdin and write stdout when < 0")
+    parser.add_argument("--stats_interval", type=float, default=60.0,
+                        help="Seconds between serving stats log lines, 0 to disable")
+    args = parser.parse_args()
+
+    args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    args.n_gpu = torch.cuda.device_count()
+    set_seed(args)
+
+    # stdout carries the responses in stdio mode, so log to stderr
+    logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt = '%m/%d/%Y %H:%M:%S',
+                        level = logging.INFO,
+                        stream=sys.stderr)
+
+    MAX_LENGTH = 100
+    if args.length < 0:
+        args.length = MAX_LENGTH  # avoid infinite loop
+
+    with contextlib.redirect_stdout(sys.stderr):
+        inference_model = InferenceModel(args)
+    asyncio.run(serve(args, inference_model))
+
+
+if __name__ == '__main__':
+    main()
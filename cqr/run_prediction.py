@@ -1,18 +1,73 @@
 
 import argparse
+import copy
+import itertools
 import json
 import logging
 import random
 import torch
 import os
+import shutil
 from tqdm import tqdm, trange
 
+from cqr.fold_runner import run_folds
 from cqr.inference_model import InferenceModel
+from cqr.prediction_job import PredictionJob, remove_job
+from cqr.prediction_pipeline import stream_predictions
+from cqr.token_cache import save_token_cache
 from cqr.utils import NUM_FOLD, set_seed
 
 logger = logging.getLogger(__name__)
 
 
+def record_inputs(record):
+    return [(record['input'], record.get('topic_number'))]
+
+
+def predict_records(inference_model, input_file, job, batch_size=1, queue_size=16):
+    with open(input_file, 'r') as fin:
+        skip = job.skip(input_file)
+        if skip:
+            logger.info("Resuming %s after %d records", input_file, skip)
+        records = (json.loads(line) for line in itertools.islice(fin, skip, None))
+        # with beam search, every record also gets its n-best rewrites
+        finish = inference_model.finish_nbest if inference_model.num_beams > 1 else None
+        for record, (prediction,) in tqdm(stream_predictions(inference_model, records, record_inputs, batch_size,
+                                                             queue_size, finish), desc="Predict"):
+            if finish is not None:
+                record['nbest'] = [{'output': output, 'log_prob': log_prob} for output, log_prob in prediction]
+                prediction = prediction[0][0]
+            record['output'] = prediction
+            job.write(input_file, [json.dumps(record)])
+    if inference_model.prefix_cache is not None:
+        logger.info("%s", inference_model.prefix_cache)
+    logger.info("%s", inference_model.token_cache)
+
+
+def fold_output_file(output_file, i):
+    return "%s.fold-%d" % (output_file, i)
+
+
+def predict_fold(args, i):
+    logger.info("Predict Fold #{}".format(i))
+    fold_args = copy.copy(args)
+    fold_args.model_path = "%s-%d" % (args.model_path, i)
+    inference_model = InferenceModel(fold_args)
+    input_file = "%s.%d" % (args.input_file, i)
+    with PredictionJob(fold_output_file(args.output_file, i), args.resume, args.checkpoint_every) as job:
+        predict_records(inference_model, input_file, job, args.batch_size, args.queue_size)
+
+
+def merge_fold_outputs(output_file, fold_files):
+    """ Concatenate the outputs of the folds in fold order, then remove them """
+    with open(output_file, 'w') as fout:
+        for fold_file in fold_files:
+            with open(fold_file, 'r') as fin:
+                shutil.copyfileobj(fin, fout)
+    for fold_file in fold_files:
+        remove_job(fold_file)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--model_path", default=None, type=str, required=True,
@@ -23,18 +78,54 @@ def main():
                         help="Output json file for predictions")
     parser.add_argument("--cross_validate", action='store_true',
                         help="Set when doing cross validation")
+    parser.add_argument("--fold_workers", type=int, default=1,
+                        help="Number of folds predicted in parallel processes, at most one per GPU")
 
     parser.add_argument("--length", type=int, default=20,
                         help="Maximum length of output sequence")
     parser.add_argument("--temperature", type=float, default=0.0,
                         help="temperature of 0 implies greedy sampling")
     parser.add_argument("--top_p", type=float, default=0.9)
+    parser.add_argument("--num_beams", type=int, default=1,
+                        help="Beam search with this many beams when > 1, ignoring temperature and top_p")
+    parser.add_argument("--num_return_sequences", type=int, default=1,
+                        help="With beam search: number of rewrites written to the nbest field of every record")
+    parser.add_argument("--length_penalty", type=float, default=1.0,
+                        help="With beam search: rewrites are ranked by log prob / length ** length_penalty")
+    parser.add_argument("--no_early_stopping", action='store_true',
+                        help="With beam search: go on until no running beam can beat the finished rewrites, "
+                             "instead of stopping once num_beams rewrites are finished")
+    parser.add_argument("--stop_sequences", type=str, nargs='*', default=[],
+                        help="Also stop decoding at any of these strings (they are left out of the rewrite)")
+    parser.add_argument("--sync_every", type=int, default=0,
+                        help="Decode steps between checks for finished rewrites, 0 for 1 on CPU and 8 on GPU")
+    parser.add_argument("--no_kv_cache", action='store_true',
+                        help="Re-run the full history at every decoding step instead of reusing cached key/values")
+    parser.add_argument("--prefix_cache_mb", type=float, default=0,
+                        help="Memory budget for caching the encoded history of each session between its turns, 0 to disable")
+    parser.add_argument("--token_cache_size", type=int, default=100000,
+                        help="Number of tokenized sentences kept in memory (0 disables)")
+    parser.add_argument("--token_cache_file", type=str, default=None,
+                        help="Load tokenized sentences from this file if it exists and save them back to it")
     parser.add_argument("--no_cuda", action='store_true',
                         help="Avoid using CUDA when available")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="Number of conversations decoded together")
+    parser.add_argument("--queue_size", type=int, default=16,
+                        help="Number of records buffered between reading, decoding and writing")
+    parser.add_argument("--resume", action='store_true',
+                        help="Continue an interrupted run from the last checkpoint in the output file's manifest")
+    parser.add_argument("--checkpoint_every", type=int, default=1000,
+                        help="Flush the output and update its manifest every this many records, 0 to disable")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
     parser.add_argument('--mtl', action='store_true',
                         help="Activate MTL setting")
+    parser.add_argument("--rewrite_threshold", type=float, default=0.0,
+                        help="MTL only: return the last utterance unchanged when the classifier's needs_rewrite "
+                             "probability is below this threshold, 0 always decodes")
+    parser.add_argument("--quantize", action='store_true',
+                        help="Run an int8 dynamically quantized copy of the model (CPU only, see cqr/quantization.py)")
     parser.add_argument('--toy_data',action='store_true')
     args = parser.parse_args()
 
@@ -54,27 +145,13 @@ def main():
         inference_model = InferenceModel(args)
         if not os.path.exists(args.output_file):
             os.makedirs(args.output_file[:args.output_file.rfind('/')], exist_ok=True)
-        with open(args.input_file , 'r') as fin, open(args.output_file, 'w') as fout:
-            for line in tqdm(fin, desc="Predict"):
-                record = json.loads(line)
-                prediction = inference_model.predict(record['input'])
-                record['output'] = prediction
-                fout.write(json.dumps(record) + '\n')
+        with PredictionJob(args.output_file, args.resume, args.checkpoint_every) as job:
+            predict_records(inference_model, args.input_file, job, args.batch_size, args.queue_size)
+        save_token_cache(inference_model.token_cache, args)
     else:
         # K-Fold Cross Validation
-        model_path = args.model_path
-        with open(args.output_file, 'w') as fout:
-            for i in range(NUM_FOLD):
-                logger.info("Predict Fold #{}".format(i))
-                args.model_path = "%s-%d" % (model_path, i)
-                inference_model = InferenceModel(args)
-                input_file = "%s.%d" % (args.input_file, i)
-                with open(input_file , 'r') as fin:
-                    for line in tqdm(fin, desc="Predict"):
-                        record = json.loads(line)
-                        prediction = inference_model.predict(record['input'])
-                        record['output'] = prediction
-                        fout.write(json.dumps(record) + '\n')
+        run_folds(predict_fold, args)
+        merge_fold_outputs(args.output_file, [fold_output_file(args.output_file, i) for i in range(NUM_FOLD)])
     logger.info("Prediction saved to %s", args.output_file)
 
 
@@ -7,34 +7,24 @@ import collections.abc
 import os
 import torch
 
-from torch.utils.data import DataLoader, Dataset, RandomSampler
 from tqdm import tqdm, trange
-from transformers import  GPT2Config, GPT2LMHeadModel, GPT2Tokenizer, AdamW, get_linear_schedule_with_warmup
+from transformers import  GPT2Config, GPT2Tokenizer, AdamW, get_linear_schedule_with_warmup
 
-from cqr.dataset import QueryRewriteDataset
-from cqr.utils import NUM_FOLD, set_seed, special_tokens_dict
+from cqr.dataset import build_dataloader, load_dataset, set_sampler_epoch
+from cqr.distributed import (gradient_sync, is_main_process, local_main_first, setup_distributed, unwrap_model,
+                             world_size, wrap_model)
+from cqr.fold_runner import run_folds, shared_fold_data
+from cqr.modeling import GPT2LMHeadTargetModel, target_positions
+from cqr.token_cache import build_token_cache, save_token_cache, shared_token_cache
+from cqr.train_stats import DeviceSums, StepTimer
+from cqr.utils import NUM_FOLD, PRECISIONS, check_precision, set_seed, special_tokens_dict, training_autocast
 
 logger = logging.getLogger(__name__)
 
 
-def collate_fn(batch_dataset: list):
-    return_tuple = [[], [], [], [], []]
-    for example in batch_dataset:
-        return_tuple[0].append(example.topic_number)
-        return_tuple[1].append(example.query_number)
-        return_tuple[2].append(example.ids)
-        return_tuple[3].append(example.labels)
-        return_tuple[4].append(example.pred_begin_pos)
-    return_tuple[2] = torch.tensor(return_tuple[2])
-    return_tuple[3] = torch.tensor(return_tuple[3])
-    return_tuple = tuple(return_tuple)
-    return return_tuple
-
-
 def train(args, train_dataset, model, tokenizer, logger, cross_validate_id=-1):
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size, collate_fn=collate_fn)
+    train_dataloader = build_dataloader(train_dataset, args, args.train_batch_size, distributed=True)
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -51,49 +41,62 @@ def train(args, train_dataset, model, tokenizer, logger, cross_validate_id=-1):
     optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
     scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=t_total)
 
-    # multi-gpu training (should be after apex fp16 initialization)
-    if args.n_gpu > 1:
-        model = torch.nn.DataParallel(model)
+    # multi-process training: one process per GPU (or CPU worker), launched by torchrun
+    model = wrap_model(model, args)
 
     # Train!
     logger.info("***** Running training *****")
     logger.info("  Num examples = %d", len(train_dataset))
     logger.info("  Num Epochs = %d", args.num_train_epochs)
     logger.info("  Instantaneous batch size per GPU = %d", args.per_gpu_train_batch_size)
-    logger.info("  Total train batch size (w. parallel & accumulation) = %d",
-                   args.train_batch_size * args.gradient_accumulation_steps)
+    logger.info("  Total train batch size (w. distributed & accumulation) = %d",
+                   args.train_batch_size * args.gradient_accumulation_steps * world_size())
     logger.info("  Gradient Accumulation steps = %d", args.gradient_accumulation_steps)
     logger.info("  Total optimization steps = %d", t_total)
 
-    global_step = 0
-    tr_loss, logging_loss = 0.0, 0.0
+    global_step, num_batches = 0, 0
+    logging_loss = 0.0
+    # the loss stays on the device and is only copied to the host every logging_steps updates
+    tr_sums = DeviceSums(['loss'], args.device)
+    timer = StepTimer()
     model.zero_grad()
-    train_iterator = trange(int(args.num_train_epochs), desc="Epoch", disable=args.local_rank not in [-1, 0])
+    train_iterator = trange(int(args.num_train_epochs), desc="Epoch", disable=not is_main_process())
     set_seed(args)  # Added here for reproducibility (even between python 2 and 3)
-    for _ in train_iterator:
-        epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0])
+    for epoch in train_iterator:
+        set_sampler_epoch(train_dataloader, epoch)
+        epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=not is_main_process())
         for step, batch in enumerate(epoch_iterator):
             inputs, labels = (batch[2], batch[3])  # get ids and labels
-            inputs = inputs.to(args.device)  # batch_size * block_size
-            labels = labels.to(args.device)
+            inputs = inputs.to(args.device, non_blocking=True)  # batch_size * block_size
+            labels = labels.to(args.device, non_blocking=True)
+            attention_mask = batch[5].to(args.device, non_blocking=True)
+            if args.target_logits_only:
+                target_index, target_labels = [t.to(args.device, non_blocking=True) for t in target_positions(batch[3])]
+            timer.mark('data')
             model.train()
-            outputs = model(inputs, labels=labels)
-            loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
-
-            del inputs
-            del outputs
-            torch.cuda.empty_cache()
-
-            if args.n_gpu > 1:
-                loss = loss.mean()  # mean() to average on multi-gpu parallel training
-            if args.gradient_accumulation_steps > 1:
-                loss = loss / args.gradient_accumulation_steps
-
-            loss.backward()
-
-            tr_loss += loss.item()
+            # gradients are only all-reduced across processes on the last batch of an update
+            with gradient_sync(model, (step + 1) % args.gradient_accumulation_steps == 0):
+                with training_autocast(args.precision, args.device):
+                    if args.target_logits_only:
+                        outputs = model(inputs, attention_mask=attention_mask, target_index=target_index,
+                                        target_labels=target_labels, chunk_size=args.lm_chunk_size)
+                    else:
+                        outputs = model(inputs, labels=labels, attention_mask=attention_mask)
+                loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
+
+                del inputs
+                del outputs
+
+                if args.gradient_accumulation_steps > 1:
+                    loss = loss / args.gradient_accumulation_steps
+                timer.mark('forward')
+
+                loss.backward()
+
+            tr_sums.add_loss(loss)
             del loss
-            torch.cuda.empty_cache()
+            num_batches += 1
+            timer.mark('backward')
 
             if (step + 1) % args.gradient_accumulation_steps == 0:
                 torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
@@ -101,18 +104,27 @@ def train(args, train_dataset, model, tokenizer, logger, cross_validate_id=-1):
                 scheduler.step()  # Update learning rate schedule
                 model.zero_grad()
                 global_step += 1
+                timer.mark('optimizer')
+
+                if args.logging_steps > 0 and global_step % args.logging_steps == 0 and is_main_process():
+                    tr_loss = tr_sums.values()['loss']
+                    logger.info("Step %d: loss %.4f, learning rate %.3g", global_step,
+                                (tr_loss - logging_loss) / args.logging_steps, scheduler.get_last_lr()[0])
+                    logging_loss = tr_loss
+                    timer.mark('sync')
 
-                if args.save_steps > 0 and global_step % args.save_steps == 0:
+                if args.save_steps > 0 and global_step % args.save_steps == 0 and is_main_process():
                     checkpoint_prefix = 'checkpoint'
                     output_dir = args.output_dir + (('-' + str(cross_validate_id)) if cross_validate_id != -1 else "")
                     # Save model checkpoint
                     output_dir = os.path.join(output_dir, '{}-{}'.format(checkpoint_prefix, global_step))
                     if not os.path.exists(output_dir):
                         os.makedirs(output_dir)
-                    model_to_save = model.module if hasattr(model, 'module') else model
+                    model_to_save = unwrap_model(model)
                     model_to_save.save_pretrained(output_dir)
                     torch.save(args, os.path.join(output_dir, 'training_args.bin'))
                     logger.info("Saving model checkpoint to %s", output_dir)
+                    timer.mark('checkpoint')
 
             if args.max_steps > 0 and global_step > args.max_steps:
                 epoch_iterator.close()
@@ -122,9 +134,55 @@ def train(args, train_dataset, model, tokenizer, logger, cross_validate_id=-1):
             train_iterator.close()
             break
 
+    tr_loss = tr_sums.values()['loss']
+    timer.mark('sync')
+    timer.log_summary(num_batches)
     return global_step, tr_loss / global_step
 
 
+def train_fold(args, i):
+    config_class, model_class, tokenizer_class = GPT2Config, GPT2LMHeadTargetModel, GPT2Tokenizer
+    logger.info("Training Fold #{}".format(i))
+    suffix = ('-' + str(i)) if args.init_from_multiple_models else ''
+    with local_main_first(args):
+        config = config_class.from_pretrained(args.model_name_or_path + suffix)
+        tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path + suffix)
+        tokenizer.add_special_tokens(special_tokens_dict)
+        model = model_class.from_pretrained(args.model_name_or_path + suffix)
+    model.resize_token_embeddings(len(tokenizer))  # resize
+    model.to(args.device)
+
+    if args.block_size <= 0:
+        args.block_size = tokenizer.max_len_single_sentence
+    args.block_size = min(args.block_size, tokenizer.max_len_single_sentence)
+
+    logger.info("Training/evaluation parameters %s", args)
+    train_files = ["%s.%d" % (args.train_file, j) for j in range(NUM_FOLD) if j != i]
+    logger.info("train_files: {}".format(train_files))
+    token_cache = shared_token_cache(tokenizer, args)
+    with local_main_first(args):
+        train_dataset = load_dataset(train_files, tokenizer, args, token_cache=token_cache)
+    logger.info("Token cache: %s", token_cache)
+    global_step, tr_loss = train(args, train_dataset, model, tokenizer, logger, cross_validate_id=i)
+    logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
+
+    if is_main_process():
+        # Create output directory if needed
+        output_dir = args.output_dir + '-' + str(i)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        logger.info("Saving model checkpoint to %s", output_dir)
+        model_to_save = unwrap_model(model)
+        model_to_save.save_pretrained(output_dir)
+        tokenizer.save_pretrained(output_dir)
+        torch.save(args, os.path.join(output_dir, 'training_args.bin'))
+
+    del model
+    torch.cuda.empty_cache()
+    return global_step, tr_loss
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -138,13 +196,36 @@ def main():
                              "Default to the model max input length for single sentence inputs (take into account special tokens).")
     parser.add_argument("--train_file", default=None, type=str, required=True,
                         help="Path of training file. Do not add fold suffix when cross validate, i.e. use 'data/eval_topics.jsonl' instead of 'data/eval_topics.jsonl.0'")
+    parser.add_argument("--pretokenized_dir", default=None, type=str,
+                        help="Keep tokenized training files here and memory-map them (see cqr/pretokenize.py)")
+    parser.add_argument("--dynamic_padding", action='store_true',
+                        help="Pad each batch only to its longest example and batch examples of similar length together")
+    parser.add_argument("--num_workers", default=0, type=int,
+                        help="Number of DataLoader worker processes")
+    parser.add_argument("--tokenize_workers", default=1, type=int,
+                        help="Number of processes tokenizing the training files")
+    parser.add_argument("--token_cache_size", default=100000, type=int,
+                        help="Number of tokenized sentences kept in memory and shared between folds (0 disables)")
+    parser.add_argument("--token_cache_file", default=None, type=str,
+                        help="Load tokenized sentences from this file if it exists and save them back to it")
     parser.add_argument("--cross_validate", action='store_true',
                         help="Set when doing cross validation")
     parser.add_argument("--init_from_multiple_models", action='store_true',
                         help="Set when initialize from different models during cross validation (Model-based+CV)")
+    parser.add_argument("--fold_workers", default=1, type=int,
+                        help="Number of folds trained in parallel processes, at most one per GPU")
 
     parser.add_argument("--per_gpu_train_batch_size", default=4, type=int,
                         help="Batch size per GPU/CPU for training.")
+    parser.add_argument("--precision", default='fp32', choices=PRECISIONS,
+                        help="bf16 runs the forward pass under autocast: less activation memory per example and "
+                             "faster matmuls on hardware with bf16 support")
+    parser.add_argument("--target_logits_only", action='store_true',
+                        help="Run the LM head only at the target positions (after pred_begin_pos) instead of over "
+                             "the whole block")
+    parser.add_argument("--lm_chunk_size", default=0, type=int,
+                        help="With --target_logits_only: run the LM head and loss on this many target positions at "
+                             "a time and recompute them in the backward pass (0 runs them all at once)")
     parser.add_argument('--gradient_accumulation_steps', type=int, default=1,
                         help="Number of updates steps to accumulate before performing a backward/update pass.")
     parser.add_argument("--learning_rate", default=5e-5, type=float,
@@ -163,41 +244,56 @@ def main():
                         help="Linear warmup over warmup_steps.")
     parser.add_argument('--save_steps', type=int, default=50,
                         help="Save checkpoint every X updates steps.")
+    parser.add_argument('--logging_steps', type=int, default=50,
+                        help="Log the loss every X updates steps, the only time the training loop waits for the "
+                             "device (0 logs the average loss at the end only)")
     parser.add_argument("--local_rank", type=int, default=-1,
-                        help="For distributed training: local_rank")
+                        help="For distributed training: local_rank (torchrun sets LOCAL_RANK instead)")
+    parser.add_argument("--ddp_backend", default=None, choices=['nccl', 'gloo'],
+                        help="Process group backend for distributed training (default: nccl on GPUs, gloo on CPU)")
     parser.add_argument("--no_cuda", action='store_true',
                         help="Avoid using CUDA when available")
     parser.add_argument('--overwrite_output_dir', action='store_true',
                         help="Overwrite the content of the output directory")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
-    parser.add_argument('--n_gpu', type=int, default=2,
-                        help="number of GPUs to use")
+    parser.add_argument('--n_gpu', type=int, default=1,
+                        help="Deprecated: every process trains on one GPU, launch one process per GPU with torchrun")
     args = parser.parse_args()
 
     if os.path.exists(args.output_dir) and os.listdir(args.output_dir) and not args.overwrite_output_dir:
         raise ValueError("Output directory ({}) already exists and is not empty. Use --overwrite_output_dir to overcome.".format(args.output_dir))
 
+    requested_gpus = args.n_gpu
     device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
-    args.n_gpu = args.n_gpu
+    args.n_gpu = 1 if device.type == 'cuda' else 0
     args.device = device
+    distributed = setup_distributed(args)
+    check_precision(args.precision, args.device)
+    if distributed and args.cross_validate and args.fold_workers > 1:
+        raise ValueError("--fold_workers cannot be combined with distributed training")
 
     # Setup logging
     logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                         datefmt = '%m/%d/%Y %H:%M:%S',
-                        level = logging.INFO)
-    logger.warning("device: %s, n_gpu: %s", device, args.n_gpu)
+                        level = logging.INFO if is_main_process() else logging.WARN)
+    logger.warning("device: %s, n_gpu: %s, distributed: %s, world size: %d", args.device, args.n_gpu, distributed,
+                   world_size())
+    if requested_gpus > 1 and not distributed:
+        logger.warning("--n_gpu %d is ignored: launch with torchrun --nproc_per_node %d to train on several GPUs",
+                       requested_gpus, requested_gpus)
 
     # Set seed
     set_seed(args)
 
-    config_class, model_class, tokenizer_class = GPT2Config, GPT2LMHeadModel, GPT2Tokenizer
+    config_class, model_class, tokenizer_class = GPT2Config, GPT2LMHeadTargetModel, GPT2Tokenizer
 
     if not args.cross_validate:
-        config = config_class.from_pretrained(args.model_name_or_path)
-        tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
-        tokenizer.add_special_tokens(special_tokens_dict)
-        model = model_class.from_pretrained(args.model_name_or_path)
+        with local_main_first(args):
+            config = config_class.from_pretrained(args.model_name_or_path)
+            tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
+            tokenizer.add_special_tokens(special_tokens_dict)
+            model = model_class.from_pretrained(args.model_name_or_path)
         model.resize_token_embeddings(len(tokenizer))  # resize
         model.to(args.device)
 	
@@ -207,57 +303,33 @@ def main():
 
         # Training
         logger.info("Training/evaluation parameters %s", args)
-        train_dataset = QueryRewriteDataset([args.train_file], tokenizer, args)
+        token_cache = build_token_cache(tokenizer, args)
+        with local_main_first(args):
+            train_dataset = load_dataset([args.train_file], tokenizer, args, token_cache=token_cache)
+        logger.info("Token cache: %s", token_cache)
+        if is_main_process():
+            save_token_cache(token_cache, args)
         global_step, tr_loss = train(args, train_dataset, model, tokenizer, logger)
         logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
 
         # Saving
-        # Create output directory if needed
-        if not os.path.exists(args.output_dir) and args.local_rank in [-1, 0]:
-            os.makedirs(args.output_dir)
+        if is_main_process():
+            # Create output directory if needed
+            if not os.path.exists(args.output_dir):
+                os.makedirs(args.output_dir)
 
-        logger.info("Saving model checkpoint to %s", args.output_dir)
-        model_to_save = model.module if hasattr(model, 'module') else model
-        model_to_save.save_pretrained(args.output_dir)
-        tokenizer.save_pretrained(args.output_dir)
-        torch.save(args, os.path.join(args.output_dir, 'training_args.bin'))
+            logger.info("Saving model checkpoint to %s", args.output_dir)
+            model_to_save = unwrap_model(model)
+            model_to_save.save_pretrained(args.output_dir)
+            tokenizer.save_pretrained(args.output_dir)
+            torch.save(args, os.path.join(args.output_dir, 'training_args.bin'))
 
     else:
         # K-Fold Cross Validation
-        for i in range(NUM_FOLD):
-            logger.info("Training Fold #{}".format(i))
-            suffix = ('-' + str(i)) if args.init_from_multiple_models else ''
-            config = config_class.from_pretrained(args.model_name_or_path + suffix)
-            tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path + suffix)
-            tokenizer.add_special_tokens(special_tokens_dict)
-            model = model_class.from_pretrained(args.model_name_or_path + suffix)
-            model.resize_token_embeddings(len(tokenizer))  # resize
-            model.to(args.device)
-
-            if args.block_size <= 0:
-                args.block_size = tokenizer.max_len_single_sentence
-            args.block_size = min(args.block_size, tokenizer.max_len_single_sentence)
-    
-            logger.info("Training/evaluation parameters %s", args)
-            train_files = ["%s.%d" % (args.train_file, j) for j in range(NUM_FOLD) if j != i]
-            logger.info("train_files: {}".format(train_files))
-            train_dataset = QueryRewriteDataset(train_files, tokenizer, args)
-            global_step, tr_loss = train(args, train_dataset, model, tokenizer, logger, cross_validate_id=i)
-            logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
-
-            # Create output directory if needed
-            output_dir = args.output_dir + '-' + str(i)
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-
-            logger.info("Saving model checkpoint to %s", output_dir)
-            model_to_save = model.module if hasattr(model, 'module') else model
-            model_to_save.save_pretrained(output_dir)
-            tokenizer.save_pretrained(output_dir)
-            torch.save(args, os.path.join(output_dir, 'training_args.bin'))
-
-            del model
-            torch.cuda.empty_cache() 
+        fold_files = ["%s.%d" % (args.train_file, j) for j in range(NUM_FOLD)]
+        tokenizer_path = args.model_name_or_path + ('-0' if args.init_from_multiple_models else '')
+        with shared_fold_data(fold_files, tokenizer_path, args):
+            run_folds(train_fold, args)
 
 
 if __name__ == "__main__":
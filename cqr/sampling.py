@@ -0,0 +1,69 @@
+import torch
+from torch.nn import functional as F
+
+# used by the TorchScript runtime too, so this module must not import transformers
+
+# tokens ranked per row by sample_top_p, enough for the nucleus of a fine-tuned rewriter
+MAX_CANDIDATES = 256
+
+
+def top_p_filtering(logits, top_p=0.0, filter_value=-float('Inf')):
+    """ Filter a distribution of logits using nucleus (top-p) filtering
+        Args:
+            logits: logits distribution shape (batch size x vocabulary size)
+            top_p > 0.0: keep the top tokens with cumulative probability >= top_p (nucleus filtering).
+                Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
+        From: https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317
+    """
+    if top_p > 0.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+
+        # Remove tokens with cumulative probability above the threshold
+        sorted_indices_to_remove = cumulative_probs > top_p
+        # Shift the indices to the right to keep also the first token above the threshold
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = 0
+
+        # scatter sorted tensors to original indexing
+        indices_to_remove = sorted_indices_to_remove.scatter(dim=1, index=sorted_indices, src=sorted_indices_to_remove)
+        logits[indices_to_remove] = filter_value
+    return logits
+
+
+def sample_next_token(next_token_logits, temperature=0.0, top_p=0.0, max_candidates=MAX_CANDIDATES):
+    """ Next token of every row (batch size x 1): the most likely one when temperature is 0, otherwise sampled
+        from the top-p filtered distribution at that temperature
+    """
+    if temperature == 0:
+        # greedy: the nucleus always contains the most likely token, so there is nothing to filter
+        return torch.argmax(next_token_logits, dim=-1).unsqueeze(-1)
+    next_token_logits = next_token_logits / temperature
+    if top_p <= 0.0:
+        return torch.multinomial(F.softmax(next_token_logits, dim=-1), num_samples=1)
+    return sample_top_p(next_token_logits, top_p, max_candidates)
+
+
+def sample_top_p(logits, top_p, max_candidates=MAX_CANDIDATES):
+    """ Sample the next token of every row from its nucleus, like top_p_filtering followed by a multinomial draw,
+        without sorting the vocabulary: only the max_candidates most likely tokens are ranked, with their
+        probabilities normalised over the whole vocabulary. Rows whose nucleus is larger than that fall back
+        to top_p_filtering.
+    """
+    num_candidates = min(max_candidates, logits.size(-1))
+    top_logits, top_indices = torch.topk(logits, num_candidates, dim=-1)
+    probs = torch.exp(top_logits - torch.logsumexp(logits, dim=-1, keepdim=True))
+    cumulative_probs = torch.cumsum(probs, dim=-1)
+
+    # Remove tokens with cumulative probability above the threshold, keeping the first token above it
+    candidates_to_remove = cumulative_probs > top_p
+    candidates_to_remove[..., 1:] = candidates_to_remove[..., :-1].clone()
+    candidates_to_remove[..., 0] = 0
+    next_token = top_indices.gather(-1, torch.multinomial(probs.masked_fill(candidates_to_remove, 0.0), num_samples=1))
+
+    if num_candidates < logits.size(-1):
+        incomplete = (cumulative_probs[:, -1] < top_p).nonzero().squeeze(-1)
+        if incomplete.numel() > 0:
+            filtered_logits = top_p_filtering(logits.index_select(0, incomplete), top_p=top_p)
+            next_token[incomplete] = torch.multinomial(F.softmax(filtered_logits, dim=-1), num_samples=1)
+    return next_token
@@ -0,0 +1,54 @@
+import torch
+
+# used by the TorchScript runtime too, so this module must not import transformers
+
+
+def default_sync_every(device):
+    """ Decode steps between checks for finished rows. Checking copies to the host: that costs nothing on CPU
+        but stalls a GPU, where a few wasted steps on finished rows are cheaper.
+    """
+    return 8 if torch.device(device).type == 'cuda' else 1
+
+
+class StopCriteria:
+    """ Tracks on the device when the rows of a batch stop decoding: at <EOS>, at the end of one of
+        stop_sequences (lists of token ids, dropped from the output like <EOS>) or after max_length tokens.
+        Generated tokens stay on the device until finished_ids, so the decode loop only has to copy to the
+        host to check which rows are done.
+    """
+
+    def __init__(self, batch_size, eos_id, max_length, stop_sequences=(), device='cpu'):
+        self.eos_id = eos_id
+        self.max_length = max_length
+        self.stop_sequences = [torch.tensor(ids, dtype=torch.long, device=device) for ids in stop_sequences if ids]
+        self.tokens = torch.full((batch_size, max_length), eos_id, dtype=torch.long, device=device)
+        self.lengths = torch.full((batch_size,), max_length, dtype=torch.long, device=device)
+        self.finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        self.num_steps = 0
+
+    def update(self, next_token, rows):
+        """ Record the tokens (len(rows) x 1) generated this step for the batch rows with indices rows.
+            Tokens of rows that already finished are ignored.
+        """
+        step = self.num_steps
+        tokens = next_token.view(-1)
+        self.tokens[rows, step] = tokens
+        stop_lengths = torch.where(tokens == self.eos_id, step, self.max_length)
+        for stop_sequence in self.stop_sequences:
+            start = step + 1 - len(stop_sequence)
+            if start >= 0:
+                matches = (self.tokens[rows, start:step + 1] == stop_sequence).all(dim=-1)
+                stop_lengths = torch.where(matches, stop_lengths.clamp(max=start), stop_lengths)
+        finished = self.finished[rows]
+        newly_finished = ~finished & (stop_lengths < self.max_length)
+        self.lengths[rows] = torch.where(newly_finished, stop_lengths, self.lengths[rows])
+        self.finished[rows] = finished | newly_finished
+        self.num_steps += 1
+
+    def finished_rows(self, rows):
+        """ Whether each of the batch rows with indices rows is done (copies to the host) """
+        return self.finished.index_select(0, rows).tolist()
+
+    def finished_ids(self):
+        """ Generated token ids of every row, without the token or sequence that stopped it """
+        return [tokens[:length] for tokens, length in zip(self.tokens[:, :self.num_steps].tolist(), self.lengths.tolist())]
@@ -0,0 +1,151 @@
+import collections
+import json
+import os
+import tempfile
+
+from cqr.utils import tokenizer_hash
+
+
+class SentenceTokenCache:
+    """ Bounded LRU map from sentences to token ids, shared by dataset construction and InferenceModel.
+        Conversation histories repeat heavily (turn k appears in every later turn of its topic), so most
+        sentences are looked up many times. It can be saved to and loaded from a JSON file between runs;
+        entries are only reused with the tokenizer they were built with.
+    """
+
+    def __init__(self, tokenizer, max_size=100000):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.tokenizer = None
+        self.tokenizer_hash = None
+        self.bind(tokenizer)
+
+    def bind(self, tokenizer):
+        """ Use tokenizer from now on; cached entries are dropped if it tokenizes differently """
+        new_hash = tokenizer_hash(tokenizer)
+        if new_hash != self.tokenizer_hash:
+            self.entries.clear()
+        self.tokenizer, self.tokenizer_hash = tokenizer, new_hash
+
+    def get(self, sent):
+        ids = self.entries.get(sent)
+        if ids is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(sent)
+        self.hits += 1
+        return ids
+
+    def put(self, sent, ids):
+        if self.max_size <= 0:
+            return
+        self.entries[sent] = ids
+        self.entries.move_to_end(sent)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def encode(self, sent):
+        ids = self.get(sent)
+        if ids is None:
+            ids = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(sent))
+            self.put(sent, ids)
+        return ids
+
+    def state(self):
+        """ What save writes: the tokenizer hash and the entries, least recently used first """
+        return {'tokenizer_hash': self.tokenizer_hash, 'entries': list(self.entries.items())}
+
+    def save(self, path):
+        write_token_cache_state(self.state(), path)
+
+    def load(self, path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data['tokenizer_hash'] != self.tokenizer_hash:
+            return
+        for sent, ids in data['entries']:
+            self.put(sent, ids)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "SentenceTokenCache(size=%d/%d, hits=%d, misses=%d)" % (
+            len(self.entries), self.max_size, self.hits, self.misses)
+
+
+def build_token_cache(tokenizer, args):
+    token_cache = SentenceTokenCache(tokenizer, getattr(args, 'token_cache_size', 100000))
+    token_cache_file = getattr(args, 'token_cache_file', None)
+    if token_cache_file and os.path.exists(token_cache_file):
+        token_cache.load(token_cache_file)
+    return token_cache
+
+
+def write_token_cache_state(state, path):
+    # a temporary file of its own next to path, so that concurrent writers never rename each other's files
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path),
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        # mkstemp creates the file readable by its owner only; give it the permissions of a file created by open
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def merge_token_cache_states(states, max_size):
+    """ One state (see SentenceTokenCache.state) with the entries of several, e.g. of the fold workers of a cross
+        validation run. Later states count as more recently used; states of another tokenizer than the first are
+        left out.
+    """
+    tokenizer_hash = states[0]['tokenizer_hash']
+    entries = collections.OrderedDict()
+    for state in states:
+        if state['tokenizer_hash'] != tokenizer_hash:
+            continue
+        for sent, ids in state['entries']:
+            entries[sent] = ids
+            entries.move_to_end(sent)
+    entries = list(entries.items())
+    return {'tokenizer_hash': tokenizer_hash, 'entries': entries[max(len(entries) - max_size, 0):]}
+
+
+def save_token_cache(token_cache, args):
+    token_cache_file = getattr(args, 'token_cache_file', None)
+    if token_cache_file:
+        token_cache.save(token_cache_file)
+
+
+def save_token_cache_states(states, args):
+    """ Save the merged token caches of several processes, which must not each write args.token_cache_file """
+    token_cache_file = getattr(args, 'token_cache_file', None)
+    states = [state for state in states if state is not None]
+    if token_cache_file and states:
+        write_token_cache_state(merge_token_cache_states(states, getattr(args, 'token_cache_size', 100000)),
+                                token_cache_file)
+
+
+_shared_token_cache = None
+
+
+def shared_token_cache(tokenizer, args):
+    """ The token cache of this process, e.g. shared by the folds of a cross validation run """
+    global _shared_token_cache
+    if _shared_token_cache is None:
+        _shared_token_cache = build_token_cache(tokenizer, args)
+    else:
+        _shared_token_cache.bind(tokenizer)
+    return _shared_token_cache
+
+
+def shared_token_cache_state():
+    """ The state of the token cache of this process, None if it has none """
+    return _shared_token_cache.state() if _shared_token_cache is not None else None
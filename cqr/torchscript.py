@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import warnings
+
+import torch
+from torch import nn
+from transformers import GPT2DoubleHeadsModel, GPT2LMHeadModel, GPT2Tokenizer
+
+from cqr.modeling import transformer_forward
+from cqr.quantization import quantize_model
+from cqr.torchscript_runtime import PREFILL_FILE, RUNTIME_FILE, STEP_FILE
+from cqr.utils import special_tokens_dict
+
+
+class Prefill(nn.Module):
+    """ Encode left-padded histories (see InferenceModel.generate_batch). Returns the logits of every row's next
+        token, the presents and, for the MTL model, the classifier logits at <CLS> (the second to last position).
+    """
+
+    def __init__(self, model):
+        super(Prefill, self).__init__()
+        self.transformer = model.transformer
+        self.lm_head = model.lm_head
+        self.multiple_choice_head = getattr(model, 'multiple_choice_head', None)
+
+    def forward(self, input_ids, attention_mask, position_ids):
+        hidden_states, presents = transformer_forward(self.transformer, input_ids, attention_mask=attention_mask,
+                                                      position_ids=position_ids)
+        logits = self.lm_head(hidden_states[:, -1, :])
+        if self.multiple_choice_head is None:
+            return logits, presents
+        mc_logits = self.multiple_choice_head(hidden_states[:, -2:-1, :], torch.zeros_like(input_ids[:, 0]))
+        return logits, presents, mc_logits
+
+
+class Step(nn.Module):
+    """ Decode one token per row given the presents of the previous steps: next token logits and the new presents """
+
+    def __init__(self, model):
+        super(Step, self).__init__()
+        self.transformer = model.transformer
+        self.lm_head = model.lm_head
+
+    def forward(self, input_ids, past, attention_mask, position_ids):
+        hidden_states, presents = transformer_forward(self.transformer, input_ids, past=past,
+                                                      attention_mask=attention_mask, position_ids=position_ids)
+        return self.lm_head(hidden_states[:, -1, :]), presents
+
+
+def example_inputs(batch_size, length, pad_length, vocab_size):
+    """ Prefill inputs of left-padded rows, the first one padded with pad_length positions """
+    input_ids = torch.randint(vocab_size, (batch_size, length), dtype=torch.long)
+    attention_mask = torch.ones(batch_size, length, dtype=torch.long)
+    attention_mask[0, :pad_length] = 0
+    position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+    return input_ids, attention_mask, position_ids
+
+
+def step_inputs(prefill, inputs):
+    """ Step inputs following the prefill of inputs """
+    input_ids, attention_mask, position_ids = inputs
+    with torch.no_grad():
+        past = prefill(*inputs)[1]
+    attention_mask = torch.cat((attention_mask, attention_mask.new_ones((input_ids.size(0), 1))), dim=1)
+    return input_ids[:, -1:].contiguous(), past, attention_mask, position_ids[:, -1:] + 1
+
+
+def trace(model):
+    """ Trace the prefill and the decode step of model. Each trace is checked on inputs of another batch size and
+        length than the ones it was traced with, which fails if the graph captured a shape as a constant.
+    """
+    vocab_size = model.config.vocab_size
+    inputs = example_inputs(2, 7, 3, vocab_size)
+    check_inputs = example_inputs(3, 12, 5, vocab_size)
+    prefill = Prefill(model).eval()
+    step = Step(model).eval()
+    with torch.no_grad(), warnings.catch_warnings():
+        # the attention scale, from the head size, is the one value the trace keeps as a constant
+        warnings.filterwarnings('ignore', category=torch.jit.TracerWarning)
+        traced_prefill = torch.jit.trace(prefill, inputs, check_inputs=[check_inputs])
+        traced_step = torch.jit.trace(step, step_inputs(prefill, inputs),
+                                      check_inputs=[step_inputs(prefill, check_inputs)])
+    return traced_prefill, traced_step
+
+
+def export_traced(model_path, output_dir, mtl=False, generation=None, quantize=False):
+    """ Write the traced prefill and step of the model in model_path to output_dir, with the tokenizer files and
+        runtime.json, for TracedRewriter
+    """
+    model_class = GPT2DoubleHeadsModel if mtl else GPT2LMHeadModel
+    tokenizer = GPT2Tokenizer.from_pretrained(model_path)
+    tokenizer.add_special_tokens(special_tokens_dict)
+    model = model_class.from_pretrained(model_path)
+    model.eval()
+    if quantize:
+        model = quantize_model(model, inplace=True)
+    traced_prefill, traced_step = trace(model)
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer.save_pretrained(output_dir)
+    traced_prefill.save(os.path.join(output_dir, PREFILL_FILE))
+    traced_step.save(os.path.join(output_dir, STEP_FILE))
+    config = {
+        'mtl': mtl,
+        'n_positions': model.config.n_positions,
+        'special_tokens': special_tokens_dict,
+        'generation': generation or {},
+        'quantize': quantize,
+    }
+    with open(os.path.join(output_dir, RUNTIME_FILE), 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the traced prefill and decode step of a model for "
+                                                 "cqr/torchscript_runtime.py")
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument('--mtl', action='store_true')
+    parser.add_argument("--quantize", action='store_true',
+                        help="Trace the int8 dynamically quantized model (CPU only)")
+    parser.add_argument("--length", type=int, default=20,
+                        help="Maximum length of output sequence")
+    parser.add_argument("--temperature", type=float, default=0.0,
+                        help="temperature of 0 implies greedy sampling")
+    parser.add_argument("--top_p", type=float, default=0.9)
+    parser.add_argument("--rewrite_threshold", type=float, default=0.0,
+                        help="MTL only: return the last utterance unchanged when the classifier's "
+                             "needs_rewrite probability is below this threshold, 0 always decodes")
+    parser.add_argument("--stop_sequences", type=str, nargs='*', default=[],
+                        help="Also stop decoding at any of these strings (they are left out of the rewrite)")
+    parser.add_argument("--sync_every", type=int, default=0,
+                        help="Decode steps between checks for finished rewrites, 0 for 1 on CPU and 8 on GPU")
+    args = parser.parse_args()
+
+    generation = {'length': args.length, 'temperature': args.temperature, 'top_p': args.top_p,
+                  'rewrite_threshold': args.rewrite_threshold, 'stop_sequences': args.stop_sequences,
+                  'sync_every': args.sync_every}
+    export_traced(args.model_path, args.output_dir, args.mtl, generation, args.quantize)
+
+
+if __name__ == '__main__':
+    main()
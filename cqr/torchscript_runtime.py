@@ -0,0 +1,138 @@
+import json
+import os
+
+import torch
+from torch.nn import functional as F
+
+from cqr.bpe import BPETokenizer
+from cqr.sampling import sample_next_token
+from cqr.stopping import StopCriteria, default_sync_every
+
+# this module must not import transformers (see cqr/torchscript.py for the export)
+
+PREFILL_FILE = 'prefill.pt'
+STEP_FILE = 'step.pt'
+RUNTIME_FILE = 'runtime.json'
+DEFAULT_GENERATION = {'length': 20, 'temperature': 0.0, 'top_p': 0.9, 'rewrite_threshold': 0.0, 'stop_sequences': [],
+                      'sync_every': 0}
+
+
+def to_list(tensor):
+    return tensor.detach().cpu().tolist()
+
+
+class TracedRewriter:
+    """ Rewrites with the traced prefill and decode step of a model exported by cqr/torchscript.py, without
+        transformers. Decodes like InferenceModel.generate_batch and has the same predict / predict_batch /
+        get_input_seq / generate / finish_prediction interface. Keyword arguments override the generation
+        settings of the export.
+    """
+
+    def __init__(self, export_dir, device='cpu', **generation):
+        with open(os.path.join(export_dir, RUNTIME_FILE)) as f:
+            config = json.load(f)
+        self.device = torch.device(device)
+        self.tokenizer = BPETokenizer(export_dir)
+        self.prefill = torch.jit.load(os.path.join(export_dir, PREFILL_FILE), map_location=self.device)
+        self.step = torch.jit.load(os.path.join(export_dir, STEP_FILE), map_location=self.device)
+
+        self.mtl = config['mtl']
+        special_tokens = config['special_tokens']
+        self.sep_id, self.pad_id, self.bos_id, self.eos_id, self.cls_id = [
+            self.tokenizer.token_to_id(special_tokens[name])
+            for name in ['sep_token', 'pad_token', 'bos_token', 'eos_token', 'cls_token']]
+        self.special_ids = {self.sep_id, self.pad_id, self.bos_id, self.eos_id}
+        if self.mtl:
+            self.special_ids.add(self.cls_id)
+
+        settings = dict(DEFAULT_GENERATION)
+        settings.update(config['generation'])
+        settings.update(generation)
+        self.length = min(settings['length'], config['n_positions'])
+        self.temperature = settings['temperature']
+        self.top_p = settings['top_p']
+        self.rewrite_threshold = settings['rewrite_threshold'] if self.mtl else 0.0
+        self.stop_sequences = [self.tokenizer.encode(text) for text in settings['stop_sequences']]
+        self.sync_every = settings['sync_every'] or default_sync_every(self.device)
+
+    def get_input_seq(self, input_sents):
+        inputs = []
+        for sent in input_sents:
+            inputs.extend(self.tokenizer.encode(sent))
+            inputs.append(self.sep_id)
+        inputs.pop()
+        if self.mtl:
+            inputs.append(self.cls_id)
+        inputs.append(self.bos_id)
+        return inputs
+
+    def predict(self, input_sents, session_id=None):
+        return self.finish_prediction(input_sents, self.generate(self.get_input_seq(input_sents)))
+
+    def predict_batch(self, list_of_input_sents):
+        batch_pred_ids = self.generate_batch([self.get_input_seq(input_sents) for input_sents in list_of_input_sents])
+        return [self.finish_prediction(input_sents, pred_ids)
+                for input_sents, pred_ids in zip(list_of_input_sents, batch_pred_ids)]
+
+    def finish_prediction(self, input_sents, pred_ids):
+        if pred_ids is None:
+            return input_sents[-1]
+        return self.tokenizer.decode([token_id for token_id in pred_ids if token_id not in self.special_ids])
+
+    def generate(self, input_ids, session_id=None):
+        return self.generate_batch([input_ids])[0]
+
+    def needs_rewrite_probs(self, mc_logits):
+        if mc_logits.dim() > 1 and mc_logits.size(-1) > 1:
+            return F.softmax(mc_logits, dim=-1)[:, 1]
+        return torch.sigmoid(mc_logits.view(-1))
+
+    def generate_batch(self, batch_ids):
+        """ Token ids predicted for every row of batch_ids, None for rows the MTL classifier skips """
+        max_length = max(len(ids) for ids in batch_ids)
+        input_ids = torch.tensor([[self.pad_id] * (max_length - len(ids)) + ids for ids in batch_ids],
+                                 dtype=torch.long, device=self.device)
+        attention_mask = torch.tensor([[0] * (max_length - len(ids)) + [1] * len(ids) for ids in batch_ids],
+                                      dtype=torch.long, device=self.device)
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+
+        stop = StopCriteria(len(batch_ids), self.eos_id, self.length, self.stop_sequences, self.device)
+        skipped = set()
+        rows = torch.arange(len(batch_ids), device=self.device)
+        with torch.no_grad():
+            outputs = self.prefill(input_ids, attention_mask, position_ids)
+            logits, past = outputs[0], outputs[1]
+            if self.rewrite_threshold > 0:
+                probs = to_list(self.needs_rewrite_probs(outputs[2]))
+                keep = [row for row, prob in enumerate(probs) if prob >= self.rewrite_threshold]
+                skipped.update(row for row, prob in enumerate(probs) if prob < self.rewrite_threshold)
+                if len(keep) < len(batch_ids):
+                    index = torch.tensor(keep, dtype=torch.long, device=self.device)
+                    logits = logits.index_select(0, index)
+                    past = tuple(layer_past.index_select(1, index) for layer_past in past)
+                    attention_mask = attention_mask.index_select(0, index)
+                    position_ids = position_ids.index_select(0, index)
+                    rows = index
+
+            for step in range(self.length if len(rows) > 0 else 0):
+                next_token = sample_next_token(logits, self.temperature, self.top_p)
+                stop.update(next_token, rows)
+                if step == self.length - 1:
+                    break
+                if (step + 1) % self.sync_every == 0:
+                    finished = stop.finished_rows(rows)
+                    if all(finished):
+                        break
+                    if any(finished):
+                        index = torch.tensor([row for row, done in enumerate(finished) if not done],
+                                             dtype=torch.long, device=self.device)
+                        past = tuple(layer_past.index_select(1, index) for layer_past in past)
+                        next_token = next_token.index_select(0, index)
+                        attention_mask = attention_mask.index_select(0, index)
+                        position_ids = position_ids.index_select(0, index)
+                        rows = rows.index_select(0, index)
+                attention_mask = torch.cat((attention_mask, attention_mask.new_ones((len(rows), 1))), dim=1)
+                position_ids = position_ids[:, -1:] + 1
+                logits, past = self.step(next_token, past, attention_mask, position_ids)
+
+        return [None if row in skipped else ids for row, ids in enumerate(stop.finished_ids())]
@@ -0,0 +1,66 @@
+import collections
+import logging
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceSums:
+    """ Running sums of per-step values (0-dim tensors) kept on the training device, so that adding to them does
+        not wait for the step to finish. values() copies them all to the host at once, normally only at logging
+        intervals. Losses added with add_loss are checked for NaN there too: NaN steps are counted in 'nan_steps'
+        instead of summed, and a warning is logged when new ones show up.
+    """
+
+    def __init__(self, names, device):
+        self.names = list(names) + ['nan_steps']
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.sums = torch.zeros(len(self.names), dtype=torch.float64, device=device)
+        self.nan_steps_seen = 0
+
+    def add(self, name, value):
+        self.sums[self.index[name]] += value.detach()
+
+    def add_loss(self, loss, name='loss'):
+        loss = loss.detach()
+        is_nan = torch.isnan(loss)
+        self.sums[self.index[name]] += torch.where(is_nan, torch.zeros_like(loss), loss)
+        self.sums[self.index['nan_steps']] += is_nan
+
+    def values(self):
+        values = dict(zip(self.names, self.sums.tolist()))
+        if values['nan_steps'] > self.nan_steps_seen:
+            logger.warning("NaN loss in %d more steps (%d in total), left out of the loss",
+                           values['nan_steps'] - self.nan_steps_seen, values['nan_steps'])
+            self.nan_steps_seen = values['nan_steps']
+        return values
+
+    def reset(self):
+        self.sums.zero_()
+        self.nan_steps_seen = 0
+
+
+class StepTimer:
+    """ Host wall time spent in each phase of the training loop, e.g. data, forward, backward, optimizer, sync.
+        Kernels run asynchronously on a GPU, so the time the host waits for them is charged to the phase that
+        waits: sync when the loop only copies to the host at logging intervals.
+    """
+
+    def __init__(self):
+        self.totals = collections.OrderedDict()
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        """ Charge the time since the previous mark to phase """
+        now = time.perf_counter()
+        self.totals[phase] = self.totals.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def log_summary(self, num_batches):
+        total = sum(self.totals.values())
+        logger.info("Step time breakdown over %d batches (%.1f ms per batch): %s", num_batches,
+                    total / max(num_batches, 1) * 1000,
+                    ", ".join("%s %.2fs (%.1f%%)" % (phase, seconds, seconds / max(total, 1e-9) * 100)
+                              for phase, seconds in self.totals.items()))
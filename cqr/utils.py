@@ -1,4 +1,5 @@
 
+import hashlib
 import random
 import torch
 import numpy as np
@@ -15,6 +16,34 @@ def set_seed(args):
     if args.n_gpu > 0:
         torch.cuda.manual_seed_all(args.seed)
 
+PRECISIONS = ['fp32', 'bf16']
+
+def training_autocast(precision, device):
+    """ Autocast for the forward pass and loss of a training step: matmuls run in bf16 while losses and
+        reductions stay in fp32. bf16 has the exponent range of fp32, so unlike fp16 it needs no loss scaling.
+    """
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+def check_precision(precision, device):
+    if precision == 'bf16' and device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+        raise ValueError("--precision bf16 is not supported by %s" % torch.cuda.get_device_name(device))
+
+def tokenizer_hash(tokenizer):
+    """ Hash of the vocabulary, merges and special tokens of tokenizer. It is computed once per tokenizer and kept
+        on it, and computed again only once tokens are added or the special tokens change.
+    """
+    key = (len(tokenizer), tuple(tokenizer.all_special_ids))
+    cached = getattr(tokenizer, '_cqr_hash', None)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    sha = hashlib.sha1()
+    sha.update(json.dumps(sorted(tokenizer.encoder.items())).encode('utf-8'))
+    sha.update(json.dumps(sorted(tokenizer.bpe_ranks.items(), key=lambda x: x[1])).encode('utf-8'))
+    sha.update(json.dumps(sorted(tokenizer.added_tokens_encoder.items())).encode('utf-8'))
+    sha.update(json.dumps(sorted(tokenizer.all_special_ids)).encode('utf-8'))
+    tokenizer._cqr_hash = (key, sha.hexdigest())
+    return tokenizer._cqr_hash[1]
+
 def convert_json_to_txt(json_file, out_file, key='output'):
     print(f"converting {json_file} for {key}...")
     with open(json_file, encoding="utf-8") as fp, open(out_file,'w') as rp:
@@ -1,5 +1,7 @@
 
 import argparse
+import copy
+import itertools
 import json
 import logging
 import random
@@ -7,12 +9,66 @@ import torch
 
 from tqdm import tqdm, trange
 
+from cqr.fold_runner import run_folds
 from cqr.inference_model import InferenceModel
+from cqr.prediction_job import PredictionJob
+from cqr.prediction_pipeline import stream_predictions
+from cqr.token_cache import save_token_cache
 from cqr.utils import NUM_FOLD, set_seed
 
 logger = logging.getLogger(__name__)
 
 
+def parse_session(line):
+    splitted = (line[:-1] if line[-1] == '\n' else line).split('\t')
+    return splitted[0], splitted[1:]
+
+
+def session_inputs(session):
+    # every turn is simplified from the raw queries, so all turns of a session can be decoded together
+    topic_number, queries = session
+    return [(queries[:i], topic_number) for i in range(2, len(queries) + 1)]
+
+
+def session_output_lines(session, all_predictions):
+    topic_number, queries = session
+    output_lines = []
+    i = 1
+    predictions = [queries[0]]
+    for query, prediction in zip(queries[1:], all_predictions):
+        i += 1
+        prediction = prediction.strip()
+        predictions.append(prediction)
+        target_sent = query
+        if prediction == target_sent.strip():
+            continue
+        
+        output_lines.append(json.dumps({"topic_number": topic_number, "query_number": i, "input": predictions, "target": target_sent}))
+    return output_lines
+
+
+def simplify_sessions(inference_model, input_file, job, batch_size=1, queue_size=16):
+    with open(input_file, 'r') as fin:
+        skip = job.skip(input_file)
+        if skip:
+            logger.info("Resuming %s after %d sessions", input_file, skip)
+        sessions = (parse_session(line) for line in itertools.islice(fin, skip, None))
+        for session, predictions in tqdm(stream_predictions(inference_model, sessions, session_inputs, batch_size,
+                                                            queue_size), desc="Predict"):
+            job.write(input_file, session_output_lines(session, predictions))
+
+
+def simplify_fold(args, i):
+    fold_args = copy.copy(args)
+    fold_args.model_path = "%s-%d" % (args.model_path, i)
+    logger.info("Predict using Model {}".format(fold_args.model_path))
+    inference_model = InferenceModel(fold_args)
+    output_file = "%s.%d" % (args.output_file, i)
+    with PredictionJob(output_file, args.resume, args.checkpoint_every) as job:
+        simplify_sessions(inference_model, args.input_file, job, args.batch_size, args.queue_size)
+    logger.info("%s", inference_model.token_cache)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--model_path", default=None, type=str, required=True,
@@ -27,14 +83,42 @@ def main():
     parser.add_argument("--temperature", type=float, default=0.0,
                         help="temperature of 0 implies greedy sampling")
     parser.add_argument("--top_p", type=float, default=0.9)
+    parser.add_argument("--stop_sequences", type=str, nargs='*', default=[],
+                        help="Also stop decoding at any of these strings (they are left out of the rewrite)")
+    parser.add_argument("--sync_every", type=int, default=0,
+                        help="Decode steps between checks for finished rewrites, 0 for 1 on CPU and 8 on GPU")
+    parser.add_argument("--no_kv_cache", action='store_true',
+                        help="Re-run the full history at every decoding step instead of reusing cached key/values")
+    parser.add_argument("--prefix_cache_mb", type=float, default=0,
+                        help="Memory budget for caching the encoded history of each session between its turns, 0 to disable")
+    parser.add_argument("--token_cache_size", type=int, default=100000,
+                        help="Number of tokenized sentences kept in memory (0 disables)")
+    parser.add_argument("--token_cache_file", type=str, default=None,
+                        help="Load tokenized sentences from this file if it exists and save them back to it")
     parser.add_argument("--no_cuda", action='store_true',
                         help="Avoid using CUDA when available")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
     parser.add_argument('--cross_validate', action='store_true',
                         help="flag for switching to CV mode")
+    parser.add_argument("--fold_workers", type=int, default=1,
+                        help="Number of folds run in parallel processes, at most one per GPU")
     parser.add_argument('--n_gpu', default=-1, type=int,
                         help="Number of GPUs to use")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="Number of turns decoded together")
+    parser.add_argument("--queue_size", type=int, default=16,
+                        help="Number of sessions buffered between reading, decoding and writing")
+    parser.add_argument("--resume", action='store_true',
+                        help="Continue an interrupted run from the last checkpoint in the output file's manifest")
+    parser.add_argument("--checkpoint_every", type=int, default=1000,
+                        help="Flush the output and update its manifest every this many sessions, 0 to disable")
+    parser.add_argument('--mtl', action='store_true',
+                        help="Activate MTL setting")
+    parser.add_argument("--rewrite_threshold", type=float, default=0.0,
+                        help="MTL only: return the last utterance unchanged when the classifier's needs_rewrite "
+                             "probability is below this threshold, 0 always decodes")
+    parser.add_argument('--toy_data', action='store_true')
     args = parser.parse_args()
 
     args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
@@ -49,58 +133,18 @@ def main():
     if args.length < 0:
         args.length = MAX_LENGTH  # avoid infinite loop
 
-    model_path = args.model_path
     if args.cross_validate:
         logger.info("***Using CV mode!***")
-        for i in range(NUM_FOLD):
-            args.model_path = "%s-%d" % (model_path, i)
-            logger.info("Predict using Model {}".format(args.model_path))
-            inference_model = InferenceModel(args)
-            output_file = "%s.%d" % (args.output_file, i)
-            with open(args.input_file, 'r') as fin, open(output_file, 'w') as fout:
-                all_lines = fin.readlines()
-                for line in tqdm(all_lines, desc="Predict"):
-                    splitted = (line[:-1] if line[-1] == '\n' else line).split('\t')
-                    queries = splitted[1:]
-                    topic_number = splitted[0]
-                    i = 1
-                    predictions = [queries[0]]
-                    for query in queries[1:]:
-                        i += 1
-                        input_sents = queries[:i]
-                        prediction = inference_model.predict(input_sents).strip()
-                        predictions.append(prediction)
-                        target_sent = query
-                        if prediction == target_sent.strip():
-                            continue
-                        
-                        output_line = json.dumps({"topic_number": topic_number, "query_number": i, "input": predictions, "target": target_sent})
-                        fout.write(output_line + "\n")
+        run_folds(simplify_fold, args)
     else:
         logger.info("***Using single model model***")
         logger.info("Predict using Model {}".format(args.model_path))
         inference_model = InferenceModel(args)
         output_file = args.output_file
-        with open(args.input_file, 'r') as fin, open(output_file, 'w') as fout:
-            all_lines = fin.readlines()
-            for line in tqdm(all_lines, desc="Predict"):
-                splitted = (line[:-1] if line[-1] == '\n' else line).split('\t')
-                queries = splitted[1:]
-                topic_number = splitted[0]
-                i = 1
-                predictions = [queries[0]]
-                for query in queries[1:]:
-                    i += 1
-                    input_sents = queries[:i]
-                    prediction = inference_model.predict(input_sents).strip()
-                    predictions.append(prediction)
-                    target_sent = query
-                    if prediction == target_sent.strip():
-                        continue
-                    
-                    output_line = json.dumps({"topic_number": topic_number, "query_number": i, "input": predictions, "target": target_sent})
-                    fout.write(output_line + "\n")
-
+        with PredictionJob(output_file, args.resume, args.checkpoint_every) as job:
+            simplify_sessions(inference_model, args.input_file, job, args.batch_size, args.queue_size)
+        logger.info("%s", inference_model.token_cache)
+        save_token_cache(inference_model.token_cache, args)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,56 @@
+import argparse
+import json
+
+import pytest
+import torch
+from transformers import GPT2Config, GPT2DoubleHeadsModel, GPT2LMHeadModel, GPT2Tokenizer
+from transformers.tokenization_gpt2 import bytes_to_unicode
+
+from cqr.inference_model import InferenceModel
+from cqr.token_cache import SentenceTokenCache
+from cqr.utils import special_tokens_dict
+
+CONVERSATIONS = [
+    ["what is throat cancer?", "is it treatable?"],
+    ["tell me about the bronze age collapse", "what caused it?", "when did it start?"],
+    ["who won the world cup in 2014?"],
+]
+MERGES = ["Ġ t", "Ġ a", "h e", "i n", "r e", "o n", "Ġt he", "e r", "Ġ s", "a t", "Ġ w", "Ġ o"]
+
+
+@pytest.fixture(scope='session')
+def tokenizer(tmp_path_factory):
+    """ A byte-level BPE tokenizer with a handful of merges, so that the models stay tiny """
+    path = tmp_path_factory.mktemp('tokenizer')
+    vocab = {u: i for i, u in enumerate(sorted(bytes_to_unicode().values()))}
+    for merge in MERGES:
+        vocab[merge.replace(' ', '')] = len(vocab)
+    vocab['<|endoftext|>'] = len(vocab)
+    (path / 'vocab.json').write_text(json.dumps(vocab))
+    (path / 'merges.txt').write_text('#version: 0.2\n' + '\n'.join(MERGES) + '\n')
+    tokenizer = GPT2Tokenizer(str(path / 'vocab.json'), str(path / 'merges.txt'))
+    tokenizer.add_special_tokens(special_tokens_dict)
+    return tokenizer
+
+
+@pytest.fixture(params=[GPT2LMHeadModel, GPT2DoubleHeadsModel], ids=['lm', 'mtl'])
+def model(request, tokenizer):
+    """ A tiny random model; the large initializer range gives peaked, input dependent predictions instead of
+        <EOS> right away
+    """
+    torch.manual_seed(0)
+    config = GPT2Config(vocab_size=len(tokenizer), n_positions=256, n_ctx=256, n_embd=32, n_layer=2, n_head=2,
+                        initializer_range=0.3)
+    return request.param(config).eval()
+
+
+@pytest.fixture
+def make_inference_model(tokenizer):
+    """ InferenceModel(args) around a model, greedy unless told otherwise; keyword arguments are added to args """
+    def make(model, **kwargs):
+        settings = dict(mtl=isinstance(model, GPT2DoubleHeadsModel), device=torch.device('cpu'), length=20,
+                        temperature=0.0, top_p=0.9, toy_data=False)
+        settings.update(kwargs)
+        return InferenceModel(argparse.Namespace(**settings), {'model': model, 'tokenizer': tokenizer},
+                              token_cache=SentenceTokenCache(tokenizer))
+    return make
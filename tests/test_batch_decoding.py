@@ -0,0 +1,24 @@
+from conftest import CONVERSATIONS
+
+
+def test_predict_batch_matches_predict(model, make_inference_model):
+    inference_model = make_inference_model(model)
+    # conversations of different lengths, so that all but the longest are left-padded
+    conversations = CONVERSATIONS + [CONVERSATIONS[1][:1], ["is it?"]]
+    assert len({len(inference_model.get_input_seq(input_sents)) for input_sents in conversations}) > 1
+    expected = [inference_model.predict(input_sents) for input_sents in conversations]
+    assert inference_model.predict_batch(conversations) == expected
+
+
+def test_predict_batch_matches_predict_with_early_stops(model, make_inference_model, tokenizer):
+    # stop at tokens the conversations predict at different steps, so that rows finish and leave the batch early
+    inference_model = make_inference_model(model)
+    stop_sequences = [tokenizer.decode([inference_model.generate(inference_model.get_input_seq(input_sents))[step]])
+                      for step, input_sents in zip([2, 5, 9], CONVERSATIONS)]
+    for sync_every in [1, 3]:
+        inference_model = make_inference_model(model, stop_sequences=stop_sequences, sync_every=sync_every)
+        pred_ids = [inference_model.generate(inference_model.get_input_seq(input_sents))
+                    for input_sents in CONVERSATIONS]
+        assert len({len(ids) for ids in pred_ids}) > 1
+        expected = [inference_model.predict(input_sents) for input_sents in CONVERSATIONS]
+        assert inference_model.predict_batch(CONVERSATIONS) == expected
@@ -0,0 +1,13 @@
+from conftest import CONVERSATIONS
+
+
+def test_single_beam_matches_greedy(model, make_inference_model):
+    inference_model = make_inference_model(model)
+    assert inference_model.num_beams == 1
+    for input_sents in CONVERSATIONS:
+        input_ids = inference_model.get_input_seq(input_sents)
+        # with one beam, beam search keeps the most likely token at every step
+        (pred_ids, log_prob), = inference_model.generate_beams(input_ids)
+        assert pred_ids == inference_model.generate(input_ids)
+        assert inference_model.finish_nbest(input_sents, [(pred_ids, log_prob)])[0][0] == \
+            inference_model.predict(input_sents)
@@ -0,0 +1,11 @@
+from conftest import CONVERSATIONS
+
+
+def test_greedy_rewrites_same_with_and_without_kv_cache(model, make_inference_model):
+    cached = make_inference_model(model)
+    uncached = make_inference_model(model, no_kv_cache=True)
+    assert cached.use_cache and not uncached.use_cache
+    for input_sents in CONVERSATIONS:
+        input_ids = cached.get_input_seq(input_sents)
+        assert cached.generate(input_ids) == uncached.generate(input_ids)
+        assert cached.predict(input_sents) == uncached.predict(input_sents)
@@ -0,0 +1,50 @@
+import pytest
+import torch
+from torch.nn import functional as F
+
+from cqr.modeling import target_lm_loss, target_positions
+from cqr.mtl_run_training import get_lm_loss
+
+
+def random_batch(batch_size, length=12, vocab_size=50, pred_begin_pos=5):
+    """ Logits and labels of a batch whose targets start after pred_begin_pos, with some padded rows (-1) """
+    torch.manual_seed(0)
+    lm_logits = torch.randn(batch_size, length, vocab_size, requires_grad=True)
+    labels = torch.randint(vocab_size, (batch_size, length))
+    labels[:, :pred_begin_pos] = -1
+    labels[1:, -2:] = -1
+    return lm_logits, labels
+
+
+def test_lm_loss_without_rows_to_rewrite():
+    lm_logits, labels = random_batch(3)
+    loss = get_lm_loss(lm_logits, labels, torch.zeros(3, dtype=torch.long))
+    assert loss.item() == 0
+    loss.backward()
+    assert torch.isfinite(lm_logits.grad).all() and (lm_logits.grad == 0).all()
+
+
+def test_lm_loss_of_one_row():
+    lm_logits, labels = random_batch(1)
+    loss = get_lm_loss(lm_logits, labels, torch.ones(1, dtype=torch.long))
+    targets = labels[0, 1:] != -1
+    expected = F.cross_entropy(lm_logits[0, :-1][targets], labels[0, 1:][targets])
+    assert torch.allclose(loss, expected)
+
+
+@pytest.mark.parametrize('chunk_size', [0, 3])
+@pytest.mark.parametrize('needs_rewrite', [None, torch.tensor([1, 0, 1, 1])], ids=['lm', 'mtl'])
+def test_target_lm_loss_matches_full_logits_loss(needs_rewrite, chunk_size):
+    _, labels = random_batch(4)
+    hidden_states = torch.randn(4, labels.size(1), 16, requires_grad=True)
+    lm_head = torch.nn.Linear(16, 50, bias=False)
+
+    loss = target_lm_loss(lm_head, hidden_states, *target_positions(labels, needs_rewrite), chunk_size=chunk_size)
+    grads = torch.autograd.grad(loss, [hidden_states, lm_head.weight])
+    # the LM model scores every row
+    expected = get_lm_loss(lm_head(hidden_states), labels, torch.ones(4, dtype=torch.long)
+                           if needs_rewrite is None else needs_rewrite)
+    expected_grads = torch.autograd.grad(expected, [hidden_states, lm_head.weight])
+    assert torch.allclose(loss, expected)
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad, atol=1e-6)
@@ -0,0 +1,27 @@
+from conftest import CONVERSATIONS
+
+
+def test_prefix_cache_decoding_matches_uncached(model, make_inference_model):
+    cached = make_inference_model(model, prefix_cache_mb=1)
+    uncached = make_inference_model(model)
+    assert cached.prefix_cache is not None and uncached.prefix_cache is None
+    # every turn of a session extends the previous one, so later turns only prefill their new utterance
+    for session_id, conversation in enumerate(CONVERSATIONS):
+        for turn in range(1, len(conversation) + 1):
+            input_ids = cached.get_input_seq(conversation[:turn])
+            assert cached.generate(input_ids, session_id=session_id) == uncached.generate(input_ids)
+            # a turn decoded again reuses the whole cached prefix
+            assert cached.generate(input_ids, session_id=session_id) == uncached.generate(input_ids)
+    assert cached.prefix_cache.hits > 0
+
+
+def test_prefix_cache_with_changed_history(model, make_inference_model):
+    # a session whose earlier utterance changed misses the cache and is encoded again
+    cached = make_inference_model(model, prefix_cache_mb=1)
+    uncached = make_inference_model(model)
+    for input_sents in [["what is throat cancer?", "is it treatable?"],
+                        ["what is lung cancer?", "is it treatable?"],
+                        ["what is lung cancer?", "is it treatable?", "how?"]]:
+        input_ids = cached.get_input_seq(input_sents)
+        assert cached.generate(input_ids, session_id='session') == uncached.generate(input_ids)
+    assert cached.prefix_cache.hits == 1 and cached.prefix_cache.misses == 2
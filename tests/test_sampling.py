@@ -0,0 +1,31 @@
+import pytest
+import torch
+from torch.nn import functional as F
+
+from cqr.sampling import sample_top_p, top_p_filtering
+
+NUM_SAMPLES = 10000
+
+
+def nucleus_probs(logits, top_p):
+    return F.softmax(top_p_filtering(logits.clone(), top_p=top_p), dim=-1)
+
+
+@pytest.mark.parametrize('max_candidates', [256, 4], ids=['top_k', 'fallback'])
+def test_sample_top_p_matches_top_p_filtering(max_candidates):
+    torch.manual_seed(0)
+    # rows whose nucleus has a few to dozens of tokens, which fit in 256 candidates but not all in 4,
+    # and a flat row whose nucleus does not fit in either
+    logits = torch.cat([torch.randn(2, 500) * 3, torch.randn(2, 500) * 2, torch.randn(1, 500)])
+    expected = nucleus_probs(logits, 0.9)
+    nucleus_sizes = (expected > 0).sum(dim=-1)
+    assert (nucleus_sizes <= 4).any() and ((nucleus_sizes > 4) & (nucleus_sizes <= 256)).any()
+    assert (nucleus_sizes > 256).any()
+
+    samples = sample_top_p(logits.repeat_interleave(NUM_SAMPLES, dim=0), 0.9, max_candidates)
+    samples = samples.view(len(logits), NUM_SAMPLES)
+    for row, row_samples in enumerate(samples):
+        # only tokens of the nucleus are drawn, as often as its renormalised distribution says
+        assert (expected[row, row_samples] > 0).all()
+        frequencies = torch.bincount(row_samples, minlength=logits.size(-1)).float() / NUM_SAMPLES
+        assert (frequencies - expected[row]).abs().max() < 0.02